@@ -3,27 +3,23 @@ import re
 import unicodedata
 from pathlib import Path
 import zipfile
+import numpy as np
 import pandas as pd
 import streamlit as st
-from typing import Optional, Tuple
+from typing import Dict, Optional, Tuple
 
 # === [NOVO BLOCO] Extração de Protocolo e Competência do Balancete ===
 
-# Mapa de meses PT-BR -> número
-MESES_PT = {
-    "JAN": 1, "JANEIRO": 1,
-    "FEV": 2, "FEVEREIRO": 2,
-    "MAR": 3, "MARCO": 3, "MARÇO": 3,
-    "ABR": 4, "ABRIL": 4,
-    "MAI": 5, "MAIO": 5,
-    "JUN": 6, "JUNHO": 6,
-    "JUL": 7, "JULHO": 7,
-    "AGO": 8, "AGOSTO": 8,
-    "SET": 9, "SETEMBRO": 9, "SETEM": 9, "SETEMB": 9,
-    "OUT": 10, "OUTUBRO": 10,
-    "NOV": 11, "NOVEMBRO": 11,
-    "DEZ": 12, "DEZEMBRO": 12,
-}
+# Meses PT-BR, regex e demais tabelas fixas do parsing: ver TABELAS (montada uma vez por processo)
+
+# === Progresso / cancelamento de tarefas longas ===
+class TarefaCancelada(Exception):
+    """Levantada dentro de uma tarefa em segundo plano quando o usuário pede o cancelamento."""
+
+def _avisar_progresso(progresso, feitos: int, total: Optional[int] = None, etapa: str = "") -> None:
+    """Repassa o andamento para o callback (se houver). O callback pode levantar TarefaCancelada."""
+    if progresso is not None:
+        progresso(feitos, total, etapa)
 
 # --- Helper robusto para normalizar competência para MM/YYYY
 def _normalize_competencia_to_mm_yyyy(raw: Optional[str]) -> Optional[str]:
@@ -33,7 +29,7 @@ def _normalize_competencia_to_mm_yyyy(raw: Optional[str]) -> Optional[str]:
     s = s.replace("  ", " ").strip()
 
     # 1) dd/mm/yyyy -> MM/YYYY
-    m = re.search(r"(\d{2})/(\d{2})/(\d{4})", s)
+    m = _RE["competencia_data"].search(s)
     if m:
         dd, mm, yyyy = m.group(1), m.group(2), m.group(3)
         try:
@@ -44,18 +40,18 @@ def _normalize_competencia_to_mm_yyyy(raw: Optional[str]) -> Optional[str]:
             pass
 
     # 2) mm/yyyy -> MM/YYYY
-    m = re.search(r"\b(\d{1,2})/(\d{4})\b", s)
+    m = _RE["competencia_mm_aaaa"].search(s)
     if m:
         mm, yyyy = int(m.group(1)), int(m.group(2))
         if 1 <= mm <= 12:
             return f"{mm:02d}/{yyyy}"
 
     # 3) abreviação/nome do mês + ano (ex: jun/25, junho/25, jun/2025, JUN/25)
-    m = re.search(r"\b([A-ZÇÃÉÀ-ÿ]{3,10})[^\dA-Z]*(\d{2}|\d{4})\b", s, flags=re.I)
+    m = _RE["competencia_mes_ano"].search(s)
     if m:
         mes_txt = normaliza_texto(m.group(1))
         # tenta mapear a palavra inteira, depois os 3 primeiros chars
-        mes_num = MESES_PT.get(mes_txt) or MESES_PT.get(mes_txt[:3]) if mes_txt else None
+        mes_num = TABELAS.meses.get(mes_txt) or TABELAS.meses.get(mes_txt[:3]) if mes_txt else None
         if mes_num:
             ano_raw = m.group(2)
             ano = int(ano_raw) + 2000 if len(ano_raw) == 2 else int(ano_raw)
@@ -63,7 +59,7 @@ def _normalize_competencia_to_mm_yyyy(raw: Optional[str]) -> Optional[str]:
                 return f"{mes_num:02d}/{ano}"
 
     # 4) AAAA-MM ou AAAA/MM -> MM/YYYY
-    m = re.search(r"\b(20\d{2})[\/\-](\d{1,2})\b", s)
+    m = _RE["competencia_aaaa_mm"].search(s)
     if m:
         ano, mm = int(m.group(1)), int(m.group(2))
         if 1 <= mm <= 12:
@@ -76,16 +72,24 @@ def carregar_controle_fic(arquivo):
     Lê do Controle FIC as colunas 'Fundos', 'CNPJ', 'COD GFI' e, se existir, propaga também 'SIT' (ou variação).
     Funciona para .xlsx e .xls (precisa de xlrd p/ .xls).
     """
+    return ler_controle_fic(arquivo)["controle"]
+
+def ler_controle_fic(arquivo) -> Dict[str, pd.DataFrame]:
+    """
+    Como carregar_controle_fic, mas devolve também as linhas descartadas por CNPJ vazio ou com
+    dígito verificador errado: {'controle': ..., 'invalidos': ['Linha', 'CNPJ (original)', 'Fundos',
+    'COD GFI', 'SIT', 'Motivo']} — vão para o relatório de CNPJs inválidos e para a conciliação por nome.
+    """
     # 1) Ler tudo como texto (evita depender de letras de coluna)
     ext = str(getattr(arquivo, "name", "")).lower().rsplit(".", 1)[-1]
     engine = "openpyxl" if ext == "xlsx" else None  # deixe None p/ pandas escolher xlrd p/ .xls
     df = pd.read_excel(arquivo, dtype=str, engine=engine)
 
     # 2) Normalizar cabeçalhos (mesma normalização que havia)
-    import unicodedata, re
+    import unicodedata
     def norm(s):
         s = unicodedata.normalize("NFKD", str(s)).encode("ascii", "ignore").decode("utf-8")
-        s = re.sub(r"\s+", " ", s).strip().upper()
+        s = _RE["espacos"].sub(" ", s).strip().upper()
         return s
 
     colmap = {norm(c): c for c in df.columns}
@@ -121,19 +125,21 @@ def carregar_controle_fic(arquivo):
     if col_gfi:    out["COD GFI"]= df[col_gfi]
     if col_sit:    out["SIT"]    = df[col_sit].astype(str).fillna("")
 
-    # 5) Normalizar CNPJ e tirar duplicatas (mantém lógica atual)
-    def so_digitos(s): return re.sub(r"\D", "", str(s or ""))
-    def normaliza_cnpj(c):
-        d = so_digitos(c)
-        if len(d) == 14: return d
-        return d.zfill(14) if 0 < len(d) < 14 else None
-    def formatar_cnpj(c):
-        d = normaliza_cnpj(c)
-        if not d: return None
-        return f"{d[:2]}.{d[2:5]}.{d[5:8]}/{d[8:12]}-{d[12:]}"
-
+    # 5) Normalizar CNPJ (em lote, com dígito verificador) e tirar duplicatas
+    colunas_invalidos = ["Linha", "CNPJ (original)", "Fundos", "COD GFI", "SIT", "Motivo"]
+    invalidos = pd.DataFrame(columns=colunas_invalidos)
     if "CNPJ" in out.columns:
-        out["CNPJ"] = out["CNPJ"].apply(lambda x: formatar_cnpj(normaliza_cnpj(x)) if pd.notna(x) else None)
+        original = out["CNPJ"]
+        motivo = motivo_cnpj_invalido(original)
+        out["CNPJ"] = formatar_cnpjs(digitos_cnpj(original)).where(motivo.isna())
+        if "Fundos" in out.columns:
+            # linha em branco no meio da planilha não é CNPJ inválido
+            preenchida = out["Fundos"].notna() & (out["Fundos"].astype(str).str.strip() != "")
+            descartadas = motivo.notna() & (preenchida | original.notna())
+            invalidos = out.loc[descartadas].drop(columns="CNPJ").assign(**{
+                "Linha": (out.index[descartadas.to_numpy()] + 2).astype(str),  # linha no Excel (cabeçalho = 1)
+                "CNPJ (original)": original[descartadas], "Motivo": motivo[descartadas]})
+            invalidos = invalidos.reindex(columns=colunas_invalidos)
         out = out.dropna(subset=["CNPJ"]).drop_duplicates(subset=["CNPJ"], keep="first")
 
     # 6) Garantir colunas (agora incluindo SIT)
@@ -145,7 +151,7 @@ def carregar_controle_fic(arquivo):
     cols_order = ["CNPJ", "Fundos", "COD GFI"]
     if "SIT" in out.columns:
         cols_order.append("SIT")
-    return out[cols_order]
+    return {"controle": compactar_dtypes(out[cols_order]), "invalidos": compactar_dtypes(invalidos.astype(TIPO_TEXTO))}
 
      
 
@@ -161,21 +167,21 @@ def _extrair_mm_aaaa(valor: Optional[str]) -> Optional[str]:
     s = str(valor).strip()
 
     # 'DD/MM/AAAA' -> MM/AAAA
-    m = re.fullmatch(r"(\d{1,2})/(\d{1,2})/(20\d{2})", s)
+    m = _RE["d_m_aaaa"].fullmatch(s)
     if m:
         mm, aaaa = int(m.group(2)), int(m.group(3))
         if 1 <= mm <= 12:
             return f"{mm:02d}/{aaaa}"
 
     # 'MM/AAAA'
-    m = re.fullmatch(r"(\d{1,2})/(20\d{2})", s)
+    m = _RE["m_aaaa"].fullmatch(s)
     if m:
         mm, aaaa = int(m.group(1)), int(m.group(2))
         if 1 <= mm <= 12:
             return f"{mm:02d}/{aaaa}"
 
     # 'AAAA-MM'
-    m = re.fullmatch(r"(20\d{2})-(\d{1,2})", s)
+    m = _RE["aaaa_m"].fullmatch(s)
     if m:
         aaaa, mm = int(m.group(1)), int(m.group(2))
         if 1 <= mm <= 12:
@@ -187,41 +193,70 @@ def _extrair_mm_aaaa(valor: Optional[str]) -> Optional[str]:
 import pandas as pd
 from typing import Optional, Dict
 
-def consolidar_incons_por_fundo(df_incons: pd.DataFrame) -> pd.DataFrame:
+COLUNAS_CONSOLIDADO = ["CNPJ", "Nome do fundo", "CDA atual", "CDA esperada", "Balancete atual", "Balancete esperada"]
+SEGMENTOS_DIVERGENCIA = ("Somente CDA", "Somente Balancete", "Ambos")
+
+def consolidar_divergencias(df_incons: pd.DataFrame, df_base: Optional[pd.DataFrame] = None) -> Dict[str, object]:
     """
-    Converte o DF de inconsistências (uma linha por origem) em um DF consolidado (uma linha por CNPJ),
-    com colunas lado a lado para CDA e Balancete.
+    Consolida o DF de inconsistências (uma linha por origem) em um único pivot por CNPJ e devolve
+    tudo o que o painel do passo 4 usa:
+      - consolidado: uma linha por CNPJ, colunas lado a lado para CDA e Balancete
+      - segmento: Series alinhada ao consolidado ('Somente CDA' / 'Somente Balancete' / 'Ambos')
+      - segmentos: dict segmento -> fatia do consolidado
+      - resumo: mesmas métricas de resumo_divergencias
     """
+    total_fundos = df_base["CNPJ"].dropna().nunique() if df_base is not None and "CNPJ" in df_base.columns else 0
     cols_base = {"CNPJ", "Nome do fundo", "Origem", "Competência atual", "Competência esperada"}
-    if not cols_base.issubset(df_incons.columns):
-        return pd.DataFrame(columns=[
-            "CNPJ","Nome do fundo","CDA atual","CDA esperada","Balancete atual","Balancete esperada"
-        ])
-
-    cda = (
-        df_incons[df_incons["Origem"]=="CDA"]
-        [["CNPJ","Nome do fundo","Competência atual","Competência esperada"]]
-        .rename(columns={"Competência atual":"CDA atual","Competência esperada":"CDA esperada"})
-    )
-    bal = (
-        df_incons[df_incons["Origem"]=="Balancete"]
-        [["CNPJ","Nome do fundo","Competência atual","Competência esperada"]]
-        .rename(columns={"Competência atual":"Balancete atual","Balancete esperada":"Balancete esperada"})
-    )
 
-    # OBS: Corrige um rename que o Python não faria automaticamente
-    if "Balancete esperada" not in bal.columns:
-        bal = bal.rename(columns={"Competência esperada":"Balancete esperada"})
+    if df_incons is None or df_incons.empty or not cols_base.issubset(df_incons.columns):
+        consolidado = pd.DataFrame(columns=COLUNAS_CONSOLIDADO)
+        segmento = pd.Series(dtype=object)
+    else:
+        # um pivot (CNPJ x Origem) com um indicador de presença: origem presente = CNPJ no segmento
+        linhas = df_incons.drop_duplicates(subset=["CNPJ", "Origem"]).assign(_presente=True)
+        linhas["Origem"] = linhas["Origem"].astype(str)
+        wide = linhas.pivot(index="CNPJ", columns="Origem",
+                            values=["Nome do fundo", "Competência atual", "Competência esperada", "_presente"])
+        wide = wide.reindex(columns=pd.MultiIndex.from_product(
+            [["Nome do fundo", "Competência atual", "Competência esperada", "_presente"], ["CDA", "Balancete"]]))
+
+        tem_cda = wide[("_presente", "CDA")].notna().to_numpy()
+        tem_bal = wide[("_presente", "Balancete")].notna().to_numpy()
+        consolidado = pd.DataFrame({
+            "CNPJ": wide.index,
+            "Nome do fundo": wide[("Nome do fundo", "CDA")].combine_first(wide[("Nome do fundo", "Balancete")]).to_numpy(),
+            "CDA atual": wide[("Competência atual", "CDA")].to_numpy(),
+            "CDA esperada": wide[("Competência esperada", "CDA")].to_numpy(),
+            "Balancete atual": wide[("Competência atual", "Balancete")].to_numpy(),
+            "Balancete esperada": wide[("Competência esperada", "Balancete")].to_numpy(),
+        })
+        segmento = pd.Series(
+            np.select([tem_cda & tem_bal, tem_cda], ["Ambos", "Somente CDA"], default="Somente Balancete"),
+            index=consolidado.index,
+        )
 
-    full = pd.merge(cda, bal, on=["CNPJ","Nome do fundo"], how="outer")
-    # Ordena e garante as colunas na ordem desejada
-    for col in ["CDA atual","CDA esperada","Balancete atual","Balancete esperada"]:
-        if col not in full.columns:
-            full[col] = pd.NA
+    contagem = segmento.value_counts()
+    resumo = {
+        "total_fundos": total_fundos,
+        "linhas": 0 if df_incons is None else len(df_incons),
+        "fundos_com_erro": len(consolidado),
+        "somente_cda": int(contagem.get("Somente CDA", 0)),
+        "somente_balancete": int(contagem.get("Somente Balancete", 0)),
+        "ambos": int(contagem.get("Ambos", 0)),
+    }
+    return {
+        "consolidado": consolidado,
+        "segmento": segmento,
+        "segmentos": {nome: consolidado[segmento == nome] for nome in SEGMENTOS_DIVERGENCIA},
+        "resumo": resumo,
+    }
 
-    return full[["CNPJ","Nome do fundo","CDA atual","CDA esperada","Balancete atual","Balancete esperada"]] \
-             .drop_duplicates(subset=["CNPJ"]) \
-             .sort_values(by=["CNPJ"])
+def consolidar_incons_por_fundo(df_incons: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converte o DF de inconsistências (uma linha por origem) em um DF consolidado (uma linha por CNPJ),
+    com colunas lado a lado para CDA e Balancete.
+    """
+    return consolidar_divergencias(df_incons)["consolidado"]
 
 def resumo_divergencias(df_incons: pd.DataFrame, df_base: pd.DataFrame) -> Dict[str, int]:
     """
@@ -231,34 +266,7 @@ def resumo_divergencias(df_incons: pd.DataFrame, df_base: pd.DataFrame) -> Dict[
       - fundos_com_erro: nº de CNPJs únicos com qualquer divergência
       - somente_cda / somente_balancete / ambos: nº de CNPJs por segmento
     """
-    total_fundos = df_base["CNPJ"].dropna().nunique() if "CNPJ" in df_base.columns else 0
-    linhas = len(df_incons)
-
-    if linhas == 0:
-        return {
-            "total_fundos": total_fundos,
-            "linhas": 0,
-            "fundos_com_erro": 0,
-            "somente_cda": 0,
-            "somente_balancete": 0,
-            "ambos": 0,
-        }
-
-    cnpjs_cda = set(df_incons[df_incons["Origem"]=="CDA"]["CNPJ"].dropna())
-    cnpjs_bal = set(df_incons[df_incons["Origem"]=="Balancete"]["CNPJ"].dropna())
-    fundos_com_erro = len(cnpjs_cda | cnpjs_bal)
-    ambos = len(cnpjs_cda & cnpjs_bal)
-    somente_cda = len(cnpjs_cda - cnpjs_bal)
-    somente_balancete = len(cnpjs_bal - cnpjs_cda)
-
-    return {
-        "total_fundos": total_fundos,
-        "linhas": linhas,
-        "fundos_com_erro": fundos_com_erro,
-        "somente_cda": somente_cda,
-        "somente_balancete": somente_balancete,
-        "ambos": ambos,
-    }
+    return consolidar_divergencias(df_incons, df_base)["resumo"]
 
 
 # Normaliza uma string data 'qualquer' para DD/MM/AAAA quando possível (mantém "Não possui")
@@ -270,7 +278,7 @@ def _coagir_para_dd_mm_aaaa(valor: Optional[str]) -> Optional[str]:
         return t
 
     # Já está em DD/MM/AAAA válido
-    m = re.fullmatch(r"(\d{2})/(\d{2})/(20\d{2})", t)
+    m = _RE["dd_mm_aaaa"].fullmatch(t)
     if m:
         return t
 
@@ -286,20 +294,25 @@ def _coagir_para_dd_mm_aaaa(valor: Optional[str]) -> Optional[str]:
 def validar_por_data_exata(
     df: pd.DataFrame,
     data_alvo_ddmmaaaa: str,
-    contar_nao_possui: bool = True
+    contar_nao_possui: bool = True,
+    motor: str = "pandas",
 ) -> pd.DataFrame:
     """
     Compara se CDA_Competencia e Balancete_Competencia == data_alvo (DD/MM/AAAA) exatamente.
     Retorna apenas as inconsistências.
     """
     # Sanitiza a data alvo (aceita 1/8/2025, 01/8/2025, etc.)
-    m = re.fullmatch(r"\s*(\d{1,2})/(\d{1,2})/(20\d{2})\s*", str(data_alvo_ddmmaaaa))
+    m = _RE["data_alvo"].fullmatch(str(data_alvo_ddmmaaaa))
     if not m:
         raise ValueError("Data inválida. Use o formato DD/MM/AAAA.")
     dd, mm, aaaa = int(m.group(1)), int(m.group(2)), int(m.group(3))
     if not (1 <= mm <= 12 and 1 <= dd <= 31):
         raise ValueError("Data inválida. Verifique dia e mês.")
     data_alvo = f"{dd:02d}/{mm:02d}/{aaaa}"
+    if motor == "polars":
+        rapido = _inconsistencias_polars(df, "data", data_alvo, data_alvo, contar_nao_possui)
+        if rapido is not None:
+            return rapido
 
     inconsistencias = []
     col_nome = None
@@ -336,24 +349,30 @@ def validar_por_data_exata(
                     "Competência esperada": data_alvo
                 })
 
-    return pd.DataFrame(inconsistencias)
+    return compactar_dtypes(pd.DataFrame(inconsistencias))
 
 def validar_por_mes_ano(
     df: pd.DataFrame,
     mes_ano_alvo: str,  # "MM/AAAA"
-    contar_nao_possui: bool = True
+    contar_nao_possui: bool = True,
+    motor: str = "pandas",
 ) -> pd.DataFrame:
     """
     Compara apenas MM/AAAA das colunas CDA_Competencia e Balancete_Competencia.
     Retorna apenas as inconsistências.
     """
-    m = re.fullmatch(r"\s*(\d{1,2})/(20\d{2})\s*", str(mes_ano_alvo))
+    m = _RE["mes_alvo"].fullmatch(str(mes_ano_alvo))
     if not m:
         raise ValueError("Mês/Ano inválido. Use o formato MM/AAAA.")
     mm, aaaa = int(m.group(1)), int(m.group(2))
     if not (1 <= mm <= 12):
         raise ValueError("Mês inválido (1-12).")
     alvo_mm_aaaa = f"{mm:02d}/{aaaa}"
+    if motor == "polars":
+        rapido = _inconsistencias_polars(df, "mes_ano", alvo_mm_aaaa, f"Qualquer dia/{alvo_mm_aaaa}",
+                                         contar_nao_possui)
+        if rapido is not None:
+            return rapido
 
     inconsistencias = []
     col_nome = None
@@ -390,7 +409,7 @@ def validar_por_mes_ano(
                     "Competência esperada": f"Qualquer dia/{alvo_mm_aaaa}"
                 })
 
-    return pd.DataFrame(inconsistencias)
+    return compactar_dtypes(pd.DataFrame(inconsistencias))
 
 
 # === Helpers para validação de dia da competência (compatível com Python 3.9) ===
@@ -403,15 +422,15 @@ def _extrair_mm_aaaa(valor: str) -> Optional[str]:
         return None
     s = str(valor).strip()
     # aceita 'DD/MM/AAAA'
-    m = re.fullmatch(r"(\d{2})/(\d{2})/(20\d{2})", s)
+    m = _RE["dd_mm_aaaa"].fullmatch(s)
     if m:
         return f"{m.group(2)}/{m.group(3)}"
     # aceita 'MM/AAAA'
-    m = re.fullmatch(r"(\d{2})/(20\d{2})", s)
+    m = _RE["mm_aaaa"].fullmatch(s)
     if m:
         return f"{m.group(1)}/{m.group(2)}"
     # aceita 'AAAA-MM'
-    m = re.fullmatch(r"(20\d{2})-(\d{1,2})", s)
+    m = _RE["aaaa_m"].fullmatch(s)
     if m:
         mm = int(m.group(2))
         if 1 <= mm <= 12:
@@ -462,55 +481,54 @@ def validar_competencias_por_dia(df: pd.DataFrame, dia: int, contar_nao_possui:
                     "Competência atual": atual,
                     "Competência esperada": esperado
                 })
-    return pd.DataFrame(inconsistencias)
+    return compactar_dtypes(pd.DataFrame(inconsistencias))
 
 
 def adicionar_drive_por_cnpj(
     df_base: pd.DataFrame,
     controle_df: pd.DataFrame,
-    nome_col_saida: str = "COD GFI"  # <- agora o nome padrão é 'COD GFI'
+    nome_col_saida: str = "COD GFI",  # <- agora o nome padrão é 'COD GFI'
+    motor: str = "pandas",
+    mapa: Optional[pd.DataFrame] = None,
 ) -> pd.DataFrame:
     """
     Anexa a coluna 'COD GFI' aos relatórios do primeiro batimento.
     Faz merge por CNPJ com a planilha de Controle (usando a coluna 'COD GFI').
     Se não encontrar a coluna no Controle, devolve o DF original + coluna vazia.
+    `mapa` (de mapa_cod_gfi) evita refazer o mapa CNPJ -> COD GFI a cada relatório.
     """
     if df_base is None or df_base.empty:
         return df_base
 
-    # Garante CNPJ formatado dos dois lados
-    left = df_base.copy()
+    # Garante CNPJ formatado (cópia rasa: só a coluna CNPJ é trocada, o DF de entrada fica intacto)
+    left = df_base.copy(deep=False)
     if "CNPJ" in left.columns:
-        left["CNPJ"] = left["CNPJ"].apply(
-            lambda x: formatar_cnpj(normaliza_cnpj(x)) if pd.notna(x) else None
-        )
-
-    right = controle_df.copy()
-    if "CNPJ" in right.columns:
-        right["CNPJ"] = right["CNPJ"].apply(
-            lambda x: formatar_cnpj(normaliza_cnpj(x)) if pd.notna(x) else None
-        )
+        left["CNPJ"] = _cnpj_formatado(left["CNPJ"], motor)
 
     col_codgfi = "COD GFI"
-    if col_codgfi not in right.columns:
-        out = left.copy()
-        out[nome_col_saida] = ""
-        return out
-
-    mapa = (
-        right[["CNPJ", col_codgfi]]
-        .drop_duplicates(subset="CNPJ", keep="first")
-    )
+    if mapa is None:
+        mapa = mapa_cod_gfi(controle_df, motor)
+    if mapa is None:
+        left[nome_col_saida] = ""
+        return left
 
-    out = left.merge(mapa, on="CNPJ", how="left")
+    out = _merge_esquerda(left, mapa, "CNPJ", motor)
     if col_codgfi in out.columns:
-        out[col_codgfi] = out[col_codgfi].fillna("")
+        out[col_codgfi] = _preencher_vazios(out[col_codgfi], "")
 
     return out
 
 
 
 
+def mapa_cod_gfi(controle_df: pd.DataFrame, motor: str = "pandas") -> Optional[pd.DataFrame]:
+    """CNPJ formatado -> COD GFI (primeira ocorrência) do Controle, ou None se não houver a coluna."""
+    if "COD GFI" not in controle_df.columns:
+        return None
+    # só as duas colunas usadas (o resto do Controle não é copiado)
+    mapa = pd.DataFrame({"CNPJ": _cnpj_formatado(controle_df["CNPJ"], motor), "COD GFI": controle_df["COD GFI"]})
+    return mapa.drop_duplicates(subset="CNPJ", keep="first")
+
 def _format_competencia_yyyy_mm(ano: int, mes: int) -> str:
     mes = max(1, min(12, int(mes)))
     return f"{int(ano):04d}-{mes:02d}"
@@ -519,63 +537,50 @@ def _parse_competencia(texto: str) -> Optional[str]:
     T = normaliza_texto(texto)
 
     # 1) MM/AAAA ou MM-AAAA
-    m = re.search(r"\b(\d{1,2})[/\-](\d{4})\b", T)
+    m = _RE["texto_mm_aaaa"].search(T)
     if m:
         mes, ano = int(m.group(1)), int(m.group(2))
         if 1 <= mes <= 12:
             return _format_competencia_yyyy_mm(ano, mes)
 
     # 2) AAAA-MM ou AAAA/MM
-    m = re.search(r"\b(\d{4})[/\-](\d{1,2})\b", T)
+    m = _RE["texto_aaaa_mm"].search(T)
     if m:
         ano, mes = int(m.group(1)), int(m.group(2))
         if 1 <= mes <= 12:
             return _format_competencia_yyyy_mm(ano, mes)
 
     # 3) Nome do mês (abreviado ou completo) + AAAA
-    m = re.search(r"\b([A-ZÇÃÉ]+)[\s/.\-]*(\d{4})\b", T)
+    m = _RE["texto_mes_ano"].search(T)
     if m:
         mes_txt, ano = m.group(1), int(m.group(2))
-        mes = MESES_PT.get(mes_txt)
+        mes = TABELAS.meses.get(mes_txt)
         if mes:
             return _format_competencia_yyyy_mm(ano, mes)
 
     return None
 
 def _eh_cnpj_sequencia(numeros: str) -> bool:
-    d = re.sub(r"\D", "", str(numeros or ""))
+    d = _RE["nao_digito"].sub("", str(numeros or ""))
     return len(d) == 14
 
 def _parse_protocolo(texto: str) -> Optional[str]:
     T = normaliza_texto(texto)
 
-    m = re.search(r"(?:PROTOCOLO|NUMERO\s*DE\s*PROTOCOLO|GFI)\D*(\d{6,})", T, flags=re.I)
+    m = _RE["protocolo_rotulado"].search(T)
     if m:
         valor = m.group(1)
         if not _eh_cnpj_sequencia(valor):
             return valor
 
-    candidatos = re.findall(r"\b(\d{6,})\b", T)
+    candidatos = _RE["numero_longo"].findall(T)
     candidatos = [c for c in candidatos if not _eh_cnpj_sequencia(c)]
     if candidatos:
         return max(candidatos, key=len)
 
     return None
 
-def _read_text_from_xlsx(uploaded_file) -> str:
-    try:
-        df_head = pd.read_excel(uploaded_file, header=None, nrows=40, dtype=str, engine="openpyxl")
-        texto = " ".join(df_head.astype(str).fillna("").values.ravel())
-        return texto
-    except Exception:
-        return ""
-    finally:
-        try:
-            uploaded_file.seek(0)
-        except Exception:
-            pass
-
-def _read_text_from_pdf(uploaded_file) -> str:
+def _read_text_from_pdf(uploaded_file, progresso=None) -> str:
     try:
         import fitz  # PyMuPDF
     except Exception:
@@ -583,11 +588,14 @@ def _read_text_from_pdf(uploaded_file) -> str:
 
     try:
         data = uploaded_file.read()
-        texto = ""
+        paginas = []
         with fitz.open(stream=data, filetype="pdf") as doc:
-            for page in doc:
-                texto += " " + page.get_text("text")
-        return texto
+            for i, page in enumerate(doc):
+                _avisar_progresso(progresso, i, doc.page_count, "páginas do PDF")
+                paginas.append(page.get_text("text"))
+        return "\n".join(paginas)
+    except TarefaCancelada:
+        raise
     except Exception:
         return ""
     finally:
@@ -600,13 +608,13 @@ def extrair_protocolo_e_competencia_do_balancete(uploaded_file) -> Tuple[Optiona
     if not uploaded_file:
         return (None, None)
 
-    nome = str(getattr(uploaded_file, "name", "")).lower()
-    texto = ""
-
-    if nome.endswith(".xlsx"):
-        texto = _read_text_from_xlsx(uploaded_file)
-    elif nome.endswith(".pdf"):
-        texto = _read_text_from_pdf(uploaded_file)
+    # só as primeiras linhas da planilha / a 1ª página do PDF (ver classificar_arquivo)
+    try:
+        formato = formato_do_arquivo(uploaded_file)
+        linhas = _amostra_linhas(uploaded_file, formato) if formato in ("xlsx", "pdf") else []
+    except Exception:
+        linhas = []
+    texto = " ".join(c for linha in linhas for c in linha)
 
     texto_total = f"{texto}  {getattr(uploaded_file, 'name', '')}"
 
@@ -617,7 +625,7 @@ def extrair_protocolo_e_competencia_do_balancete(uploaded_file) -> Tuple[Optiona
 # === [FIM DO BLOCO NOVO] ===
 
 def so_digitos(s):
-    return re.sub(r'\D', '', str(s or ''))
+    return _RE["nao_digito"].sub('', str(s or ''))
 
 def normaliza_cnpj(cnpj):
     d = so_digitos(cnpj)
@@ -633,15 +641,68 @@ def formatar_cnpj(cnpj):
         return None
     return f"{d[:2]}.{d[2:5]}.{d[5:8]}/{d[8:12]}-{d[12:]}"
 
-def remover_duplicatas_por_cnpj(df, coluna_origem):
-    df = df.copy()
-    df["CNPJ_Normalizado"] = df[coluna_origem].apply(normaliza_cnpj)
-    df["CNPJ"] = df["CNPJ_Normalizado"].apply(formatar_cnpj)
-    df = df[df["CNPJ"].notnull()]
-    return df.drop_duplicates(subset="CNPJ").copy()
+# --- CNPJ em lote: as mesmas regras de normaliza_cnpj/formatar_cnpj, mais o dígito verificador,
+# como operações de coluna (texto Arrow) e de matriz (numpy) — sem laço Python por linha.
+PESOS_DV1_CNPJ = np.array([5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2])
+PESOS_DV2_CNPJ = np.array([6, 5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2])
+
+def digitos_cnpj(serie: pd.Series) -> pd.Series:
+    """normaliza_cnpj de cada valor: 14 dígitos (menos que isso é completado com zeros) ou NA."""
+    d = serie.astype(TIPO_TEXTO).str.replace(r"\D", "", regex=True)
+    n = d.str.len()
+    return d.where((n > 0) & (n <= 14)).str.zfill(14)
+
+def formatar_cnpjs(digitos: pd.Series) -> pd.Series:
+    """00.000.000/0000-00 a partir da saída de digitos_cnpj (NA continua NA)."""
+    s = digitos.str
+    return s.slice(0, 2) + "." + s.slice(2, 5) + "." + s.slice(5, 8) + "/" + s.slice(8, 12) + "-" + s.slice(12, 14)
+
+def matriz_digitos_cnpj(digitos: pd.Series) -> np.ndarray:
+    """Matriz n x 14 (uint8) dos dígitos; linhas sem CNPJ ficam com 255 (nunca passam no DV)."""
+    matriz = np.full((len(digitos), 14), 255, dtype=np.uint8)
+    presentes = digitos.notna().to_numpy()
+    if presentes.any():
+        texto = "".join(digitos[presentes].tolist()).encode("ascii", "replace")
+        matriz[presentes] = np.frombuffer(texto, dtype=np.uint8).reshape(-1, 14) - ord("0")
+    return matriz
+
+def cnpj_dv_valido(digitos: pd.Series) -> np.ndarray:
+    """Dígitos verificadores (módulo 11) conferem e não são 14 dígitos iguais. Entrada: digitos_cnpj."""
+    m = matriz_digitos_cnpj(digitos).astype(np.int64)
+    dv1 = m[:, :12] @ PESOS_DV1_CNPJ % 11
+    dv1 = np.where(dv1 < 2, 0, 11 - dv1)
+    dv2 = m[:, :13] @ PESOS_DV2_CNPJ % 11
+    dv2 = np.where(dv2 < 2, 0, 11 - dv2)
+    return (m[:, 12] == dv1) & (m[:, 13] == dv2) & (m != m[:, :1]).any(axis=1) & (m < 10).all(axis=1)
+
+def motivo_cnpj_invalido(serie: pd.Series) -> pd.Series:
+    """Por que o CNPJ de cada linha não serve de chave (NA quando serve)."""
+    bruto = serie.astype(TIPO_TEXTO).str.replace(r"\D", "", regex=True)
+    n = bruto.str.len().fillna(0).to_numpy()
+    valido = cnpj_dv_valido(digitos_cnpj(serie))
+    motivo = np.select(
+        [n == 0, n > 14, valido, n < 14],
+        ["Sem dígitos", "Mais de 14 dígitos", None, "Menos de 14 dígitos (completado com zeros); DV não confere"],
+        default="Dígito verificador não confere")
+    return pd.Series(motivo, index=serie.index, dtype=TIPO_TEXTO)
+
+def remover_duplicatas_por_cnpj(df, coluna_origem, mascara=None):
+    """
+    Uma linha por CNPJ válido (a primeira), com 'CNPJ_Normalizado' e 'CNPJ' formatado.
+    CNPJ cujo dígito verificador não confere fica de fora (ver motivo_cnpj_invalido).
+    `mascara` restringe as linhas consideradas; o DF de saída é materializado uma vez só.
+    """
+    posicoes = np.arange(len(df)) if mascara is None else np.flatnonzero(np.asarray(mascara, dtype=bool))
+    normalizado = digitos_cnpj(df[coluna_origem].iloc[posicoes])
+    cnpj = formatar_cnpjs(normalizado)
+    manter = (cnpj.notna().to_numpy() & cnpj_dv_valido(normalizado)) & ~cnpj.duplicated().to_numpy()
+    out = df.take(posicoes[manter])
+    out["CNPJ_Normalizado"] = normalizado.to_numpy(dtype=object)[manter]
+    out["CNPJ"] = cnpj.array[manter]
+    return out
 
 def padronizar_colunas(df):
-    df = df.copy()
+    df = df.copy(deep=False)  # só os rótulos mudam; os dados são compartilhados
     def norm(s):
         s = unicodedata.normalize("NFKD", str(s))
         s = s.encode("ascii", "ignore").decode("utf-8")
@@ -657,11 +718,158 @@ def normaliza_texto(s):
 
 def _norm_header_key(s: str) -> str:
     s = unicodedata.normalize("NFKD", str(s)).encode("ascii", "ignore").decode("utf-8")
-    s = re.sub(r"\s+", " ", s.strip().lower())
-    s = re.sub(r"[^a-z0-9]+", "_", s)
-    s = re.sub(r"_+", "_", s).strip("_")
+    s = _RE["espacos"].sub(" ", s.strip().lower())
+    s = _RE["nao_alfanum_min"].sub("_", s)
+    s = _RE["sublinhados"].sub("_", s).strip("_")
     return s
 
+# === Objetos do processo e tabelas fixas do parsing ===
+# Sob o Streamlit este arquivo é re-executado a cada interação. O que é fixo (meses, regex,
+# variantes de acento, rótulos do protocolo) e o que precisa valer para o processo inteiro
+# (caches e travas) fica num módulo auxiliar em sys.modules e só é montado na primeira execução;
+# nos reruns seguintes, é só uma consulta num dict. Editar o app.py (mtime) descarta tudo.
+import sys
+import types
+from typing import Mapping, NamedTuple
+
+try:
+    _VERSAO_ARQUIVO = Path(__file__).stat().st_mtime_ns
+except OSError:
+    _VERSAO_ARQUIVO = 0
+
+def objeto_do_processo(nome: str, construir):
+    """
+    Devolve o objeto `nome` do processo, chamando `construir()` só quando ele ainda não existe.
+
+    Não usa st.cache_resource porque estes objetos são do motor, não da interface: a CLI, a API,
+    o vigia e os processos do pool rodam sem o runtime do Streamlit. Além disso, sob o Streamlit
+    este arquivo existe em dois módulos — o __main__ dos reruns e o 'app' importado por
+    _modulo_importavel para o pool —, cada um com seus globais; o módulo auxiliar em sys.modules
+    é o único lugar que os dois enxergam, então caches e travas são os mesmos nos dois.
+    O st.cache_resource fica para o que só a interface usa (ícone, caches das etapas e das ações, pool de tarefas).
+    """
+    proc = sys.modules.get("_batimento_processo")
+    if proc is None:
+        proc = sys.modules.setdefault("_batimento_processo", types.ModuleType("_batimento_processo"))
+    objetos = proc.__dict__.setdefault("objetos", {})
+    chave = (nome, _VERSAO_ARQUIVO)
+    obj = objetos.get(chave)
+    if obj is None:
+        for antiga in [k for k in list(objetos) if k[0] == nome and k[1] != _VERSAO_ARQUIVO]:
+            objetos.pop(antiga, None)
+        # duas sessões montando juntas: fica valendo o primeiro (importa para as travas)
+        obj = objetos.setdefault(chave, construir())
+    return obj
+
+class TabelasFixas(NamedTuple):
+    """Tabelas e regex fixos do parsing; imutável e compartilhada por todas as sessões."""
+    meses: Mapping[str, int]                 # nome/abreviação do mês -> número
+    variantes_sem_acento: Mapping[str, str]  # letra ASCII -> letras que o normaliza_texto reduz a ela
+    abreviacoes_nome: tuple                  # (padrão, abreviação) da chave de nome dos fundos
+    re_abreviacoes: tuple                    # os mesmos, compilados
+    rotulos_protocolo: tuple                 # (campo, regex) dos rótulos do Protocolo de Confirmação
+    padroes: Mapping[str, re.Pattern]        # demais regex, por nome
+
+def _variantes_sem_acento() -> dict:
+    """Letra ASCII -> todas as letras latinas que o normaliza_texto reduz a ela (ex.: 'C' -> 'CÇç...')."""
+    variantes = {}
+    for cp in range(0x41, 0x250):
+        ch = chr(cp)
+        base = normaliza_texto(ch)
+        if len(base) == 1 and base.isalpha():
+            variantes.setdefault(base, set()).update({ch, ch.upper(), ch.lower()})
+    return {k: "".join(sorted(v)) for k, v in variantes.items()}
+
+def _montar_tabelas() -> TabelasFixas:
+    meses = {
+        "JAN": 1, "JANEIRO": 1,
+        "FEV": 2, "FEVEREIRO": 2,
+        "MAR": 3, "MARCO": 3, "MARÇO": 3,
+        "ABR": 4, "ABRIL": 4,
+        "MAI": 5, "MAIO": 5,
+        "JUN": 6, "JUNHO": 6,
+        "JUL": 7, "JULHO": 7,
+        "AGO": 8, "AGOSTO": 8,
+        "SET": 9, "SETEMBRO": 9, "SETEM": 9, "SETEMB": 9,
+        "OUT": 10, "OUTUBRO": 10,
+        "NOV": 11, "NOVEMBRO": 11,
+        "DEZ": 12, "DEZEMBRO": 12,
+    }
+    # chave de nome da conciliação: termos longos -> abreviação (aplicados em ordem)
+    abreviacoes = (
+        (r"\bFUNDOS? DE INVESTIMENTO EM COTAS DE FUNDOS? DE INVESTIMENTO\b", "FIC FI"),
+        (r"\bFUNDOS? DE INVESTIMENTO EM COTAS\b", "FIC"),
+        (r"\bFUNDOS? DE INVESTIMENTO\b", "FI"),
+        (r"\bRENDA FIXA\b", "RF"),
+        (r"\bCREDITO PRIVADO\b", "CP"),
+        (r"\bLONGO PRAZO\b", "LP"),
+        (r"\bMULTIMERCADO\b", "MULTI"),
+        (r"\bREFERENCIADO\b", "REF"),
+        (r"\bRESPONSABILIDADE LIMITADA\b", "RL"),
+    )
+    # Rótulos (linha em maiúsculas). O valor é o resto da linha depois do rótulo ("Status: Ativo",
+    # comum no PDF) ou, se vazio, a próxima linha que não for rótulo (células do XLSX).
+    rotulos = (
+        ("inicio", r"PROTOCOLO DE CONFIRMA"),
+        ("participante", r"PARTICIPANTE\b\s*:?\s*(.*)"),
+        ("arquivo", r"NOME DO ARQUIVO\s*:?\s*(.*)"),
+        ("competencia", r"COMPET\w*\s*:?\s*(.*)"),
+        ("status", r"STATUS\b\s*:?\s*(.*)"),
+        ("data_acao", r"DATA A[ÇC][ÃA]O\b\s*:?\s*(.*)"),
+        ("protocolo", r"(?:N[º°]|NO)\s*(?:DO\s+)?PROTOCOLO\s*:?\s*(.*)"),
+        # rótulos sem campo: só encerram buscas e não podem virar valor de outro rótulo
+        ("outro", r"(?:TIPO DO PARTICIPANTE|INFORME|OPERA|DOCUMENTO:|USU[AÁ]RIO|N[º°] DO RECEBIMENTO)"),
+    )
+    padroes = {
+        # texto livre de competência (_normalize_competencia_to_mm_yyyy)
+        "competencia_data": r"(\d{2})/(\d{2})/(\d{4})",
+        "competencia_mm_aaaa": r"\b(\d{1,2})/(\d{4})\b",
+        "competencia_mes_ano": r"\b([A-ZÇÃÉÀ-ÿ]{3,10})[^\dA-Z]*(\d{2}|\d{4})\b",
+        "competencia_aaaa_mm": r"\b(20\d{2})[\/\-](\d{1,2})\b",
+        # valores inteiros de competência/data (fullmatch)
+        "d_m_aaaa": r"(\d{1,2})/(\d{1,2})/(20\d{2})",
+        "dd_mm_aaaa": r"(\d{2})/(\d{2})/(20\d{2})",
+        "m_aaaa": r"(\d{1,2})/(20\d{2})",
+        "mm_aaaa": r"(\d{2})/(20\d{2})",
+        "aaaa_m": r"(20\d{2})-(\d{1,2})",
+        "data_alvo": r"\s*(\d{1,2})/(\d{1,2})/(20\d{2})\s*",
+        "mes_alvo": r"\s*(\d{1,2})/(20\d{2})\s*",
+        # texto do PDF/XLSX do balancete (_parse_competencia / _parse_protocolo)
+        "texto_mm_aaaa": r"\b(\d{1,2})[/\-](\d{4})\b",
+        "texto_aaaa_mm": r"\b(\d{4})[/\-](\d{1,2})\b",
+        "texto_mes_ano": r"\b([A-ZÇÃÉ]+)[\s/.\-]*(\d{4})\b",
+        "protocolo_rotulado": r"(?:PROTOCOLO|NUMERO\s*DE\s*PROTOCOLO|GFI)\D*(\d{6,})",
+        "numero_longo": r"\b(\d{6,})\b",
+        # Protocolo de Confirmação (CDA / Balancete)
+        "cnpj_mascara": r"(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})",
+        "mmaaaa6": r"(\d{6})(?!\d)",  # ex: 082025
+        "comp_mm_aaaa": r"\b(\d{2})/(20\d{2})\b",
+        "comp_data": r"\b(\d{2})/(\d{2})/(20\d{2})\b",
+        "comp_iso": r"\b(20\d{2})-(\d{2})-(\d{2})\b",
+        "iso_aaaa_mm": r"(20\d{2})[/\-](\d{2})",
+        "br_mm_aaaa": r"(\d{2})[/\-](20\d{2})",
+        # textos e cabeçalhos
+        "espacos": r"\s+",
+        "nao_digito": r"\D",
+        "nao_alfanum": r"[^A-Z0-9]+",
+        "nao_alfanum_min": r"[^a-z0-9]+",
+        "sublinhados": r"_+",
+        "data_no_nome": r"(20\d{2})-?(\d{2})-?(\d{2})",
+    }
+    sem_caixa = {"competencia_mes_ano", "protocolo_rotulado"}
+    return TabelasFixas(
+        meses=types.MappingProxyType(meses),
+        variantes_sem_acento=types.MappingProxyType(_variantes_sem_acento()),
+        abreviacoes_nome=abreviacoes,
+        re_abreviacoes=tuple((re.compile(p), s) for p, s in abreviacoes),
+        rotulos_protocolo=tuple((campo, re.compile(p)) for campo, p in rotulos),
+        padroes=types.MappingProxyType(
+            {nome: re.compile(p, re.I if nome in sem_caixa else 0) for nome, p in padroes.items()}),
+    )
+
+TABELAS = objeto_do_processo("tabelas", _montar_tabelas)
+_RE = TABELAS.padroes
+
 def _encontrar_coluna_status(df: pd.DataFrame):
     """
     Localiza a coluna que contém a situação/status no DataFrame.
@@ -698,74 +906,404 @@ def _encontrar_coluna_status(df: pd.DataFrame):
 
 
 
-VALORES_ATIVOS = {
-    normaliza_texto("Em Funcionamento Normal"),
-    normaliza_texto("Em Funcionamento"),
-    normaliza_texto("Ativo"),
-    normaliza_texto("Ativa"),
-    normaliza_texto("Em Atividade"),
-    normaliza_texto("A"),
+# === Tipos compactos para colunas de texto ===
+# String Arrow quando o pyarrow estiver disponível (senão, string nativa do pandas)
+try:
+    import pyarrow  # noqa: F401
+    TEM_PYARROW = True
+    TIPO_TEXTO = "string[pyarrow]"
+except Exception:
+    TEM_PYARROW = False
+    TIPO_TEXTO = "string"
+
+# Colunas com poucos valores distintos repetidos em milhares de linhas -> category
+COLUNAS_CATEGORICAS = {
+    "Situacao", "Tipo_Fundo", "Administrador", "SIT", "Origem",
+    "CDA_Competencia", "CDA_Status", "Balancete_Competencia", "Balancete_Status",
+    "Competência atual", "Competência esperada",
 }
 
-def filtrar_status_ativos(df: pd.DataFrame) -> pd.DataFrame:
+def compactar_dtypes(df: pd.DataFrame,
+                     colunas_categoricas=COLUNAS_CATEGORICAS,
+                     limiar_cardinalidade: float = 0.05,
+                     min_linhas: int = 1000) -> pd.DataFrame:
+    """
+    Converte as colunas de texto (object) para string Arrow e, quando a cardinalidade é baixa,
+    para category. As colunas de COLUNAS_CATEGORICAS viram category sempre; as demais só
+    quando o DF tem pelo menos `min_linhas` e os distintos não passam de `limiar_cardinalidade`.
+    """
+    if df is None or df.empty:
+        return df
+    conv = {}
+    for c in df.columns:
+        s = df[c]
+        if not (s.dtype == object or isinstance(s.dtype, pd.StringDtype)):
+            continue
+        if c in colunas_categoricas or (
+            len(s) >= min_linhas and s.nunique(dropna=True) <= limiar_cardinalidade * len(s)
+        ):
+            conv[c] = "category"
+        elif s.dtype == object:
+            conv[c] = TIPO_TEXTO
+    return df.astype(conv) if conv else df
+
+def _preencher_vazios(serie: pd.Series, valor: str) -> pd.Series:
+    """fillna que também funciona em colunas category (inclui o valor nas categorias)."""
+    if isinstance(serie.dtype, pd.CategoricalDtype) and valor not in serie.cat.categories:
+        serie = serie.cat.add_categories([valor])
+    return serie.fillna(valor)
+
+# === Regras de filtro (arquivo externo com recarga automática) ===
+import json
+import os
+import hashlib
+import warnings
+
+# Caminho do arquivo de regras (pode ser trocado pela variável de ambiente BATIMENTO_REGRAS)
+ARQUIVO_REGRAS = Path(os.environ.get("BATIMENTO_REGRAS", Path(__file__).with_name("regras_batimento.json")))
+
+# Usadas quando o arquivo não existe; o regras_batimento.json do repositório tem os mesmos valores
+REGRAS_PADRAO = {
+    "cadfi": {
+        "administradores": ["BB GESTAO DE RECURSOS DTVM S.A"],
+        "situacoes": ["Em Funcionamento Normal"],
+        "tipos_fundo": ["FI"],
+        # Filtro POSITIVO: qualquer um dos termos (sem diferenciar caixa/acentos)
+        "termos_incluir": ["FIC", "COTAS", "FIC DE FI", "FIF FIF", "FI DE FIC", "FC"],
+        # Filtro de EXCLUSÃO: nomes específicos para remover
+        "nomes_excluir": [
+            "BB TOP DI RENDA FIXA REFERENCIADO DI LONGO PRAZO FIC FIF RESPONSABILIDADE LIMITADA",
+            "BB PRATA FUNDO DE INVESTIMENTO EM COTAS DE FUNDOS DE INVESTIMENTO FINANCEIRO MULTIMERCADO",
+            "BB DIVERSIFICAÇÃO FUNDO MÚTUO DE PRIVATIZAÇÃO - FGTS CARTEIRA LIVRE RESPONSABILIDADE LIMITADA",
+            "BB ASSET RENDA FIXA SIMPLES FUNDO DE INVESTIMENTO EM COTAS DE FUNDOS DE INVESTIMENTO FINANCEIRO RESPONSABILIDADE LIMITADA",
+        ],
+    },
+    "controle": {
+        "nomes_excluir": ["BB CIN", "BB BNC AÇÕES NOSSA CAIXA NOSSO CLUBE DE INVESTIMENTO"],
+        "situacoes_excluir": ["I", "P", "T"],
+    },
+    "valores_ativos": ["Em Funcionamento Normal", "Em Funcionamento", "Ativo", "Ativa", "Em Atividade", "A"],
+}
+
+def _montar_regras(bruto: dict) -> dict:
+    """Valida o conteúdo do arquivo e devolve as regras prontas (tuplas, valores já normalizados)."""
+    if not isinstance(bruto, dict):
+        raise ValueError("o arquivo deve conter um objeto JSON ({...}) no nível mais alto")
+    for secao in ("cadfi", "controle"):
+        if not isinstance(bruto.get(secao) or {}, dict):
+            raise ValueError(f"a seção '{secao}' deve ser um objeto JSON ({{\"regra\": [...]}})")
+    cadfi = {**REGRAS_PADRAO["cadfi"], **(bruto.get("cadfi") or {})}
+    controle = {**REGRAS_PADRAO["controle"], **(bruto.get("controle") or {})}
+    ativos = bruto.get("valores_ativos", REGRAS_PADRAO["valores_ativos"])
+    for nome, valor in [*cadfi.items(), *controle.items(), ("valores_ativos", ativos)]:
+        if not isinstance(valor, list) or not all(isinstance(v, str) for v in valor):
+            raise ValueError(f"Regra '{nome}' deve ser uma lista de textos.")
+
+    regras = {
+        "cadfi": {k: tuple(v) for k, v in cadfi.items()},
+        "controle": {k: tuple(v) for k, v in controle.items()},
+        "valores_ativos": frozenset(normaliza_texto(v) for v in ativos),
+        "situacoes_excluir_norm": frozenset(normaliza_texto(v)[:1] for v in controle["situacoes_excluir"]),
+    }
+    canonico = json.dumps({"cadfi": cadfi, "controle": controle, "valores_ativos": ativos},
+                          sort_keys=True, ensure_ascii=False)
+    regras["versao"] = hashlib.sha1(canonico.encode("utf-8")).hexdigest()[:12]
+    # já compila os matchers de nome (ficam no cache de compilar_regras_nome)
+    compilar_regras_nome(regras["cadfi"]["termos_incluir"], regras["cadfi"]["nomes_excluir"])
+    compilar_regras_nome((), regras["controle"]["nomes_excluir"])
+    return regras
+
+_CACHE_REGRAS = objeto_do_processo("cache_regras", dict)  # caminho -> (assinatura, regras)
+_AVISOS_REGRAS = objeto_do_processo("avisos_regras", dict)  # caminho -> aviso da última recarga
+
+def carregar_regras(caminho=None) -> dict:
+    """
+    Devolve as regras do arquivo `caminho` (padrão: ARQUIVO_REGRAS). O arquivo só é relido quando
+    muda (mtime/tamanho), então pode ser chamado a cada rerun. Se a nova versão estiver inválida,
+    mantém a última que funcionou e guarda o motivo (ver aviso_regras).
+    """
+    caminho = Path(caminho or ARQUIVO_REGRAS)
+    try:
+        st_arq = caminho.stat()
+        assinatura = (st_arq.st_mtime_ns, st_arq.st_size)
+    except OSError:
+        assinatura = None
+
+    anterior = _CACHE_REGRAS.get(caminho)
+    if anterior and anterior[0] == assinatura:
+        return anterior[1]
+
+    try:
+        bruto = json.loads(caminho.read_text(encoding="utf-8")) if assinatura else {}
+        regras = _montar_regras(bruto)
+    except (ValueError, OSError) as e:
+        if anterior:
+            _AVISOS_REGRAS[caminho] = f"Arquivo de regras inválido ({caminho}): {e}. Mantendo a versão anterior."
+            return anterior[1]
+        raise ValueError(f"Arquivo de regras inválido ({caminho}): {e}") from e
+
+    regras["arquivo"] = str(caminho) if assinatura else None
+    _CACHE_REGRAS[caminho] = (assinatura, regras)
+    _AVISOS_REGRAS.pop(caminho, None)
+    return regras
+
+def aviso_regras(caminho=None) -> Optional[str]:
+    """Motivo pelo qual a última recarga de `caminho` manteve a versão anterior (None se carregou)."""
+    return _AVISOS_REGRAS.get(Path(caminho or ARQUIVO_REGRAS))
+
+def filtrar_status_ativos(df: pd.DataFrame, regras: Optional[dict] = None) -> pd.DataFrame:
     if df is None or df.empty:
         return df
     col = _encontrar_coluna_status(df)
     if not col:
         return df
-    out = df.copy()
-    out["_STATUS_NORM_"] = out[col].map(normaliza_texto)
-    out = out[out["_STATUS_NORM_"].isin(VALORES_ATIVOS)].drop(columns=["_STATUS_NORM_"])
-    return out
+    regras = regras or carregar_regras()
+    return df[df[col].map(normaliza_texto).isin(regras["valores_ativos"])]
 
 def carregar_excel(arquivo):
     df = pd.read_excel(arquivo, engine="openpyxl", dtype=str)
-    return padronizar_colunas(df)
+    return compactar_dtypes(padronizar_colunas(df))
+
+# === Motor de cálculo das junções e validações: pandas (padrão) ou Polars (opcional) ===
+# Com o Polars, comparações por CNPJ, merges e validações rodam em LazyFrames (multi-thread, sem
+# .apply/iterrows). O Polars só calcula quais linhas entram e com quem casam; os valores saem das
+# próprias colunas pandas (iloc/take), então dtypes, ordem e conteúdo ficam idênticos e os
+# relatórios gravados saem iguais byte a byte. Leitura dos arquivos e regras de nome são comuns.
+try:
+    import polars as pl  # requer polars >= 1.20 (maintain_order / nulls_equal nos joins)
+    TEM_POLARS = True
+except Exception:
+    pl = None
+    TEM_POLARS = False
+
+MOTORES = ("pandas", "polars")
+MOTOR_PADRAO = os.environ.get("BATIMENTO_MOTOR", "pandas")
+
+def motores_disponiveis() -> list:
+    return [m for m in MOTORES if m != "polars" or TEM_POLARS]
+
+def conferir_motor(motor: str) -> str:
+    if motor not in MOTORES:
+        raise ValueError(f"Motor '{motor}' desconhecido. Opções: {', '.join(MOTORES)}.")
+    if motor == "polars" and not TEM_POLARS:
+        raise ValueError("Motor 'polars' indisponível: instale o pacote polars.")
+    return motor
+
+def _eh_texto(serie: pd.Series) -> bool:
+    return (serie.dtype == object or isinstance(serie.dtype, (pd.StringDtype, pd.CategoricalDtype)))
+
+def _pl_texto(serie: pd.Series):
+    """Series pandas (texto/category) -> Series Polars String."""
+    return pl.from_pandas(serie.reset_index(drop=True)).cast(pl.String)
+
+def _contido_em(chaves: pd.Series, outras: pd.Series, motor: str = "pandas") -> pd.Series:
+    """Mesmo que `chaves.isin(outras)`."""
+    if motor != "polars" or not (_eh_texto(chaves) and _eh_texto(outras)):
+        return chaves.isin(outras)
+    esq = pl.LazyFrame({"k": _pl_texto(chaves)})
+    dir_ = pl.LazyFrame({"k": _pl_texto(outras)}).unique().with_columns(_ok=pl.lit(True))
+    mascara = (esq.join(dir_, on="k", how="left", nulls_equal=True, maintain_order="left")
+               .select(pl.col("_ok").fill_null(False)).collect().to_series().to_numpy())
+    return pd.Series(mascara, index=chaves.index)
+
+def _merge_esquerda(esq: pd.DataFrame, dir_: pd.DataFrame, chave: str, motor: str = "pandas") -> pd.DataFrame:
+    """Mesmo que `esq.merge(dir_, on=chave, how="left")`."""
+    outras = [c for c in dir_.columns if c != chave]
+    if (motor != "polars" or set(outras) & set(esq.columns) or esq[chave].dtype != dir_[chave].dtype
+            or not all(_eh_texto(dir_[c]) for c in [chave, *outras])):
+        return esq.merge(dir_, on=chave, how="left")
+    pares = (
+        pl.LazyFrame({"k": _pl_texto(esq[chave])}).with_row_index("_e")
+        .join(pl.LazyFrame({"k": _pl_texto(dir_[chave])}).with_row_index("_d"),
+              on="k", how="left", nulls_equal=True, maintain_order="left_right")
+        .select("_e", pl.col("_d").cast(pl.Int64).fill_null(-1))
+        .collect()
+    )
+    out = esq.iloc[pares["_e"].to_numpy()].reset_index(drop=True)
+    pos_dir = pares["_d"].to_numpy()
+    for c in outras:
+        out[c] = dir_[c].array.take(pos_dir, allow_fill=True)
+    return out
 
-import re
+def _cnpj_formatado(serie: pd.Series, motor: str = "pandas") -> pd.Series:
+    """formatar_cnpj(normaliza_cnpj(x)) de cada valor (None onde não houver CNPJ), como TIPO_TEXTO."""
+    if motor != "polars" or not _eh_texto(serie):
+        return formatar_cnpjs(digitos_cnpj(serie))
+    d = pl.col("v").str.replace_all(r"\D", "")
+    d = pl.when(d.str.len_chars().is_between(1, 14)).then(d.str.zfill(14))
+    fmt = pl.concat_str([d.str.slice(0, 2), pl.lit("."), d.str.slice(2, 3), pl.lit("."), d.str.slice(5, 3),
+                         pl.lit("/"), d.str.slice(8, 4), pl.lit("-"), d.str.slice(12, 2)])
+    res = pl.LazyFrame({"v": _pl_texto(serie)}).select(fmt.alias("v")).collect().to_series()
+    return pd.Series(res.to_pandas(use_pyarrow_extension_array=True).array, index=serie.index).astype(TIPO_TEXTO)
+
+def _pl_mm_aaaa(t):
+    """_extrair_mm_aaaa como expressão Polars (sobre o texto já sem espaços)."""
+    dma = t.str.extract_groups(r"^(\d{2})/(\d{2})/(20\d{2})$")
+    iso = t.str.extract_groups(r"^(20\d{2})-(\d{1,2})$")
+    mes_iso = iso.struct.field("2").cast(pl.Int32, strict=False)
+    return (
+        pl.when(dma.struct.field("1").is_not_null())
+        .then(pl.concat_str([dma.struct.field("2"), pl.lit("/"), dma.struct.field("3")]))
+        .when(t.str.contains(r"^\d{2}/20\d{2}$")).then(t)
+        .when(mes_iso.is_between(1, 12))
+        .then(pl.concat_str([mes_iso.cast(pl.String).str.zfill(2), pl.lit("/"), iso.struct.field("1")]))
+    )
+
+def _inconsistencias_polars(df: pd.DataFrame, modo: str, alvo: str, esperada: str,
+                            contar_nao_possui: bool) -> Optional[pd.DataFrame]:
+    """
+    validar_por_mes_ano (modo 'mes_ano', alvo MM/AAAA) ou validar_por_data_exata (modo 'data',
+    alvo DD/MM/AAAA) no Polars. None quando há vazios ou colunas não-texto (ficam no pandas).
+    """
+    col_nome = next((c for c in ("Nome do fundo", "Denominacao_Social", "Denominacao Social", "Denominacao")
+                     if c in df.columns), None)
+    origens = [(c, o) for c, o in (("CDA_Competencia", "CDA"), ("Balancete_Competencia", "Balancete"))
+               if c in df.columns]
+    usadas = ["CNPJ", *([col_nome] if col_nome else []), *(c for c, _ in origens)]
+    if "CNPJ" not in df.columns or any(not _eh_texto(df[c]) or df[c].isna().any() for c in usadas):
+        return None
+
+    base = {"CNPJ": _pl_texto(df["CNPJ"]),
+            "nome": _pl_texto(df[col_nome]) if col_nome else pl.Series([None] * len(df), dtype=pl.String)}
+    t = pl.col("atual").str.strip_chars()
+    if modo == "mes_ano":
+        divergente = _pl_mm_aaaa(t).ne_missing(pl.lit(alvo))
+    else:
+        coagida = (pl.when(t.str.contains(r"^\d{2}/\d{2}/20\d{2}$")).then(t)
+                   .when(_pl_mm_aaaa(t).is_not_null()).then(pl.concat_str([pl.lit("01/"), _pl_mm_aaaa(t)]))
+                   .otherwise(t))
+        divergente = coagida != pl.lit(alvo)
+    filtro = pl.when(t.str.to_uppercase() == "NÃO POSSUI").then(pl.lit(contar_nao_possui)).otherwise(divergente)
+
+    partes = [
+        pl.LazyFrame({**base, "atual": _pl_texto(df[col])}).filter(filtro).select(
+            pl.col("CNPJ"), pl.col("nome").alias("Nome do fundo"), pl.lit(origem).alias("Origem"),
+            pl.col("atual").alias("Competência atual"), pl.lit(esperada).alias("Competência esperada"))
+        for col, origem in origens
+    ]
+    res = pl.concat(partes).collect() if partes else None
+    if res is None or res.height == 0:
+        return compactar_dtypes(pd.DataFrame([]))
+    return compactar_dtypes(res.to_pandas())
+
+from functools import lru_cache
+
+_VARIANTES_SEM_ACENTO = TABELAS.variantes_sem_acento
 
-def filtrar_cadfi(df):
+def _regex_termo_sem_acento(termo: str) -> str:
+    """Regex de um termo que casa o texto original com qualquer caixa/acento (equivale a normalizar antes)."""
+    partes = []
+    for ch in normaliza_texto(termo):
+        var = _VARIANTES_SEM_ACENTO.get(ch)
+        partes.append(f"[{re.escape(var)}]" if var else re.escape(ch))
+    return "".join(partes)
+
+@lru_cache(maxsize=32)
+def compilar_regras_nome(incluir: Tuple[str, ...] = (), excluir: Tuple[str, ...] = ()):
+    """
+    Compila todos os termos de inclusão/exclusão em UM regex. Caixa e acento são absorvidos no
+    próprio padrão (variantes como 'FC'/'fc' viram um termo só), então os nomes não precisam ser
+    normalizados linha a linha. A exclusão tem prioridade: o padrão procura primeiro um nome
+    excluído em qualquer posição e, se não houver, um termo de inclusão.
+    O padrão só usa sintaxe comum ao `re` e ao RE2 (pyarrow).
+    Devolve (padrão, regex compilado, mapa termo normalizado -> termo original).
+    """
+    origem = {}
+    for termo in tuple(excluir) + tuple(incluir):
+        if normaliza_texto(termo):
+            origem.setdefault(normaliza_texto(termo), termo)
+
+    def alternancia(termos):
+        norm = sorted({normaliza_texto(t) for t in termos if normaliza_texto(t)}, key=len, reverse=True)
+        return "|".join(_regex_termo_sem_acento(t) for t in norm)
+
+    ramos = []
+    if excluir:
+        ramos.append(f".*?(?P<excluir>{alternancia(excluir)})")
+    if incluir:
+        ramos.append(f".*?(?P<incluir>{alternancia(incluir)})")
+    padrao = "(?s)^(?:" + "|".join(ramos) + ")" if ramos else "(?s)^$.^"
+    return padrao, re.compile(padrao), origem
+
+def _casar_regras(unicos, padrao: str, regex) -> Tuple[pd.Series, pd.Series]:
+    """Roda o regex uma vez por nome distinto; devolve os trechos casados (exclusão, inclusão)."""
+    if TEM_PYARROW:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        achado = pc.extract_regex(pa.array(pd.array(unicos, dtype="string[pyarrow]")), padrao)
+
+        def grupo(nome):
+            if achado.type.get_field_index(nome) < 0:
+                return pd.Series([None] * len(unicos), dtype=TIPO_TEXTO)
+            campo = pc.if_else(achado.is_valid(), achado.field(nome), None)
+            campo = pc.if_else(pc.equal(campo, ""), None, campo)   # ramo que não casou vem como ""
+            return pd.Series(pd.arrays.ArrowStringArray(campo))
+
+        return grupo("excluir"), grupo("incluir")
+
+    exc, inc = [], []
+    for nome in unicos:
+        m = regex.search(str(nome))
+        d = m.groupdict() if m else {}
+        exc.append(d.get("excluir"))
+        inc.append(d.get("incluir"))
+    return pd.Series(exc, dtype=TIPO_TEXTO), pd.Series(inc, dtype=TIPO_TEXTO)
+
+def avaliar_regras_nome(nomes: pd.Series, incluir=(), excluir=()) -> pd.DataFrame:
+    """
+    Avalia as regras de nome em uma passada sobre os nomes distintos e devolve, alinhado ao
+    índice de `nomes`: 'Regra_Excluir' / 'Regra_Incluir' (termo que decidiu, ou NA) e 'Aceito'
+    (casou alguma inclusão — ou não há inclusões — e nenhuma exclusão).
+    """
+    padrao, regex, origem = compilar_regras_nome(tuple(incluir), tuple(excluir))
+    codigos, unicos = pd.factorize(nomes, use_na_sentinel=True)
+    exc, inc = _casar_regras(unicos, padrao, regex)
+
+    def para_termo(trechos: pd.Series):
+        # poucos trechos distintos ('FIC', 'fic', 'Cotas'...): normaliza só esses.
+        # O None no fim atende os códigos -1 (trecho ausente / nome NA).
+        cod_t, uni_t = pd.factorize(trechos, use_na_sentinel=True)
+        termos = pd.array([origem.get(normaliza_texto(t)) for t in uni_t] + [None], dtype=TIPO_TEXTO)
+        return termos.take(np.append(cod_t, -1)[codigos])
+
+    out = pd.DataFrame({
+        "Regra_Excluir": para_termo(exc),
+        "Regra_Incluir": para_termo(inc),
+    }, index=nomes.index)
+    tem_inclusao = out["Regra_Incluir"].notna() if incluir else True
+    out["Aceito"] = (out["Regra_Excluir"].isna() & tem_inclusao).astype(bool)
+    return out
+
+def filtrar_cadfi(df, regras: Optional[dict] = None):
+    return remover_duplicatas_por_cnpj(df, "CNPJ_Fundo", mascara_cadfi(df, regras))
+
+def mascara_cadfi(df, regras: Optional[dict] = None) -> pd.Series:
+    """True nas linhas do CadFi que passam nas regras (administrador, situação, tipo e nome)."""
+    filtro, nomes = _avaliar_regras_cadfi(df, regras)
+    return filtro & nomes["Aceito"].reindex(df.index, fill_value=False)
+
+def _avaliar_regras_cadfi(df, regras: Optional[dict] = None) -> Tuple[pd.Series, pd.DataFrame]:
+    """
+    (filtro de administrador/situação/tipo, avaliar_regras_nome das linhas que passaram nele).
+    As regras de nome só rodam nessas linhas (os filtros de igualdade são bem mais baratos).
+    """
     required = ["Administrador", "Situacao", "Tipo_Fundo", "Denominacao_Social", "CNPJ_Fundo"]
     if not all(col in df.columns for col in required):
         faltantes = set(required) - set(df.columns)
         raise ValueError(f"Colunas ausentes no CadFi: {faltantes}")
 
-    # --- Filtro POSITIVO: qualquer um dos termos (case-insensitive) ---
-    termos_incluir = [
-        "FIC",             # termo genérico
-        "cotas",
-        "FIC de FI",
-        "FIF FIF",
-        "fic de fi",
-        "fi de fic",
-        "FC",              # se realmente quiser considerar 'FC' como indicativo
-        "fc",
-    ]
-    # Cria um regex do tipo (FIC|cotas|FIC de FI|...)
-    padrao_incluir = "(" + "|".join(map(re.escape, termos_incluir)) + ")"
-
-    # --- Filtro de EXCLUSÃO: nomes específicos para remover ---
-    nomes_excluir = [
-        "BB TOP DI RENDA FIXA REFERENCIADO DI LONGO PRAZO FIC FIF RESPONSABILIDADE LIMITADA",
-        "BB PRATA FUNDO DE INVESTIMENTO EM COTAS DE FUNDOS DE INVESTIMENTO FINANCEIRO MULTIMERCADO",
-        "BB DIVERSIFICAÇÃO FUNDO MÚTUO DE PRIVATIZAÇÃO - FGTS CARTEIRA LIVRE RESPONSABILIDADE LIMITADA",
-        "BB ASSET RENDA FIXA SIMPLES FUNDO DE INVESTIMENTO EM COTAS DE FUNDOS DE INVESTIMENTO FINANCEIRO RESPONSABILIDADE LIMITADA",
-    ]
-    padrao_excluir = "(" + "|".join(map(re.escape, nomes_excluir)) + ")"
-
+    r = (regras or carregar_regras())["cadfi"]
     filtro = (
-        (df["Administrador"].fillna("") == "BB GESTAO DE RECURSOS DTVM S.A")
-        & (df["Situacao"] == "Em Funcionamento Normal")
-        & (df["Tipo_Fundo"] == "FI")
-        & (df["Denominacao_Social"].str.contains(padrao_incluir, case=False, na=False, regex=True))
-        & (~df["Denominacao_Social"].str.contains(padrao_excluir, case=False, na=False, regex=True))
+        df["Administrador"].isin(r["administradores"])
+        & df["Situacao"].isin(r["situacoes"])
+        & df["Tipo_Fundo"].isin(r["tipos_fundo"])
     )
+    nomes = avaliar_regras_nome(df.loc[filtro, "Denominacao_Social"], r["termos_incluir"], r["nomes_excluir"])
+    return filtro, nomes
 
-    df_filtrado = df.loc[filtro].copy()
-    return remover_duplicatas_por_cnpj(df_filtrado, "CNPJ_Fundo")
-
-def comparar_controle_fora_cadfi(cadfi_df, controle_df):
-    return controle_df[~controle_df["CNPJ"].isin(set(cadfi_df["CNPJ"]))].copy()
+def comparar_controle_fora_cadfi(cadfi_df, controle_df, motor="pandas"):
+    return controle_df[~_contido_em(controle_df["CNPJ"], cadfi_df["CNPJ"], motor)]
 
 def _encontrar_coluna_nome(df: pd.DataFrame) -> str:
     norm_map = {_norm_header_key(c): c for c in df.columns}
@@ -790,64 +1328,62 @@ def _encontrar_coluna_nome(df: pd.DataFrame) -> str:
         candidatos.sort(reverse=True, key=lambda x: x[0])
         return candidatos[0][1]
     for c in df.columns:
-        if c != "CNPJ" and df[c].dtype == object:
+        if c != "CNPJ" and (df[c].dtype == object or isinstance(df[c].dtype, pd.StringDtype)):
             return c
     return None
 
-def relatorio_controle_fora_cadfi(df_controle: pd.DataFrame) -> pd.DataFrame:
-    if df_controle is None or df_controle.empty:
+def relatorio_controle_fora_cadfi(df_controle: pd.DataFrame, mascara=None) -> pd.DataFrame:
+    if df_controle is None or df_controle.empty or (mascara is not None and not mascara.any()):
         return pd.DataFrame(columns=["CNPJ", "Nome do fundo (Controle)"])
-    out = df_controle.copy()
-    col_nome = _encontrar_coluna_nome(out)
-    if col_nome and col_nome in out.columns:
-        out = out.rename(columns={col_nome: "Nome do fundo (Controle)"})
-        out["Nome do fundo (Controle)"] = (
-            out["Nome do fundo (Controle)"]
-            .astype(str)
-            .str.strip()
-        )
+    linhas = slice(None) if mascara is None else mascara
+    col_nome = _encontrar_coluna_nome(df_controle)
+    if col_nome and col_nome in df_controle.columns:
+        nome = df_controle.loc[linhas, col_nome].astype(str).str.strip()
     else:
-        out["Nome do fundo (Controle)"] = ""
-    return out[["CNPJ", "Nome do fundo (Controle)"]]
-
-EXCLUIR_NOMES_CONTROLE = [
-    "BB CIN",
-    "BB BNC AÇÕES NOSSA CAIXA NOSSO CLUBE DE INVESTIMENTO",
-]
+        nome = ""
+    return pd.DataFrame({"CNPJ": df_controle.loc[linhas, "CNPJ"], "Nome do fundo (Controle)": nome})
 
-def filtrar_controle_por_nome(df: pd.DataFrame,
-                              nomes_excluir=EXCLUIR_NOMES_CONTROLE) -> pd.DataFrame:
-    if df is None or df.empty:
-        return df
-    col_nome = _encontrar_coluna_nome(df)
+def mascara_nome_controle(df: pd.DataFrame, nomes_excluir=None, linhas=None) -> np.ndarray:
+    """
+    True nas linhas cujo nome passa nas regras de exclusão do Controle. Com `linhas` (máscara),
+    as regras só são avaliadas ali (o resto fica False).
+    """
+    linhas = np.ones(len(df), dtype=bool) if linhas is None else np.asarray(linhas, dtype=bool)
+    col_nome = _encontrar_coluna_nome(df) if len(df) else None
     if not col_nome or col_nome not in df.columns:
+        return linhas
+    if nomes_excluir is None:
+        nomes_excluir = carregar_regras()["controle"]["nomes_excluir"]
+    posicoes = np.flatnonzero(linhas)
+    aceito = np.zeros(len(df), dtype=bool)
+    aceito[posicoes] = avaliar_regras_nome(df[col_nome].iloc[posicoes], excluir=tuple(nomes_excluir))["Aceito"].to_numpy()
+    return aceito
+
+def filtrar_controle_por_nome(df: pd.DataFrame, nomes_excluir=None) -> pd.DataFrame:
+    if df is None or df.empty:
         return df
-    nomes_norm = [normaliza_texto(n) for n in nomes_excluir]
-    out = df.copy()
-    out["_NOME_NORM_"] = out[col_nome].map(normaliza_texto)
-    mask_excluir = out["_NOME_NORM_"].apply(lambda s: any(p in s for p in nomes_norm))
-    out = out[~mask_excluir].drop(columns=["_NOME_NORM_"])
-    return out
+    return df[mascara_nome_controle(df, nomes_excluir)]
 
-EXCLUIR_SITUACAO_CONTROLE = ("I", "P", "T")
+def mascara_situacao_controle(df: pd.DataFrame, excluir_codigos=None) -> np.ndarray:
+    """True nas linhas cuja situação (1ª letra normalizada) não está entre as excluídas."""
+    col_status = _encontrar_coluna_status(df) if len(df) else None
+    if not col_status or col_status not in df.columns:
+        return np.ones(len(df), dtype=bool)
+    if excluir_codigos is None:
+        excluir_norm = carregar_regras()["situacoes_excluir_norm"]
+    else:
+        excluir_norm = {normaliza_texto(x)[:1] for x in excluir_codigos}
+    sit = df[col_status].map(lambda x: normaliza_texto(x)[:1] if pd.notna(x) else "")
+    return ~sit.isin(excluir_norm).to_numpy()
 
-def filtrar_controle_por_situacao(df: pd.DataFrame,
-                                  excluir_codigos=EXCLUIR_SITUACAO_CONTROLE) -> pd.DataFrame:
+def filtrar_controle_por_situacao(df: pd.DataFrame, excluir_codigos=None) -> pd.DataFrame:
     if df is None or df.empty:   # ✅ corrigido     755+ 105 + 84
         return df
-
-    col_status = _encontrar_coluna_status(df)
-    if not col_status or col_status not in df.columns:
+    if not _encontrar_coluna_status(df) in df.columns:
         return df
-
-    excluir_norm = {normaliza_texto(x)[:1] for x in excluir_codigos}
-    out = df.copy()
-    out["SIT"] = out[col_status].map(
-        lambda x: normaliza_texto(x)[:1] if pd.notna(x) else ""
-    )
-    mask_excluir = out["SIT"].isin(excluir_norm)
-    out = out[~mask_excluir].drop(columns=["SIT"])
-    return out
+    # como antes: a coluna auxiliar 'SIT' não volta no resultado (nem a original de mesmo nome)
+    colunas = [c for c in df.columns if c != "SIT"]
+    return df.loc[mascara_situacao_controle(df, excluir_codigos), colunas]
 
 
 def carregar_controle(df_controle):
@@ -855,53 +1391,312 @@ def carregar_controle(df_controle):
         raise ValueError("Coluna 'CNPJ' ausente no Controle Espelho.")
     return remover_duplicatas_por_cnpj(df_controle, "CNPJ")
 
-def comparar_cnpjs(cadfi_df, controle_df):
-    return cadfi_df[~cadfi_df["CNPJ"].isin(set(controle_df["CNPJ"]))].copy()
+def comparar_cnpjs(cadfi_df, controle_df, motor="pandas"):
+    return cadfi_df[~_contido_em(cadfi_df["CNPJ"], controle_df["CNPJ"], motor)]
 
-def comparar_fundos_em_comum(cadfi_df, controle_df):
-    return cadfi_df[cadfi_df["CNPJ"].isin(set(controle_df["CNPJ"]))].copy()
+def comparar_fundos_em_comum(cadfi_df, controle_df, motor="pandas"):
+    return cadfi_df[_contido_em(cadfi_df["CNPJ"], controle_df["CNPJ"], motor)]
 
-def relatorio_fora_controle(df):
-    if df is None or df.empty:
+def _relatorio_cnpj_nome(df, mascara=None):
+    """CNPJ + 'Nome do fundo' das linhas da máscara: seleção e projeção numa cópia só."""
+    if df is None or df.empty or (mascara is not None and not mascara.any()):
         return pd.DataFrame(columns=["CNPJ", "Nome do fundo"])
-    df = df.copy()
-    rel = df[["CNPJ", "Denominacao_Social"]].rename(columns={
-        "Denominacao_Social": "Nome do fundo",
-    })
+    rel = df.loc[slice(None) if mascara is None else mascara, ["CNPJ", "Denominacao_Social"]]
+    rel.columns = ["CNPJ", "Nome do fundo"]
     return rel
 
-def relatorio_em_comum(df):
-    if df is None or df.empty:
-        return pd.DataFrame(columns=[
-            "CNPJ", "Nome do fundo"
-        ])
-    df = df.copy()
-    rel = df[[
-        "CNPJ", "Denominacao_Social"
-    ]].rename(columns={
-        "Denominacao_Social": "Nome do fundo",
-    })
-    return rel
+def relatorio_fora_controle(df, mascara=None):
+    return _relatorio_cnpj_nome(df, mascara)
 
-def to_excel_bytes(df, sheet_name="Relatorio"):
-    buffer = io.BytesIO()
-    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+def relatorio_em_comum(df, mascara=None):
+    return _relatorio_cnpj_nome(df, mascara)
+
+# === Conciliação por nome: fundos com CNPJ ausente ou digitado errado ===
+from collections import Counter
+
+# Quem tem o CNPJ digitado errado no Controle aparece duas vezes: "fora do Controle" (lado CadFi)
+# e "Controle fora do CadFi". Aqui os dois restos (mais as linhas descartadas por CNPJ inválido)
+# são casados pelo nome. Para não comparar todos contra todos, cada nome só é comparado com os do
+# outro lado que compartilham um bloco pouco frequente — palavra ou par de palavras vizinhas
+# (índice invertido) — ou cujo CNPJ difere em um dígito, dois vizinhos trocados ou um dígito
+# faltando (chaves com posições mascaradas/removidas). Blocos comuns demais (FI, FIC...) são ignorados.
+# A nota final combina similaridade de trigramas dos nomes com a proximidade dos CNPJs.
+_RE_ABREVIACOES = TABELAS.re_abreviacoes
+
+MAX_CANDIDATOS_CONCILIACAO = 50  # por fundo, pelos nomes (os de CNPJ parecido entram sempre)
+
+def chave_nome_fundo(nome) -> str:
+    """Nome comparável: normaliza_texto, só letras/dígitos e termos longos abreviados."""
+    s = _RE["nao_alfanum"].sub(" ", normaliza_texto(nome if pd.notna(nome) else ""))
+    for regex, abreviacao in _RE_ABREVIACOES:
+        s = regex.sub(abreviacao, s)
+    return " ".join(s.split())
+
+def _blocos_nome(chave: str) -> set:
+    palavras = chave.split()
+    return set(palavras) | {f"{a} {b}" for a, b in zip(palavras, palavras[1:])}
+
+def _trigramas(chave: str) -> frozenset:
+    s = f"  {chave} "
+    return frozenset(s[i:i + 3] for i in range(len(s) - 2))
+
+def _chaves_cnpj(digitos: Optional[str]) -> list:
+    """
+    Chaves que colidem quando dois CNPJs (só dígitos, como vieram) diferem em 1 dígito, em 2
+    vizinhos (troca) ou por 1 dígito faltando (13 dígitos de um lado, 14 do outro).
+    """
+    if not digitos or len(digitos) not in (13, 14):
+        return []
+    if len(digitos) == 13:
+        return ["-" + digitos]
+    return ([digitos[:i] + "?" + digitos[i + 1:] for i in range(14)]
+            + [digitos[:i] + "??" + digitos[i + 2:] for i in range(13)]
+            + ["-" + digitos[:i] + digitos[i + 1:] for i in range(14)])
+
+def _digitos_para_conciliar(valor) -> Optional[str]:
+    d = so_digitos(valor) if pd.notna(valor) else ""
+    return d if len(d) in (13, 14) else None
+
+def _diferenca_cnpj(a: str, b: str) -> str:
+    """Descrição da diferença entre dois CNPJs (só dígitos) que colidiram em _chaves_cnpj."""
+    if len(a) != len(b):
+        return "1 dígito faltando"
+    diferentes = [i for i in range(14) if a[i] != b[i]]
+    if len(diferentes) == 1:
+        return "1 dígito diferente"
+    if len(diferentes) == 2 and a[diferentes[0]] == b[diferentes[1]] and a[diferentes[1]] == b[diferentes[0]]:
+        return "2 dígitos trocados de lugar"
+    return "2 dígitos vizinhos diferentes" if diferentes else ""
+
+def conciliar_por_nome(lado_cadfi: pd.DataFrame, lado_controle: pd.DataFrame, nota_minima: float = 0.5,
+                       max_por_fundo: int = 3) -> pd.DataFrame:
+    """
+    Propõe pares CadFi x Controle. Entradas com colunas 'CNPJ' (texto como veio), 'Nome' e 'Origem';
+    o lado Controle traz também 'COD GFI'. Devolve até `max_por_fundo` candidatos por fundo do
+    CadFi com nota >= `nota_minima`, do melhor para o pior; 'Sugerido' = 'Sim' no pareamento
+    um-para-um escolhido guloso pela nota.
+    """
+    colunas = ["Nota", "CNPJ (CadFi)", "Nome (CadFi)", "Origem (CadFi)", "CNPJ (Controle)", "Nome (Controle)",
+               "COD GFI", "Origem (Controle)", "Similaridade do nome", "CNPJ parecido", "Sugerido"]
+    if lado_cadfi.empty or lado_controle.empty:
+        return pd.DataFrame(columns=colunas)
+
+    chaves_ctl = [chave_nome_fundo(n) for n in lado_controle["Nome"]]
+    trig_ctl = [_trigramas(c) for c in chaves_ctl]
+    dig_ctl = [_digitos_para_conciliar(c) for c in lado_controle["CNPJ"]]
+
+    # índices invertidos do lado Controle: bloco do nome -> linhas; chave de CNPJ -> linhas
+    por_bloco, por_cnpj = {}, {}
+    for j, chave in enumerate(chaves_ctl):
+        for bloco in _blocos_nome(chave):
+            por_bloco.setdefault(bloco, []).append(j)
+        for k in _chaves_cnpj(dig_ctl[j]):
+            por_cnpj.setdefault(k, []).append(j)
+    limite = max(25, min(200, len(chaves_ctl) // 20))
+
+    pares = []
+    for i, (cnpj, nome) in enumerate(zip(lado_cadfi["CNPJ"], lado_cadfi["Nome"])):
+        chave = chave_nome_fundo(nome)
+        # só os que mais compartilham blocos seguem para a nota (custo fixo por fundo)
+        compartilhados = Counter()
+        for bloco in _blocos_nome(chave):
+            linhas = por_bloco.get(bloco, ())
+            if len(linhas) <= limite:
+                compartilhados.update(linhas)
+        candidatos = {j for j, _ in compartilhados.most_common(MAX_CANDIDATOS_CONCILIACAO)}
+        digitos = _digitos_para_conciliar(cnpj)
+        cnpj_parecido = {j for k in _chaves_cnpj(digitos) for j in por_cnpj.get(k, ())}
+
+        trig = _trigramas(chave)
+        notas = []
+        for j in candidatos | cnpj_parecido:
+            comuns = len(trig & trig_ctl[j])
+            similaridade = comuns / (len(trig) + len(trig_ctl[j]) - comuns)
+            # CNPJ quase igual pesa; só pelo nome a nota vai até 0.9
+            nota = 0.6 * similaridade + 0.4 if j in cnpj_parecido else 0.9 * similaridade
+            if nota >= nota_minima:
+                descricao = _diferenca_cnpj(digitos, dig_ctl[j]) if j in cnpj_parecido else ""
+                notas.append((round(nota, 3), round(similaridade, 3), descricao, j))
+        notas.sort(key=lambda x: (-x[0], x[3]))
+        pares += [(i, *n) for n in notas[:max_por_fundo]]
+
+    pares.sort(key=lambda p: (-p[1], p[0], p[4]))
+    usados_cadfi, usados_ctl, sugeridos = set(), set(), []
+    for i, _, _, _, j in pares:
+        livre = i not in usados_cadfi and j not in usados_ctl
+        if livre:
+            usados_cadfi.add(i)
+            usados_ctl.add(j)
+        sugeridos.append("Sim" if livre else "Não")
+
+    pos_cadfi = [p[0] for p in pares]
+    pos_ctl = [p[4] for p in pares]
+    out = pd.DataFrame({
+        "Nota": [p[1] for p in pares],
+        "CNPJ (CadFi)": lado_cadfi["CNPJ"].to_numpy()[pos_cadfi],
+        "Nome (CadFi)": lado_cadfi["Nome"].to_numpy()[pos_cadfi],
+        "Origem (CadFi)": lado_cadfi["Origem"].to_numpy()[pos_cadfi],
+        "CNPJ (Controle)": lado_controle["CNPJ"].to_numpy()[pos_ctl],
+        "Nome (Controle)": lado_controle["Nome"].to_numpy()[pos_ctl],
+        "COD GFI": lado_controle["COD GFI"].to_numpy()[pos_ctl],
+        "Origem (Controle)": lado_controle["Origem"].to_numpy()[pos_ctl],
+        "Similaridade do nome": [p[2] for p in pares],
+        "CNPJ parecido": [p[3] for p in pares],
+        "Sugerido": sugeridos,
+    }, columns=colunas)
+    texto = [c for c in colunas if c not in ("Nota", "Similaridade do nome")]
+    out[texto] = out[texto].astype(TIPO_TEXTO)
+    return out
+
+# Acima desse nº de linhas a planilha é gravada em modo write-only (linha a linha, memória constante)
+LIMIAR_MODO_GRANDE = 200_000
+
+def _escrever_excel_linha_a_linha(df, destino, sheet_name="Relatorio"):
+    """Grava o DF com o openpyxl em modo write-only: cada linha vai direto para o XML da planilha."""
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title=sheet_name)
+    ws.append([str(c) for c in df.columns])
+    for row in df.itertuples(index=False, name=None):
+        ws.append([None if pd.isna(v) else v for v in row])
+    wb.save(destino)
+
+def escrever_excel(df, destino, sheet_name="Relatorio", modo_grande: Optional[bool] = None):
+    """
+    Grava o DF como .xlsx em `destino` (caminho ou arquivo aberto, inclusive não-seekable,
+    como a entrada de um ZIP). `modo_grande=None` escolhe pelo tamanho do DF.
+    """
+    if modo_grande is None:
+        modo_grande = len(df) >= LIMIAR_MODO_GRANDE
+    if modo_grande:
+        _escrever_excel_linha_a_linha(df, destino, sheet_name=sheet_name)
+        return
+    with pd.ExcelWriter(destino, engine="openpyxl") as writer:
         df.to_excel(writer, index=False, sheet_name=sheet_name)
+
+def paginar_relatorio(df: pd.DataFrame, busca: str = "", pagina: int = 1,
+                      tamanho_pagina: int = 50) -> Tuple[pd.DataFrame, int, int]:
+    """
+    Filtra o relatório por CNPJ (só dígitos, aceita trecho) ou COD GFI e devolve apenas a página
+    pedida, junto com o total de linhas filtradas e o nº de páginas.
+    """
+    if df is None:
+        return pd.DataFrame(), 0, 1
+    termo = str(busca or "").strip()
+    if termo:
+        mask = pd.Series(False, index=df.index)
+        digitos = so_digitos(termo)
+        if digitos and "CNPJ" in df.columns:
+            mask |= df["CNPJ"].astype(TIPO_TEXTO).str.replace(r"\D", "", regex=True) \
+                              .str.contains(digitos, regex=False).fillna(False).astype(bool)
+        if "COD GFI" in df.columns:
+            mask |= df["COD GFI"].astype(TIPO_TEXTO).str.strip() \
+                                 .str.contains(termo, case=False, regex=False).fillna(False).astype(bool)
+        df = df[mask]
+    total = len(df)
+    paginas = max(1, -(-total // tamanho_pagina))
+    pagina = min(max(1, int(pagina)), paginas)
+    inicio = (pagina - 1) * tamanho_pagina
+    return df.iloc[inicio:inicio + tamanho_pagina], total, paginas
+
+def to_excel_bytes(df, sheet_name="Relatorio", modo_grande: Optional[bool] = None):
+    buffer = io.BytesIO()
+    escrever_excel(df, buffer, sheet_name=sheet_name, modo_grande=modo_grande)
     buffer.seek(0)
     return buffer
 
+# Formatos de saída: chave -> (extensão, mime). Parquet só com pyarrow instalado.
+FORMATOS_EXPORTACAO = {
+    "xlsx": (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv.gz": (".csv.gz", "application/gzip"),
+}
+if TEM_PYARROW:
+    FORMATOS_EXPORTACAO["parquet"] = (".parquet", "application/vnd.apache.parquet")
+
+def nome_arquivo_relatorio(nome_base: str, formato: str = "xlsx") -> str:
+    return f"{nome_base}{FORMATOS_EXPORTACAO[formato][0]}"
+
+def escrever_relatorio(df, destino, formato: str = "xlsx", sheet_name="Relatorio",
+                       modo_grande: Optional[bool] = None):
+    """Grava o DF em `destino` no formato pedido ('xlsx', 'csv.gz' ou 'parquet')."""
+    if formato == "xlsx":
+        escrever_excel(df, destino, sheet_name=sheet_name, modo_grande=modo_grande)
+    elif formato == "csv.gz":
+        import gzip
+        with gzip.GzipFile(fileobj=destino, mode="wb") if hasattr(destino, "write") \
+                else gzip.open(destino, "wb") as gz, \
+                io.TextIOWrapper(gz, encoding="utf-8", newline="") as txt:
+            df.to_csv(txt, index=False)
+    elif formato == "parquet":
+        df.to_parquet(destino, index=False)
+    else:
+        raise ValueError(f"Formato de relatório não suportado: {formato}")
+
+def relatorio_bytes(df, formato: str = "xlsx", sheet_name="Relatorio"):
+    if formato == "xlsx":
+        return to_excel_bytes(df, sheet_name=sheet_name)
+    buffer = io.BytesIO()
+    escrever_relatorio(df, buffer, formato=formato, sheet_name=sheet_name)
+    buffer.seek(0)
+    return buffer
+
+def ler_relatorio(arquivo) -> pd.DataFrame:
+    """
+    Lê um relatório gerado anteriormente (.xlsx, .csv, .csv.gz ou .parquet), tudo como texto,
+    com colunas padronizadas e dtypes compactos.
+    """
+    nome = str(getattr(arquivo, "name", arquivo)).lower()
+    if nome.endswith(".parquet"):
+        df = pd.read_parquet(arquivo).astype(TIPO_TEXTO)
+    elif nome.endswith(".csv") or nome.endswith(".csv.gz") or nome.endswith(".gz"):
+        df = pd.read_csv(arquivo, dtype=str, compression="gzip" if nome.endswith(".gz") else None)
+    else:
+        df = pd.read_excel(arquivo, dtype=str)
+    return compactar_dtypes(padronizar_colunas(df))
+
+# Extensões aceitas nos uploads de relatórios gerados pelo app
+TIPOS_RELATORIO_ENTRADA = ["xlsx", "csv", "gz"] + (["parquet"] if TEM_PYARROW else [])
+
+def escrever_zip_relatorios(destino, relatorios, modo_grande: Optional[bool] = None, formato: str = "xlsx"):
+    """
+    Grava um ZIP com um arquivo por relatório (`relatorios`: nome do arquivo -> DF), no `formato` pedido.
+    Cada planilha é escrita direto no stream da entrada do ZIP, sem buffer intermediário.
+    """
+    def entrada_zip(nome):
+        # xlsx, parquet e csv.gz já vêm comprimidos: deflate de novo só gasta CPU (como no original, STORED)
+        info = zipfile.ZipInfo(nome, date_time=time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED if nome.lower().endswith(".csv") else zipfile.ZIP_STORED
+        return info
+
+    with zipfile.ZipFile(destino, "w") as zipf:
+        for nome, df in relatorios.items():
+            with zipf.open(entrada_zip(nome), "w", force_zip64=True) as entrada:
+                escrever_relatorio(df, entrada, formato=formato, modo_grande=modo_grande)
+    return destino
+
+def gerar_zip_relatorios(rel_comum, rel_fora, rel_controle_fora, formato: str = "xlsx"):
+    zip_buffer = io.BytesIO()
+    escrever_zip_relatorios(zip_buffer, {
+        nome_arquivo_relatorio("Relatorio_Fundos_Em_Ambos", formato): rel_comum,
+        nome_arquivo_relatorio("Relatorio_Fundos_Somente_no_CadFi", formato): rel_fora,
+        nome_arquivo_relatorio("Relatorio_Fundos_Somente_no_Controle", formato): rel_controle_fora,
+    }, formato=formato)
+    zip_buffer.seek(0)
+    return zip_buffer
+
 # ======================= /CDA =====================================================
 
 def _normaliza_competencia_mm_aaaa(s: str) -> Optional[str]:
     if not s:
         return None
     s = s.strip()
-    m_iso = re.search(r'(20\d{2})[/\-](\d{2})', s)
+    m_iso = _RE["iso_aaaa_mm"].search(s)
     if m_iso:
         ano, mes = int(m_iso.group(1)), int(m_iso.group(2))
         if 1 <= mes <= 12:
             return _format_competencia_yyyy_mm(ano, mes)
-    m_br = re.search(r'(\d{2})[/\-](20\d{2})', s)
+    m_br = _RE["br_mm_aaaa"].search(s)
     if m_br:
         mes, ano = int(m_br.group(1)), int(m_br.group(2))
         if 1 <= mes <= 12:
@@ -909,9 +1704,13 @@ def _normaliza_competencia_mm_aaaa(s: str) -> Optional[str]:
     return None
 
 def remover_segundos_colunas(df: pd.DataFrame, colunas, formato: str = "%Y-%m-%d %H:%M") -> pd.DataFrame:
+    if not any(col in df.columns for col in colunas):
+        return df
     df = df.copy()
     for col in colunas:
         if col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype(TIPO_TEXTO)
             s = pd.to_datetime(df[col], errors="coerce")
             df.loc[s.notna(), col] = s[s.notna()].dt.strftime(formato)
             df.loc[s.isna(), col] = (
@@ -932,21 +1731,21 @@ def _competencia_to_01_mm_aaaa(s: Optional[str]) -> Optional[str]:
         return t
 
     # AAAA-MM -> 01/MM/AAAA
-    m = re.fullmatch(r"(20\d{2})-(\d{1,2})", t)
+    m = _RE["aaaa_m"].fullmatch(t)
     if m:
         ano, mes = int(m.group(1)), int(m.group(2))
         if 1 <= mes <= 12:
             return f"01/{mes:02d}/{ano}"
 
     # MM/AAAA -> 01/MM/AAAA
-    m = re.fullmatch(r"(\d{1,2})/(20\d{2})", t)
+    m = _RE["m_aaaa"].fullmatch(t)
     if m:
         mes, ano = int(m.group(1)), int(m.group(2))
         if 1 <= mes <= 12:
             return f"01/{mes:02d}/{ano}"
 
     # DD/MM/AAAA -> força dia 01
-    m = re.fullmatch(r"(\d{1,2})/(\d{1,2})/(20\d{2})", t)
+    m = _RE["d_m_aaaa"].fullmatch(t)
     if m:
         dd, mm, ano = int(m.group(1)), int(m.group(2)), int(m.group(3))
         if 1 <= mm <= 12:
@@ -956,150 +1755,314 @@ def _competencia_to_01_mm_aaaa(s: Optional[str]) -> Optional[str]:
     return t
 
 
-def parse_protocolos_cda_xlsx(arquivo_xlsx) -> pd.DataFrame:
-    df_raw = pd.read_excel(arquivo_xlsx, sheet_name=0, header=None, dtype=str)
-    lines = []
-    for _, row in df_raw.iterrows():
-        for val in row.values:
-            if pd.isna(val):
-                continue
-            txt = str(val).strip()
-            if txt:
-                lines.append((len(lines), txt))
-
-    n = len(lines)
-    registros = []
-    for i in range(n):
-        _, text = lines[i]
-        low = text.lower()
-
-        # Âncora: "Nº Protocolo"
-        if low.startswith('nº protocolo') or low.startswith('n° protocolo') or low.startswith('no protocolo') \
-           or low.startswith('nº do protocolo') or low.startswith('n° do protocolo'):
-            # Protocolo (na linha logo abaixo)
-            protocolo = None
-            j = i + 1
-            while j < n:
-                _, t2 = lines[j]
-                low2 = t2.lower()
-                if re.match(
-                    r'^(protocolo de confirma|status:|informe:|opera|documento:|compet|usuário|usuario|nº do recebimento|nome do arquivo|participante:|tipo do participante|data ação:|data acao:)',
-                    low2
-                ):
-                    j += 1
-                    continue
-                protocolo = t2.strip()
-                if protocolo.endswith(".0"):
-                    protocolo = protocolo[:-2]
+# ================== Protocolos de Confirmação (motor comum CDA / Balancete) ==================
+# O CDA e o Balancete chegam no mesmo layout da CVM ("Protocolo de Confirmação"): blocos de
+# rótulo/valor, um por fundo. O motor abaixo percorre as linhas uma vez só e emite um
+# RegistroProtocolo por bloco; o que muda de um documento para o outro fica em LAYOUTS_PROTOCOLO.
+from typing import Iterator, NamedTuple
+
+class RegistroProtocolo(NamedTuple):
+    cnpj: str                    # 14 dígitos
+    cnpj_mascara: str            # como veio no documento (00.000.000/0000-00)
+    participante: Optional[str]  # primeira linha após "Participante"
+    protocolo: str
+    competencia: Optional[str]   # já normalizada pelo layout
+    status: str
+    data_acao: Optional[str]     # texto cru; vira datetime na montagem do DataFrame
+
+_RE_CNPJ_MASCARA = _RE["cnpj_mascara"]
+_RE_MMYYYY6 = _RE["mmaaaa6"]  # ex: 082025
+_RE_COMP_MM_AAAA = _RE["comp_mm_aaaa"]
+_RE_COMP_DATA = _RE["comp_data"]
+_RE_COMP_ISO = _RE["comp_iso"]
+
+# Rótulos do protocolo (e como o valor de cada um é lido): ver _montar_tabelas
+_ROTULOS_PROTOCOLO = TABELAS.rotulos_protocolo
+
+def _competencia_balancete(val: str) -> Optional[str]:
+    """Competência do protocolo (MM/AAAA, DD/MM/AAAA, ISO ou o que o pandas entender) -> 'MM/AAAA'."""
+    # 1) MM/AAAA
+    m2 = _RE_COMP_MM_AAAA.search(val)
+    if m2:
+        return f"{m2.group(1)}/{m2.group(2)}"
+    # 2) DD/MM/AAAA ou MM/DD/AAAA
+    m3 = _RE_COMP_DATA.search(val)
+    if m3:
+        a, b, ano = int(m3.group(1)), int(m3.group(2)), int(m3.group(3))
+        if a > 12 and 1 <= b <= 12:
+            return f"{b:02d}/{ano}"   # DD/MM/AAAA
+        return f"{a:02d}/{ano}"       # MM/DD/AAAA ou ambíguo
+    # 3) ISO AAAA-MM-DD (com ou sem hora)
+    m4 = _RE_COMP_ISO.search(val)
+    if m4:
+        return f"{int(m4.group(2)):02d}/{int(m4.group(1))}"
+    # 4) fallback genérico via pandas
+    try:
+        ts = pd.to_datetime(val, dayfirst=True, errors="coerce")
+        if pd.notna(ts):
+            return f"{int(ts.month):02d}/{ts.year}"
+    except Exception:
+        pass
+    return None
+
+# O que difere entre os documentos:
+#   competencia          -> normaliza o texto do campo Competência
+#   competencia_arquivo  -> MMAAAA do "Nome do Arquivo" tem prioridade sobre o campo
+#   descricao            -> texto do progresso
+LAYOUTS_PROTOCOLO = {
+    "cda": {
+        "competencia": _normaliza_competencia_mm_aaaa,   # -> 'AAAA-MM'
+        "competencia_arquivo": False,
+        "descricao": "linhas do protocolo CDA",
+    },
+    "balancete": {
+        "competencia": lambda v: _competencia_balancete(v) or "",  # -> 'MM/AAAA'
+        "competencia_arquivo": True,
+        "descricao": "linhas do protocolo de Balancete",
+    },
+}
+
+def iterar_registros_protocolo(linhas, layout: dict, progresso=None) -> Iterator[RegistroProtocolo]:
+    """
+    Máquina de estados de uma passada (tempo linear) sobre as linhas de um Protocolo de
+    Confirmação. Um bloco começa no cabeçalho ou num novo "Participante" e só vira registro
+    com CNPJ e protocolo; nenhum campo passa de um bloco para o seguinte.
+    """
+    n = len(linhas)
+    bloco = {}
+    pendente = None           # campo esperando o valor na próxima linha que não for rótulo
+    busca_cnpj = busca_arquivo = 0  # quantas linhas ainda olhar para CNPJ / MMAAAA do arquivo
+
+    def fechar():
+        if bloco.get("cnpj") and bloco.get("protocolo"):
+            comp = None
+            if layout["competencia_arquivo"]:
+                comp = bloco.get("competencia_arquivo")
+            if not comp:
+                comp = layout["competencia"](bloco.get("competencia") or "")
+            return RegistroProtocolo(
+                cnpj=bloco["cnpj"], cnpj_mascara=bloco["cnpj_mascara"], participante=bloco.get("participante"),
+                protocolo=bloco["protocolo"], competencia=comp, status=bloco.get("status") or "",
+                data_acao=bloco.get("data_acao"),
+            )
+        return None
+
+    def valor(campo, texto):
+        if campo == "protocolo" and texto.endswith(".0"):
+            texto = texto[:-2]
+        bloco[campo] = texto
+
+    for i, linha in enumerate(linhas):
+        if i % 500 == 0:
+            _avisar_progresso(progresso, i, n, layout["descricao"])
+        up = linha.upper()
+        rotulo = resto = None
+        for nome, padrao in _ROTULOS_PROTOCOLO:
+            m = padrao.match(up)
+            if m:
+                rotulo = nome
+                if not m.groups():
+                    resto = ""
+                elif len(up) == len(linha):  # recorta do original para preservar maiúsculas/minúsculas
+                    resto = linha[m.start(1):].strip()
+                else:
+                    resto = m.group(1).strip()
                 break
-                j += 1
-
-            # Participante -> extrair CNPJ (mesma lógica atual)
-            cnpj_masked, participante = None, None
-            k = i
-            while k >= 0:
-                _, tprev = lines[k]
-                lowp = tprev.lower()
-                if lowp.startswith('participante'):
-                    first_name = None
-                    kk = k + 1
-                    while kk < n:
-                        _, tline = lines[kk]
-                        low2 = tline.lower()
-                        if low2.startswith('tipo do participante') or low2.startswith('data ação') or low2.startswith('data acao') \
-                           or low2.startswith('nº protocolo') or low2.startswith('n° protocolo') or low2.startswith('nº do protocolo') or low2.startswith('n° do protocolo'):
-                            break
-                        if first_name is None and tline:
-                            first_name = tline.strip()
-                        m = re.search(r'(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})', tline)
-                        if m:
-                            cnpj_masked = m.group(1)
-                            break
-                        kk += 1
-                    participante = first_name
-                    break
-                k -= 1
-
-            # Competência (igual ao seu, normalizando)
-            competencia_raw, data_acao_raw = None, None
-
-            k = i
-            while k >= 0:
-                _, tprev = lines[k]
-                lowp = tprev.lower()
-                if lowp.startswith('competência:') or lowp.startswith('competencia:'):
-                    kk = k + 1
-                    while kk < n:
-                        _, tval = lines[kk]
-                        if tval:
-                            competencia_raw = tval.strip()
-                            break
-                        kk += 1
-                    break
-                k -= 1
-
-            k = i
-            while k >= 0:
-                _, tprev = lines[k]
-                lowp = tprev.lower()
-                if lowp.startswith('data ação') or lowp.startswith('data acao'):
-                    kk = k + 1
-                    while kk < n:
-                        _, tval = lines[kk]
-                        if tval:
-                            data_acao_raw = tval.strip()
-                            break
-                        kk += 1
-                    break
-                k -= 1
-
-            # 🔎 Status (NOVO): pegar a linha logo após "Status:"
-            status_txt = None
-            k = i
-            while k >= 0:
-                _, tprev = lines[k]
-                lowp = tprev.lower()
-                if lowp.startswith('status:'):
-                    kk = k + 1
-                    while kk < n:
-                        _, tval = lines[kk]
-                        if tval:
-                            status_txt = tval.strip()
-                            break
-                        kk += 1
-                    break
-                k -= 1
-
-            if cnpj_masked and protocolo:
-                cnpj_num = normaliza_cnpj(cnpj_masked)
-                comp = _normaliza_competencia_mm_aaaa(competencia_raw)
 
-                try:
-                    data_acao = pd.to_datetime(data_acao_raw, dayfirst=True, errors='coerce') if data_acao_raw else pd.NaT
-                except Exception:
-                    data_acao = pd.NaT
-
-                registros.append({
-                    "CNPJ_Masked": cnpj_masked,
-                    "CNPJ_Num": cnpj_num,
-                    "Participante": participante,
-                    "CDA_Protocolo": protocolo,
-                    "CDA_Competencia": comp,
-                    "CDA_Status": status_txt or "",
-                    "Data_Acao": data_acao
-                })
+        if rotulo is None:
+            # linha de valor
+            if busca_cnpj:
+                busca_cnpj -= 1
+                bloco.setdefault("participante", linha)
+                m = _RE_CNPJ_MASCARA.search(linha)
+                if m:
+                    bloco["cnpj_mascara"], bloco["cnpj"] = m.group(1), normaliza_cnpj(m.group(1))
+                    busca_cnpj = 0
+            if busca_arquivo:
+                busca_arquivo -= 1
+                m = _RE_MMYYYY6.search(linha)
+                if m:
+                    bloco["competencia_arquivo"] = f"{m.group(1)[:2]}/{m.group(1)[2:]}"
+                    busca_arquivo = 0
+            if pendente:
+                valor(pendente, linha)
+                pendente = None
+            continue
 
-    df = pd.DataFrame(registros)
-    if df.empty:
-        return df
+        # rótulo: encerra buscas; um valor pendente vazio só sobrevive para o protocolo
+        busca_cnpj = busca_arquivo = 0
+        if pendente != "protocolo":
+            pendente = None
+
+        if rotulo == "inicio" or (rotulo == "participante" and bloco.get("cnpj")):
+            registro = fechar()
+            if registro:
+                yield registro
+            bloco, pendente = {}, None
+
+        if rotulo == "participante":
+            if resto:
+                bloco["participante"] = resto
+                m = _RE_CNPJ_MASCARA.search(resto)
+                if m:
+                    bloco["cnpj_mascara"], bloco["cnpj"] = m.group(1), normaliza_cnpj(m.group(1))
+            if not bloco.get("cnpj"):
+                busca_cnpj = 11   # nome do fundo costuma vir antes do CNPJ
+        elif rotulo == "arquivo":
+            m = _RE_MMYYYY6.search(resto)
+            if m:
+                bloco["competencia_arquivo"] = f"{m.group(1)[:2]}/{m.group(1)[2:]}"
+            else:
+                busca_arquivo = 4
+        elif rotulo in ("competencia", "status", "data_acao", "protocolo"):
+            if resto:
+                valor(rotulo, resto)
+            else:
+                pendente = rotulo
+
+    registro = fechar()
+    if registro:
+        yield registro
+
+# --- Planilhas com várias abas: cada aba é um fluxo de blocos independente. Abas grandes são
+# lidas em paralelo num pool de processos (o parse é Python puro, preso ao GIL em threads).
+LIMIAR_PARALELO_ABAS = 2 * 1024 * 1024  # bytes do arquivo a partir dos quais vale subir processos
+_POOL_ABAS = None
+
+def _conteudo_arquivo(arquivo) -> bytes:
+    if hasattr(arquivo, "getvalue"):
+        return arquivo.getvalue()
+    if hasattr(arquivo, "read"):
+        dados = arquivo.read()
+        arquivo.seek(0)
+        return dados
+    return Path(arquivo).read_bytes()
+
+def _texto_celula(valor) -> str:
+    # mesmo texto que o pd.read_excel(dtype=str) produziria (ex.: 700000.0 -> '700000')
+    if valor is None:
+        return ""
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)
+    return str(valor).strip()
+
+def abas_da_planilha(conteudo: bytes) -> list:
+    import openpyxl
+    wb = openpyxl.load_workbook(io.BytesIO(conteudo), read_only=True)
+    try:
+        return list(wb.sheetnames)
+    finally:
+        wb.close()
+
+def _linhas_da_aba(conteudo: bytes, aba: str) -> list:
+    """Células não-vazias da aba, em ordem de leitura (uma "linha" por célula)."""
+    import openpyxl
+    wb = openpyxl.load_workbook(io.BytesIO(conteudo), read_only=True, data_only=True)
+    try:
+        return [txt for row in wb[aba].iter_rows(values_only=True)
+                for txt in map(_texto_celula, row) if txt]
+    finally:
+        wb.close()
+
+def _registros_da_aba(conteudo: bytes, aba: str, layout: str) -> list:
+    """Unidade de trabalho do pool: registros de protocolo de uma aba."""
+    return list(iterar_registros_protocolo(_linhas_da_aba(conteudo, aba), LAYOUTS_PROTOCOLO[layout]))
+
+def _modulo_importavel():
+    """
+    Este arquivo como módulo importável ('app'). Sob o Streamlit ele roda como __main__, e os
+    processos do pool só acham funções (e o próprio pool, que deve sobreviver aos reruns) num
+    módulo que consigam importar.
+    """
+    import importlib
+    import sys
+    nome = Path(__file__).stem
+    if __name__ == nome:
+        return sys.modules[__name__]
+    pasta = str(Path(__file__).resolve().parent)
+    if pasta not in sys.path:
+        sys.path.insert(0, pasta)
+    return importlib.import_module(nome)
+
+def _pool_abas():
+    global _POOL_ABAS
+    if _POOL_ABAS is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # spawn: igual no Windows e no Linux, e seguro com as threads das tarefas em segundo plano
+        _POOL_ABAS = ProcessPoolExecutor(max_workers=min(4, os.cpu_count() or 1),
+                                         mp_context=multiprocessing.get_context("spawn"))
+    return _POOL_ABAS
+
+def registros_protocolo_planilha(arquivo_excel, layout: str, progresso=None,
+                                 paralelo: Optional[bool] = None) -> list:
+    """
+    Registros de protocolo de todas as abas, na ordem das abas (a deduplicação fica com quem
+    chama). `paralelo=None` decide sozinho: pool de processos só com 2+ abas num arquivo grande.
+    """
+    conteudo = _conteudo_arquivo(arquivo_excel)
+    abas = abas_da_planilha(conteudo)
+    if paralelo is None:
+        paralelo = len(abas) > 1 and len(conteudo) >= LIMIAR_PARALELO_ABAS
+    descricao = LAYOUTS_PROTOCOLO[layout]["descricao"]
+
+    if not paralelo or len(abas) < 2:
+        registros = []
+        for k, aba in enumerate(abas):
+            _avisar_progresso(progresso, k, len(abas), f"{descricao} — aba {aba}")
+            registros.extend(iterar_registros_protocolo(_linhas_da_aba(conteudo, aba),
+                                                        LAYOUTS_PROTOCOLO[layout], progresso))
+        return registros
+
+    from concurrent.futures import as_completed
+    modulo = _modulo_importavel()
+    futuros = {modulo._pool_abas().submit(modulo._registros_da_aba, conteudo, aba, layout): k
+               for k, aba in enumerate(abas)}
+    por_aba = [None] * len(abas)
+    try:
+        for feitos, futuro in enumerate(as_completed(futuros), start=1):
+            por_aba[futuros[futuro]] = futuro.result()
+            _avisar_progresso(progresso, feitos, len(abas), f"{descricao} — abas")
+    except BaseException:
+        for futuro in futuros:
+            futuro.cancel()
+        raise
+    return [r for registros in por_aba for r in registros]
+
+def _datas_acao(textos) -> pd.Series:
+    """'Data Ação' em datetime (dia primeiro). Tenta o formato inferido de uma vez e só cai no
+    parse elemento a elemento para o que sobrar."""
+    s = pd.Series(textos, dtype=object)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        datas = pd.to_datetime(s, dayfirst=True, errors="coerce")
+        faltam = datas.isna() & s.notna()
+        if faltam.any():
+            datas[faltam] = pd.to_datetime(s[faltam], dayfirst=True, errors="coerce", format="mixed")
+    return datas
+
+def parse_protocolos_cda_xlsx(arquivo_xlsx, progresso=None, paralelo: Optional[bool] = None) -> pd.DataFrame:
+    registros = registros_protocolo_planilha(arquivo_xlsx, "cda", progresso, paralelo)
+    if not registros:
+        return pd.DataFrame()
+    df = pd.DataFrame({
+        "CNPJ_Masked": [r.cnpj_mascara for r in registros],
+        "CNPJ_Num": [r.cnpj for r in registros],
+        "Participante": [r.participante for r in registros],
+        "CDA_Protocolo": [r.protocolo for r in registros],
+        "CDA_Competencia": [r.competencia for r in registros],
+        "CDA_Status": [r.status for r in registros],
+        "Data_Acao": _datas_acao([r.data_acao for r in registros]),
+    })
 
     # Mantém a lógica: um por CNPJ, priorizando Data_Acao mais recente
     df = df.sort_values(["CNPJ_Num", "Data_Acao"], ascending=[True, False]) \
            .drop_duplicates("CNPJ_Num", keep="first")
 
-    return df
+    return compactar_dtypes(df)
 
-def enriquecer_em_comum_com_cda(rel_em_comum_df: pd.DataFrame, df_cda: pd.DataFrame) -> pd.DataFrame:
+def enriquecer_em_comum_com_cda(rel_em_comum_df: pd.DataFrame, df_cda: pd.DataFrame,
+                                motor: str = "pandas") -> pd.DataFrame:
     # Se o relatório base estiver ausente, devolve DF vazio, nunca None
     if rel_em_comum_df is None:
         return pd.DataFrame(columns=["CNPJ", "Nome do fundo", "CDA_Protocolo", "CDA_Competencia", "CDA_Status"])
@@ -1118,23 +2081,22 @@ def enriquecer_em_comum_com_cda(rel_em_comum_df: pd.DataFrame, df_cda: pd.DataFr
         return rel
 
     # Normaliza chave de junção
-    rel["CNPJ_Num"] = rel["CNPJ"].map(normaliza_cnpj)
+    rel["CNPJ_Num"] = rel["CNPJ"].map(normaliza_cnpj).astype(TIPO_TEXTO)
 
     # Garante que df_cda tenha as colunas necessárias; se não tiver, cria vazias para não quebrar o merge
     df_cda = df_cda.copy()
     for c in ["CNPJ_Num", "CDA_Protocolo", "CDA_Competencia", "CDA_Status"]:
         if c not in df_cda.columns:
             df_cda[c] = None
+    df_cda["CNPJ_Num"] = df_cda["CNPJ_Num"].astype(TIPO_TEXTO)
 
     # Merge por CNPJ normalizado
-    enx = rel.merge(
-        df_cda[["CNPJ_Num", "CDA_Protocolo", "CDA_Competencia", "CDA_Status"]],
-        on="CNPJ_Num", how="left"
-    )
+    enx = _merge_esquerda(rel, df_cda[["CNPJ_Num", "CDA_Protocolo", "CDA_Competencia", "CDA_Status"]],
+                          "CNPJ_Num", motor)
 
     # Preenche faltantes
     for c in expected_cols:
-        enx[c] = enx[c].fillna("Não possui")
+        enx[c] = _preencher_vazios(enx[c], "Não possui")
         
     # 🔽 PADRONIZA A COMPETÊNCIA DO CDA PARA 01/MM/AAAA
     if "CDA_Competencia" in enx.columns:
@@ -1162,25 +2124,13 @@ def enriquecer_em_comum_com_cda(rel_em_comum_df: pd.DataFrame, df_cda: pd.DataFr
 
 
 
-def _linhas_excel_como_texto(arquivo_excel) -> list[str]:
-    xls = pd.ExcelFile(arquivo_excel, engine="openpyxl")
-    linhas = []
-    for sheet in xls.sheet_names:
-        df = pd.read_excel(xls, sheet_name=sheet, dtype=str, header=None, engine="openpyxl")
-        for _, row in df.iterrows():
-            for val in row.tolist():
-                s = str(val).strip() if pd.notna(val) else ""
-                if s:
-                    linhas.append(s)
-    return [unicodedata.normalize("NFKD", s).strip() for s in linhas if s.strip()]
-
 def _extrair_mm_yyyy_de_nome_arquivo(linhas: list[str]) -> Optional[str]:
     mm_yyyy = None
     for i, text in enumerate(linhas):
         if text.upper().startswith("NOME DO ARQUIVO"):
             for j in range(i+1, min(i+5, len(linhas))):
                 cand = linhas[j]
-                m = re.search(r"(\d{6})(?!\d)", cand)
+                m = _RE["mmaaaa6"].search(cand)
                 if m:
                     mm = m.group(1)[:2]
                     yyyy = m.group(1)[2:]
@@ -1188,235 +2138,2152 @@ def _extrair_mm_yyyy_de_nome_arquivo(linhas: list[str]) -> Optional[str]:
                     return mm_yyyy
     return mm_yyyy
 
-# --- Substitua sua parse_protocolo_balancete por esta (XLSX)
-def parse_protocolo_balancete(arquivo_excel) -> pd.DataFrame:
-    # Lê como texto cru
-    df_raw = pd.read_excel(arquivo_excel, sheet_name=0, header=None, dtype=str, engine="openpyxl")
+COLUNAS_PROTOCOLO_BALANCETE = ["CNPJ", "Balancete_Protocolo", "Balancete_Competencia", "Balancete_Status"]
+
+def _df_balancete(registros_protocolo) -> pd.DataFrame:
+    """Registros do protocolo de Balancete -> DataFrame, um por CNPJ (o primeiro)."""
+    registros = [
+        {"CNPJ": formatar_cnpj(r.cnpj), "Balancete_Protocolo": r.protocolo,
+         "Balancete_Competencia": r.competencia, "Balancete_Status": r.status}
+        for r in registros_protocolo
+    ]
+    if not registros:
+        return pd.DataFrame(columns=COLUNAS_PROTOCOLO_BALANCETE)
+    df = pd.DataFrame(registros).drop_duplicates("CNPJ", keep="first").reset_index(drop=True)
+    return compactar_dtypes(df)
+
+def _parse_linhas_balancete(linhas: list, progresso=None) -> pd.DataFrame:
+    return _df_balancete(iterar_registros_protocolo(linhas, LAYOUTS_PROTOCOLO["balancete"], progresso))
+
+def parse_protocolo_balancete(arquivo_excel, progresso=None, paralelo: Optional[bool] = None) -> pd.DataFrame:
+    # todas as abas; com protocolos repetidos entre abas vale o primeiro (ordem das abas)
+    return _df_balancete(registros_protocolo_planilha(arquivo_excel, "balancete", progresso, paralelo))
 
-    # Achata as linhas não-vazias
+def parse_protocolo_balancete_from_pdf(uploaded_pdf, progresso=None) -> pd.DataFrame:
+    text = _read_text_from_pdf(uploaded_pdf, progresso=progresso)
+    linhas = [l.strip() for l in text.splitlines() if l.strip()]
+    return _parse_linhas_balancete(linhas, progresso)
+
+
+# ======================== Classificação rápida de arquivos ========================
+# Lê só o começo do arquivo (primeiras linhas da 1ª aba, 1ª página do PDF, cabeçalho do
+# CSV/Parquet) para dizer o que ele é e extrair metadados. Um upload no campo errado falha
+# em milissegundos, antes de qualquer parse completo.
+
+TIPOS_DOCUMENTO = {
+    "cadfi": "CadFi",
+    "controle": "Controle FIC",
+    "protocolo_cda": "Protocolo do CDA",
+    "protocolo_balancete": "Protocolo de Balancete",
+    "relatorio": "relatório gerado pelo app",
+}
+
+LINHAS_AMOSTRA = 40
+
+# assinatura dos primeiros bytes -> formato
+_ASSINATURAS_ARQUIVO = [
+    (b"%PDF", "pdf"),
+    (b"PK\x03\x04", "xlsx"),
+    (b"\xd0\xcf\x11\xe0", "xls"),
+    (b"\x1f\x8b", "csv.gz"),
+    (b"PAR1", "parquet"),
+]
+
+def _bytes_iniciais(arquivo, n: int = 8) -> bytes:
+    if hasattr(arquivo, "getvalue"):
+        return arquivo.getvalue()[:n]
+    if hasattr(arquivo, "read"):
+        pos = arquivo.tell()
+        try:
+            return arquivo.read(n)
+        finally:
+            arquivo.seek(pos)
+    with open(arquivo, "rb") as f:
+        return f.read(n)
+
+def formato_do_arquivo(arquivo) -> str:
+    """Formato pelo conteúdo (assinatura), com a extensão só como último recurso (CSV puro)."""
+    cabeca = _bytes_iniciais(arquivo)
+    for assinatura, formato in _ASSINATURAS_ARQUIVO:
+        if cabeca.startswith(assinatura):
+            return formato
+    nome = str(getattr(arquivo, "name", arquivo)).lower()
+    return "csv" if nome.endswith(".csv") else "desconhecido"
+
+def _amostra_linhas(arquivo, formato: str, max_linhas: int = LINHAS_AMOSTRA) -> list:
+    """Primeiras linhas (listas de textos não-vazios) sem ler o arquivo inteiro."""
     linhas = []
-    for _, row in df_raw.iterrows():
-        for val in row.values:
-            if pd.isna(val):
-                continue
-            txt = str(val).strip()
-            if txt:
-                linhas.append(txt)
-
-
-    pattern_cnpj = re.compile(r"(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})")
-    pattern_mmYYYY6 = re.compile(r"(\d{6})(?!\d)")  # ex: 082025
-
-    registros = []
-    current = {"cnpj": None, "protocolo": None, "comp": None, "mmYYYY_file": None, "status": None}
-
-    def flush():
-        if current["cnpj"] and current["protocolo"]:
-            cnpj_fmt = formatar_cnpj(current["cnpj"])
-            comp = current["mmYYYY_file"] or current["comp"] or ""
-            registros.append({
-                "CNPJ": cnpj_fmt,
-                "Balancete_Protocolo": current["protocolo"],
-                "Balancete_Competencia": comp,
-                "Balancete_Status": current.get("status") or ""
-            })
-        current.update({"cnpj": None, "protocolo": None, "comp": None, "mmYYYY_file": None, "status": None})
+    fonte = io.BytesIO(arquivo.getvalue()) if hasattr(arquivo, "getvalue") else arquivo
+    if formato == "xlsx":
+        import openpyxl
+        wb = openpyxl.load_workbook(fonte, read_only=True, data_only=True)
+        try:
+            for row in wb.worksheets[0].iter_rows(max_row=max_linhas, values_only=True):
+                linhas.append([str(v).strip() for v in row if v is not None and str(v).strip()])
+        finally:
+            wb.close()
+    elif formato == "xls":
+        df = pd.read_excel(fonte, header=None, nrows=max_linhas, dtype=str)
+        linhas = [[str(v).strip() for v in row if pd.notna(v) and str(v).strip()] for row in df.to_numpy()]
+    elif formato == "pdf":
+        import fitz  # PyMuPDF
+        dados = fonte.getvalue() if hasattr(fonte, "getvalue") else Path(fonte).read_bytes()
+        with fitz.open(stream=dados, filetype="pdf") as doc:
+            texto = doc[0].get_text("text") if doc.page_count else ""
+        linhas = [[l.strip()] for l in texto.splitlines()[:max_linhas * 4]]
+    elif formato in ("csv", "csv.gz"):
+        import gzip
+        bruto = fonte if hasattr(fonte, "read") else open(fonte, "rb")
+        try:
+            fluxo = gzip.GzipFile(fileobj=bruto) if formato == "csv.gz" else bruto
+            texto = io.TextIOWrapper(fluxo, encoding="utf-8", errors="replace")
+            import csv
+            for _, row in zip(range(max_linhas), csv.reader(texto)):
+                linhas.append([c.strip() for c in row if c.strip()])
+        finally:
+            if bruto is not fonte:
+                bruto.close()
+    elif formato == "parquet":
+        import pyarrow.parquet as pq
+        linhas = [list(pq.read_schema(fonte).names)]
+    if hasattr(arquivo, "seek") and not hasattr(arquivo, "getvalue"):
+        arquivo.seek(0)
+    return [l for l in linhas if l]
+
+def classificar_arquivo(arquivo) -> dict:
+    """
+    {'tipo': chave de TIPOS_DOCUMENTO ou None, 'formato', 'colunas', 'metadados'}.
+    Protocolos trazem o primeiro registro (CNPJ/protocolo/competência); relatórios, até que
+    passo já foram enriquecidos.
+    """
+    formato = formato_do_arquivo(arquivo)
+    info = {"tipo": None, "formato": formato, "colunas": [], "metadados": {}}
+    try:
+        linhas = _amostra_linhas(arquivo, formato)
+    except ImportError:
+        return info  # sem o leitor (ex.: PyMuPDF/xlrd) não dá para afirmar nada
+    except Exception as e:
+        info["metadados"]["erro"] = f"{type(e).__name__}: {e}"
+        return info
+    celulas = [c for linha in linhas for c in linha]
+    maiusculas = [c.upper() for c in celulas]
+
+    # Protocolo de Confirmação da CVM (CDA ou Balancete)
+    rotulo_protocolo = dict(_ROTULOS_PROTOCOLO)["protocolo"]
+    if any(c.startswith("PROTOCOLO DE CONFIRMA") or rotulo_protocolo.match(c) for c in maiusculas):
+        # o tipo vem do campo "Informe" (na mesma linha ou na seguinte); sem ele, do texto todo
+        informe = next((f"{c} {maiusculas[i + 1] if i + 1 < len(maiusculas) else ''}"
+                        for i, c in enumerate(maiusculas) if c.startswith("INFORME")), "")
+        texto = informe or " ".join(maiusculas)
+        if "BALANCETE" in texto:
+            info["tipo"] = "protocolo_balancete"
+        elif "CDA" in texto:
+            info["tipo"] = "protocolo_cda"
+        if info["tipo"]:
+            layout = LAYOUTS_PROTOCOLO["balancete" if info["tipo"] == "protocolo_balancete" else "cda"]
+            primeiro = next(iterar_registros_protocolo(celulas, layout), None)
+            if primeiro:
+                info["metadados"] = {"cnpj": formatar_cnpj(primeiro.cnpj), "protocolo": primeiro.protocolo,
+                                     "competencia": primeiro.competencia}
+        return info
+
+    # Planilhas tabulares: a primeira linha com 2+ células é o cabeçalho
+    cabecalho = next((l for l in linhas if len(l) >= 2), [])
+    info["colunas"] = cabecalho
+    chaves = {_norm_header_key(c) for c in cabecalho}
+    if "cnpj" in chaves and chaves & {"nome_do_fundo", "nome_do_fundo_controle"}:
+        info["tipo"] = "relatorio"
+        info["metadados"]["etapa"] = ("balancete" if "balancete_protocolo" in chaves
+                                      else "cda" if "cda_protocolo" in chaves else "batimento")
+    elif "cnpj_fundo" in chaves and chaves & {"denominacao_social", "denom_social"}:
+        info["tipo"] = "cadfi"
+    elif "cnpj" in chaves and chaves & {"cod_gfi", "codigo_gfi", "gfi", "fundos", "fundo"}:
+        info["tipo"] = "controle"
+    return info
+
+def conferir_tipo_arquivo(arquivo, esperado: str) -> dict:
+    """
+    Levanta ValueError se o arquivo for, com certeza, de outro tipo que não `esperado`.
+    Arquivos que não deu para classificar passam (o parse completo decide).
+    """
+    info = classificar_arquivo(arquivo)
+    if info["tipo"] and info["tipo"] != esperado:
+        nome = Path(str(getattr(arquivo, "name", arquivo))).name
+        raise ValueError(f"O arquivo '{nome}' parece ser {TIPOS_DOCUMENTO[info['tipo']]}, "
+                         f"mas este campo espera {TIPOS_DOCUMENTO[esperado]}.")
+    return info
+
+# tipo classificado -> entrada do pipeline
+ENTRADA_POR_TIPO = {
+    "cadfi": "arquivo_cadfi",
+    "controle": "arquivo_controle",
+    "protocolo_cda": "arquivo_cda",
+    "protocolo_balancete": "arquivo_balancete",
+}
 
-    i, n = 0, len(linhas)
-    while i < n:
-        up = linhas[i].upper()
+# ======================== Execução dos passos ========================
+import threading
+import time
 
-        # Início novo bloco? fecha o anterior (se completo)
-        if up.startswith("PROTOCOLO DE CONFIRMA"):
-            if current["cnpj"] and current["protocolo"]:
-                flush()
-            i += 1
-            continue
+COLUNAS_BALANCETE = ["Balancete_Protocolo", "Balancete_Competencia", "Balancete_Status"]
 
-        # PARTICIPANTE -> CNPJ
-        if up.startswith("PARTICIPANTE"):
-            if current["cnpj"] and current["protocolo"]:
-                flush()
-            for j in range(i + 1, min(i + 12, n)):
-                m = pattern_cnpj.search(linhas[j])
-                if m:
-                    current["cnpj"] = normaliza_cnpj(m.group(1))
-                    break
-            i += 1
-            continue
+def enriquecer_com_balancete(df_rel_comum: pd.DataFrame, df_balancete_proto: pd.DataFrame,
+                             motor: str = "pandas") -> pd.DataFrame:
+    """Merge por CNPJ do relatório (já com CDA) com os protocolos de Balancete."""
+    df_rel_comum = df_rel_comum.copy()
+    df_balancete_proto = padronizar_colunas(df_balancete_proto)
 
-        # NOME DO ARQUIVO -> captura 082025 => 08/2025 (agora olha até 4 linhas abaixo)
-        if up.startswith("NOME DO ARQUIVO"):
-            for j in range(i + 1, min(i + 5, n)):  # varre próximas linhas
-                m = pattern_mmYYYY6.search(linhas[j])
-                if m:
-                    mm, yyyy = m.group(1)[:2], m.group(1)[2:]
-                    current["mmYYYY_file"] = f"{mm}/{yyyy}"
-                    break
-            i += 1  # avança só uma posição; o while segue varrendo normalmente
+    # Normaliza CNPJ do relatório-base
+    df_rel_comum["CNPJ"] = _cnpj_formatado(df_rel_comum["CNPJ"], motor)
+
+    # Normaliza CNPJ do balancete (se existir)
+    if "CNPJ" in df_balancete_proto.columns:
+        df_balancete_proto["CNPJ"] = _cnpj_formatado(df_balancete_proto["CNPJ"], motor)
+    else:
+        df_balancete_proto["CNPJ"] = pd.Series(dtype=TIPO_TEXTO)
+
+    # Fallback: garante as colunas esperadas do balancete para o merge
+    for c in COLUNAS_BALANCETE:
+        if c not in df_balancete_proto.columns:
+            df_balancete_proto[c] = None
+
+    merged = _merge_esquerda(df_rel_comum, df_balancete_proto[["CNPJ"] + COLUNAS_BALANCETE], "CNPJ", motor)
+
+    # Preenche vazios
+    for c in COLUNAS_BALANCETE:
+        merged[c] = _preencher_vazios(merged[c], "Não possui")
+
+    # 🔽 PADRONIZA COMPETÊNCIA para 01/MM/AAAA (CDA e Balancete):
+    for col in ["CDA_Competencia", "Balancete_Competencia"]:
+        if col in merged.columns:
+            merged[col] = merged[col].map(_competencia_to_01_mm_aaaa)
+
+    cols = list(merged.columns)
+    insert_pos = cols.index("Mes de Referencia") + 1 if "Mes de Referencia" in cols else len(cols)
+    for c in COLUNAS_BALANCETE:
+        if c in cols:
+            cols.remove(c)
+    cols = cols[:insert_pos] + COLUNAS_BALANCETE + cols[insert_pos:]
+    return merged[cols]
+
+# --- Pipeline do batimento como DAG de etapas com cache
+#
+# Cada etapa declara de quem depende (outras etapas ou entradas: arquivos enviados, regras,
+# parâmetros). A chave de cache de uma etapa é o hash do seu nome + as impressões digitais das
+# dependências, então só recalcula o que está abaixo de uma entrada que mudou: trocar a
+# competência do 4º passo só refaz a validação; trocar o Controle FIC refaz do 1º ao 4º.
+# Uma dependência "a|b" usa a entrada `a` quando ela foi fornecida e, senão, a etapa `b`
+# (ex.: relatório 'Em Ambos' reenviado pelo usuário ou o gerado no 1º passo).
+# A entrada "motor" (pandas/polars) tem valor padrão MOTOR_PADRAO quando não é informada.
+
+def _etapa_cadfi(arquivo, progresso=None):
+    """CadFi do arquivo enviado ou, sem arquivo, o montado pela linha do tempo numa data passada."""
+    if isinstance(arquivo, pd.DataFrame):
+        return arquivo
+    conferir_tipo_arquivo(arquivo, "cadfi")
+    return carregar_excel(arquivo)
+
+def _etapa_controle_lido(arquivo, progresso=None):
+    conferir_tipo_arquivo(arquivo, "controle")
+    return ler_controle_fic(arquivo)
+
+def _etapa_cda(arquivo, progresso=None):
+    conferir_tipo_arquivo(arquivo, "protocolo_cda")
+    return parse_protocolos_cda_xlsx(arquivo, progresso)
+
+def _etapa_controle(controle, regras, progresso=None):
+    # APLICA FILTRO DE SIT A JAQUI (recomendado) — se a coluna não existir é noop
+    return filtrar_controle_por_situacao(controle, regras["controle"]["situacoes_excluir"])
+
+def _etapa_batimento(cadfi_filtrado, controle_prep, regras, motor="pandas", progresso=None) -> Dict[str, pd.DataFrame]:
+    """
+    Comparações CadFi x Controle FIC e os três relatórios do 1º passo. Tudo é decidido por
+    máscaras sobre os DFs de entrada; cada relatório é materializado uma vez, já projetado.
+    """
+    # segue comparações com controle já restrito a SIT == 'A'
+    no_controle = np.asarray(_contido_em(cadfi_filtrado["CNPJ"], controle_prep["CNPJ"], motor), dtype=bool)
+    controle_fora = ~np.asarray(_contido_em(controle_prep["CNPJ"], cadfi_filtrado["CNPJ"], motor), dtype=bool)
+    controle_fora &= mascara_situacao_controle(controle_prep, regras["controle"]["situacoes_excluir"])
+    controle_fora &= mascara_nome_controle(controle_prep, regras["controle"]["nomes_excluir"], linhas=controle_fora)
+
+    rel_fora = relatorio_fora_controle(cadfi_filtrado, ~no_controle)
+    rel_comum = relatorio_em_comum(cadfi_filtrado, no_controle)
+    rel_comum = remover_segundos_colunas(rel_comum, ["CDA_Protocolo", "CDA_Competencia"])
+    rel_controle_fora = relatorio_controle_fora_cadfi(controle_prep, controle_fora)
+
+    mapa = mapa_cod_gfi(controle_prep, motor)  # uma vez para os três relatórios
+    rel_comum = adicionar_drive_por_cnpj(rel_comum, controle_prep, motor=motor, mapa=mapa)
+    # COD GFI como primeira coluna do relatório 'Em Ambos' (move a coluna, sem copiar o DF)
+    if "COD GFI" in rel_comum.columns:
+        rel_comum.insert(0, "COD GFI", rel_comum.pop("COD GFI"))
+
+    rel_fora = adicionar_drive_por_cnpj(rel_fora, controle_prep, motor=motor, mapa=mapa)
+    rel_controle_fora = adicionar_drive_por_cnpj(rel_controle_fora, controle_prep, motor=motor, mapa=mapa)
+    return {"rel_comum": rel_comum, "rel_fora": rel_fora, "rel_controle_fora": rel_controle_fora}
+
+COLUNAS_CNPJS_INVALIDOS = ["Origem", "Linha", "CNPJ (original)", "Nome do fundo", "COD GFI", "Motivo"]
+
+def _etapa_cnpjs_invalidos(cadfi, controle_lido, regras, progresso=None) -> pd.DataFrame:
+    """
+    Linhas do CadFi e do Controle FIC que ficaram de fora do batimento por CNPJ vazio ou com
+    dígito verificador errado — só as que passariam nas regras (as demais não fazem falta).
+    """
+    no_escopo = mascara_cadfi(cadfi, regras).to_numpy()
+    motivo = motivo_cnpj_invalido(cadfi["CNPJ_Fundo"].iloc[np.flatnonzero(no_escopo)])
+    ruins = cadfi.loc[motivo.index[motivo.notna().to_numpy()]]
+    do_cadfi = pd.DataFrame({"Origem": "CadFi", "Linha": (ruins.index + 2).astype(str),
+                             "CNPJ (original)": ruins["CNPJ_Fundo"], "Nome do fundo": ruins["Denominacao_Social"],
+                             "COD GFI": None, "Motivo": motivo.dropna()})
+
+    invalidos = controle_lido["invalidos"]
+    r = regras["controle"]
+    no_escopo = mascara_situacao_controle(invalidos, r["situacoes_excluir"])
+    no_escopo &= mascara_nome_controle(invalidos, r["nomes_excluir"], linhas=no_escopo)
+    ruins = invalidos.loc[no_escopo]
+    do_controle = pd.DataFrame({"Origem": "Controle FIC", "Linha": ruins["Linha"], "CNPJ (original)": ruins["CNPJ (original)"],
+                                "Nome do fundo": ruins["Fundos"], "COD GFI": ruins["COD GFI"], "Motivo": ruins["Motivo"]})
+    partes = [p.astype(TIPO_TEXTO) for p in (do_cadfi, do_controle) if len(p)]
+    if not partes:
+        return pd.DataFrame(columns=COLUNAS_CNPJS_INVALIDOS, dtype=TIPO_TEXTO)
+    return pd.concat(partes, ignore_index=True)[COLUNAS_CNPJS_INVALIDOS]
+
+COLUNAS_AUDITORIA_REGRAS = ["CNPJ", "Nome do fundo", "Excluído por", "Incluído por", "Aceito"]
+
+def _etapa_auditoria_regras(cadfi, regras, progresso=None) -> pd.DataFrame:
+    """
+    Auditoria das regras de nome do CadFi: para cada fundo que passou nos filtros de administrador,
+    situação e tipo, o termo que o excluiu, o termo de inclusão que casou e se entrou no batimento.
+    """
+    _, nomes = _avaliar_regras_cadfi(cadfi, regras)
+    linhas = cadfi.loc[nomes.index]
+    auditoria = pd.DataFrame({"CNPJ": linhas["CNPJ_Fundo"], "Nome do fundo": linhas["Denominacao_Social"],
+                              "Excluído por": nomes["Regra_Excluir"], "Incluído por": nomes["Regra_Incluir"],
+                              "Aceito": np.where(nomes["Aceito"], "Sim", "Não")})
+    return auditoria.astype(TIPO_TEXTO).reset_index(drop=True)[COLUNAS_AUDITORIA_REGRAS]
+
+def _etapa_conciliacao(relatorios, invalidos, progresso=None) -> pd.DataFrame:
+    """Restos do batimento + linhas com CNPJ inválido (as do relatório de inválidos) casados pelo nome."""
+    rel_fora, rel_ctl = relatorios["rel_fora"], relatorios["rel_controle_fora"]
+    lado = {origem: invalidos[invalidos["Origem"] == origem] for origem in ("CadFi", "Controle FIC")}
+    lado_cadfi = pd.concat([
+        pd.DataFrame({"CNPJ": rel_fora["CNPJ"], "Nome": rel_fora["Nome do fundo"], "Origem": "Fora do Controle"}),
+        pd.DataFrame({"CNPJ": lado["CadFi"]["CNPJ (original)"], "Nome": lado["CadFi"]["Nome do fundo"],
+                      "Origem": "CNPJ inválido no CadFi"}),
+    ], ignore_index=True)
+    lado_controle = pd.concat([
+        pd.DataFrame({"CNPJ": rel_ctl["CNPJ"], "Nome": rel_ctl["Nome do fundo (Controle)"],
+                      "COD GFI": rel_ctl["COD GFI"] if "COD GFI" in rel_ctl.columns else None,
+                      "Origem": "Controle fora do CadFi"}),
+        pd.DataFrame({"CNPJ": lado["Controle FIC"]["CNPJ (original)"], "Nome": lado["Controle FIC"]["Nome do fundo"],
+                      "COD GFI": lado["Controle FIC"]["COD GFI"], "Origem": "CNPJ inválido no Controle"}),
+    ], ignore_index=True)
+    return conciliar_por_nome(lado_cadfi, lado_controle)
+
+def _etapa_relatorio_base(relatorio, progresso=None) -> pd.DataFrame:
+    """Relatório-base dos passos 2 e 3: o arquivo reenviado pelo usuário ou o DataFrame da etapa anterior."""
+    if isinstance(relatorio, pd.DataFrame):
+        return relatorio
+    conferir_tipo_arquivo(relatorio, "relatorio")
+    df = ler_relatorio(relatorio)
+    if "CNPJ" not in df.columns:
+        raise ValueError("O relatório 'Em Ambos' precisa ter a coluna 'CNPJ'.")
+    return df
+
+def _etapa_balancete(arquivo, progresso=None) -> pd.DataFrame:
+    # formato pelo conteúdo (não pela extensão); xlsx mais confiável, pdf pelo texto
+    formato = conferir_tipo_arquivo(arquivo, "protocolo_balancete")["formato"]
+    if formato == "xlsx" or (formato != "pdf" and str(getattr(arquivo, "name", "")).lower().endswith(".xlsx")):
+        return parse_protocolo_balancete(arquivo, progresso=progresso)
+    return parse_protocolo_balancete_from_pdf(arquivo, progresso=progresso)
+
+def _etapa_validacao(df_base, parametros: dict, motor="pandas", progresso=None) -> pd.DataFrame:
+    """parametros = {'modo': 'data'|'mes_ano', 'alvo': str, 'contar_nao_possui': bool}"""
+    validar = validar_por_data_exata if parametros["modo"] == "data" else validar_por_mes_ano
+    return validar(df_base, parametros["alvo"], contar_nao_possui=parametros.get("contar_nao_possui", True),
+                   motor=motor)
+
+# nome -> (dependências, função, descrição para o progresso)
+ETAPAS_BATIMENTO = {
+    "cadfi_na_data":  (("linha_do_tempo_cadfi", "data_cadfi"),
+                       lambda linha, data, progresso=None: cadfi_na_data(linha, data), "Montando CadFi na data"),
+    "cadfi":          (("arquivo_cadfi|cadfi_na_data",), _etapa_cadfi, "Lendo CadFi"),
+    "cadfi_filtrado": (("cadfi", "regras"), lambda df, regras, progresso=None: filtrar_cadfi(df, regras),
+                       "Filtrando CadFi"),
+    "controle_lido":  (("arquivo_controle",), _etapa_controle_lido, "Lendo Controle FIC"),
+    "controle_bruto": (("controle_lido",), lambda lido, progresso=None: lido["controle"], "Controle FIC"),
+    "controle":       (("controle_bruto", "regras"), _etapa_controle, "Filtrando Controle FIC"),
+    "batimento":      (("cadfi_filtrado", "controle", "regras", "motor"), _etapa_batimento, "Comparando CNPJs"),
+    "rel_comum":      (("batimento",), lambda rels, progresso=None: rels["rel_comum"], "Relatório 'Em Ambos'"),
+    "cnpjs_invalidos": (("cadfi", "controle_lido", "regras"), _etapa_cnpjs_invalidos,
+                        "Conferindo dígitos verificadores dos CNPJs"),
+    "conciliacao":    (("batimento", "cnpjs_invalidos"), _etapa_conciliacao,
+                       "Conciliando nomes (CNPJ ausente ou digitado errado)"),
+    "auditoria_regras": (("cadfi", "regras"), _etapa_auditoria_regras, "Auditando regras de nome do CadFi"),
+    "base_cda":       (("arquivo_rel_ambos|rel_comum",), _etapa_relatorio_base, "Lendo relatório 'Em Ambos'"),
+    "cda":            (("arquivo_cda",), _etapa_cda, "Lendo protocolos do CDA"),
+    "rel_cda":        (("base_cda", "cda", "motor"),
+                       lambda df, cda, motor, progresso=None: enriquecer_em_comum_com_cda(df, cda, motor),
+                       "Integrando CDA"),
+    "base_balancete": (("arquivo_rel_cda|rel_cda",), _etapa_relatorio_base, "Lendo relatório com CDA"),
+    "balancete":      (("arquivo_balancete",), _etapa_balancete, "Lendo Balancete"),
+    "rel_balancete":  (("base_balancete", "balancete", "motor"),
+                       lambda df, bal, motor, progresso=None: enriquecer_com_balancete(df, bal, motor),
+                       "Integrando Balancete"),
+    "validacao":      (("rel_balancete", "parametros_validacao", "motor"), _etapa_validacao,
+                       "Validando competências"),
+    "divergencias":   (("validacao", "rel_balancete"),
+                       lambda inc, base, progresso=None: consolidar_divergencias(inc, base), "Consolidando divergências"),
+}
+
+def impressao_digital(valor) -> str:
+    """Hash estável de uma entrada do pipeline (arquivo, DataFrame, regras ou parâmetros)."""
+    h = hashlib.sha1()
+    if hasattr(valor, "getvalue"):                         # upload / BytesIO
+        h.update(valor.getvalue())
+    elif isinstance(valor, (str, Path)) and Path(valor).is_file():
+        h.update(Path(valor).read_bytes())
+    elif isinstance(valor, pd.DataFrame):
+        h.update(repr(list(valor.columns)).encode("utf-8"))
+        h.update(pd.util.hash_pandas_object(valor, index=False).to_numpy().tobytes())
+    elif isinstance(valor, dict) and "versao" in valor:    # regras (carregar_regras)
+        h.update(str(valor["versao"]).encode("utf-8"))
+    else:
+        h.update(json.dumps(valor, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+def novo_cache_etapas(max_itens: int = 32) -> dict:
+    """Cache LRU (chave da etapa -> resultado), seguro para as tarefas em threads."""
+    from collections import OrderedDict
+    return {"itens": OrderedDict(), "max_itens": max_itens, "trava": threading.Lock()}
+
+CACHE_ETAPAS = None  # cache padrão do processo, criado no primeiro uso
+
+# --- Perfil por etapa (opcional): cProfile + tracemalloc
+# Com `perfil=<pasta>`, cada etapa calculada grava <etapa>.prof (abrir com pstats/snakeviz),
+# <etapa>_cpu.txt (funções mais caras) e <etapa>_memoria.txt (linhas que mais alocaram), além
+# de um perfil.json com tempo e pico de memória por etapa — prontos para anexar num chamado.
+PASTA_PERFIS = Path(os.environ.get("BATIMENTO_PASTA_PERFIS", Path(__file__).with_name("perfis")))
+
+_TRAVA_PERFIL = objeto_do_processo("trava_perfil", threading.Lock)  # um perfilador por vez (cProfile e tracemalloc são globais)
+
+def nova_pasta_perfil(base=None) -> Path:
+    """Pasta nova (por execução) para os relatórios de perfil."""
+    base = Path(base or PASTA_PERFIS)
+    pasta = base / f"{time.strftime('%Y-%m-%d_%H%M%S')}_{threading.get_ident() % 10000:04d}"
+    pasta.mkdir(parents=True, exist_ok=True)
+    return pasta
+
+def _executar_com_perfil(pasta, nome: str, funcao, args, progresso=None, top: int = 30):
+    import cProfile
+    import pstats
+    import tracemalloc
+
+    pasta = Path(pasta)
+    pasta.mkdir(parents=True, exist_ok=True)
+    with _TRAVA_PERFIL:
+        iniciou_tracemalloc = not tracemalloc.is_tracing()
+        if iniciou_tracemalloc:
+            tracemalloc.start(1)  # 1 quadro basta para o top por linha e custa bem menos
+        tracemalloc.reset_peak()
+        memoria_antes = tracemalloc.get_traced_memory()[0]
+        perfilador = cProfile.Profile()
+        inicio = time.perf_counter()
+        try:
+            valor = perfilador.runcall(funcao, *args, progresso=progresso)
+        finally:
+            duracao = time.perf_counter() - inicio
+            pico = tracemalloc.get_traced_memory()[1] - memoria_antes
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            ])
+            if iniciou_tracemalloc:
+                tracemalloc.stop()
+
+            perfilador.dump_stats(str(pasta / f"{nome}.prof"))
+            with open(pasta / f"{nome}_cpu.txt", "w", encoding="utf-8") as f:
+                pstats.Stats(perfilador, stream=f).sort_stats("cumulative").print_stats(top)
+            with open(pasta / f"{nome}_memoria.txt", "w", encoding="utf-8") as f:
+                f.write(f"Etapa {nome}: pico {pico / 2**20:.1f} MiB acima do início\n\n")
+                for stat in snapshot.statistics("lineno")[:top]:
+                    f.write(f"{stat.size / 2**20:9.2f} MiB {stat.count:9d} blocos  {stat.traceback}\n")
+
+            resumo_arq = pasta / "perfil.json"
+            resumo = json.loads(resumo_arq.read_text(encoding="utf-8")) if resumo_arq.exists() else {}
+            resumo[nome] = {"segundos": round(duracao, 4), "pico_memoria_mib": round(pico / 2**20, 2)}
+            resumo_arq.write_text(json.dumps(resumo, ensure_ascii=False, indent=2), encoding="utf-8")
+    return valor
+
+def _resolver_dependencia(dep: str, entradas: dict) -> str:
+    if "|" in dep:
+        preferida, alternativa = dep.split("|", 1)
+        return preferida if entradas.get(preferida) is not None else alternativa
+    return dep
+
+def planejar_etapas(alvos, entradas: dict, etapas: Optional[dict] = None):
+    """
+    Ordem topológica (DFS) só do que os `alvos` precisam e a chave de cada etapa/entrada: a de
+    uma entrada é a impressão digital do valor; a de uma etapa, o hash das chaves das dependências.
+    Devolve (ordem [(etapa, deps)], chaves, valores das entradas).
+    """
+    etapas = etapas or ETAPAS_BATIMENTO
+    chaves, valores = {}, {}
+    ordem, visitando = [], set()
+    def visitar(nome):
+        if nome in chaves or nome in visitando:
+            return
+        if nome not in etapas:
+            if entradas.get(nome) is None:
+                raise ValueError(f"Entrada '{nome}' não informada.")
+            chaves[nome] = impressao_digital(entradas[nome])
+            valores[nome] = entradas[nome]
+            return
+        visitando.add(nome)
+        deps = [_resolver_dependencia(d, entradas) for d in etapas[nome][0]]
+        for d in deps:
+            visitar(d)
+        visitando.discard(nome)
+        chaves[nome] = hashlib.sha1("|".join([nome] + [chaves[d] for d in deps]).encode("utf-8")).hexdigest()
+        ordem.append((nome, deps))
+
+    for alvo in alvos:
+        visitar(alvo)
+    return ordem, chaves, valores
+
+def executar_etapas(alvos, entradas: dict, cache: Optional[dict] = None, progresso=None,
+                    etapas: Optional[dict] = None, registro: Optional[dict] = None, perfil=None,
+                    recalcular: bool = False) -> dict:
+    """
+    Calcula as etapas `alvos` (e só as dependências necessárias) e devolve {nome: resultado}.
+    Resultados já presentes no cache com a mesma chave são reaproveitados (com `recalcular`,
+    tudo é calculado de novo e substitui o que estava no cache). Se `registro` for um dict,
+    recebe {etapa: 'cache'|'calculada'} para cada etapa visitada. Com `perfil` (pasta),
+    cada etapa calculada roda sob cProfile/tracemalloc e grava seus relatórios ali.
+    """
+    global CACHE_ETAPAS
+    if cache is None:
+        if CACHE_ETAPAS is None:
+            CACHE_ETAPAS = novo_cache_etapas()
+        cache = CACHE_ETAPAS
+    etapas = etapas or ETAPAS_BATIMENTO
+    registro = {} if registro is None else registro
+    if entradas.get("motor") is None:
+        entradas = {**entradas, "motor": MOTOR_PADRAO}
+    conferir_motor(entradas["motor"])
+    ordem, chaves, valores = planejar_etapas(alvos, entradas, etapas)
+
+    # recupera do cache de trás para frente: etapas cujos dependentes já estão em cache nem são lidas
+    necessarias = set(alvos)
+    for nome, deps in reversed(ordem):
+        if nome not in necessarias:
             continue
+        with cache["trava"]:
+            achado = not recalcular and chaves[nome] in cache["itens"]
+            if achado:
+                cache["itens"].move_to_end(chaves[nome])
+                valores[nome] = cache["itens"][chaves[nome]]
+        if achado:
+            registro[nome] = "cache"
+        else:
+            necessarias.update(deps)
+
+    pendentes = [(n, d) for n, d in ordem if n in necessarias and registro.get(n) != "cache"]
+    for i, (nome, deps) in enumerate(pendentes):
+        funcao, descricao = etapas[nome][1], etapas[nome][2]
+        _avisar_progresso(progresso, i, len(pendentes), descricao)
+        args = [valores[d] for d in deps]
+        if perfil:
+            valores[nome] = _executar_com_perfil(perfil, nome, funcao, args, progresso)
+        else:
+            valores[nome] = funcao(*args, progresso=progresso)
+        registro[nome] = "calculada"
+        with cache["trava"]:
+            cache["itens"][chaves[nome]] = valores[nome]
+            cache["itens"].move_to_end(chaves[nome])
+            while len(cache["itens"]) > cache["max_itens"]:
+                cache["itens"].popitem(last=False)
+    _avisar_progresso(progresso, len(pendentes), len(pendentes), "Concluído")
+    return {alvo: valores[alvo] for alvo in alvos}
+
+def impressao_acao(acao: str, alvos, entradas: dict, etapas: Optional[dict] = None) -> str:
+    """
+    Impressão digital de uma ação (botão da interface): o nome da ação e as chaves das etapas
+    `alvos`, que já cobrem o hash dos arquivos usados, a versão das regras, os parâmetros da
+    validação (modo, alvo, contar_nao_possui) e o motor. Entrada que os alvos não usam não conta.
+    """
+    if entradas.get("motor") is None:
+        entradas = {**entradas, "motor": MOTOR_PADRAO}
+    _, chaves, _ = planejar_etapas(alvos, entradas, etapas)
+    return hashlib.sha1("|".join([acao] + [chaves[a] for a in alvos]).encode("utf-8")).hexdigest()
+
+def avisos_balancete(df_balancete_proto: pd.DataFrame) -> list:
+    avisos = []
+    if "CNPJ" not in df_balancete_proto.columns:
+        avisos.append(
+            "Não foi possível extrair CNPJ do arquivo de Balancete — verifique o layout. "
+            "O resultado pode ficar vazio."
+        )
+    return avisos
 
-        # COMPETÊNCIA
-        if up.startswith("COMPET"):
-            val = linhas[i + 1].strip() if (i + 1) < n else ""
+# --- Tarefas em segundo plano (pool de threads + progresso + cancelamento)
+def iniciar_tarefa(pool, funcao, *args, descricao: str = "", **kwargs) -> dict:
+    """
+    Submete `funcao(*args, progresso=..., **kwargs)` ao pool e devolve o handle da tarefa:
+    {'descricao', 'futuro', 'estado', 'cancelar', 'inicio'}. O callback de progresso atualiza
+    'estado' (feitos/total/etapa) e levanta TarefaCancelada quando 'cancelar' é acionado.
+    """
+    estado = {"feitos": 0, "total": None, "etapa": descricao}
+    cancelar = threading.Event()
 
-            # 1) MM/AAAA
-            m2 = re.search(r"\b(\d{2})/(20\d{2})\b", val)
-            if m2:
-                current["comp"] = f"{m2.group(1)}/{m2.group(2)}"
-            else:
-                # 2) DD/MM/AAAA ou MM/DD/AAAA
-                m3 = re.search(r"\b(\d{2})/(\d{2})/(20\d{2})\b", val)
-                if m3:
-                    a, b, ano = int(m3.group(1)), int(m3.group(2)), int(m3.group(3))
-                    if a > 12 and 1 <= b <= 12:
-                        current["comp"] = f"{b:02d}/{ano}"   # DD/MM/AAAA
-                    else:
-                        current["comp"] = f"{a:02d}/{ano}"   # MM/DD/AAAA ou ambíguo
+    def progresso(feitos, total=None, etapa=""):
+        if cancelar.is_set():
+            raise TarefaCancelada()
+        estado.update(feitos=feitos, total=total, etapa=etapa or estado["etapa"])
 
+    futuro = pool.submit(funcao, *args, progresso=progresso, **kwargs)
+    return {"descricao": descricao, "futuro": futuro, "estado": estado,
+            "cancelar": cancelar, "inicio": time.time()}
+
+def arquivo_em_memoria(uploaded_file):
+    """Cópia em memória (com .name) de um upload, para a tarefa não depender do objeto do Streamlit."""
+    if uploaded_file is None:
+        return None
+    copia = io.BytesIO(uploaded_file.getvalue())
+    copia.name = getattr(uploaded_file, "name", "")
+    return copia
+
+
+# ======================== API HTTP local ========================
+# Serviço opcional para outras ferramentas internas (`python app.py api`). Os arquivos são
+# enviados uma vez (POST /arquivos?nome=...) e referenciados pelo id (sha1 do conteúdo) nas
+# chamadas dos passos, que rodam no mesmo pipeline de etapas (e no mesmo cache) da interface.
+#
+#   POST /passo1     {"arquivo_cadfi": id, "arquivo_controle": id}
+#   POST /conciliacao  (as entradas do passo 1) CNPJs inválidos e pares por nome para eles
+#   POST /passo2     {"arquivo_cda": id, "arquivo_rel_ambos": id}   (ou as entradas do passo 1)
+#   POST /passo3     {"arquivo_balancete": id, "arquivo_rel_cda": id} (ou as entradas dos passos 1–2)
+#   POST /validacao  {..., "parametros_validacao": {"modo": "mes_ano", "alvo": "08/2025"}}
+#
+# Qualquer pedido aceita "motor": "pandas"|"polars" (padrão: o do servidor). Sem "arquivo_cadfi",
+# "data_cadfi": "AAAA-MM-DD" roda o passo 1 com o CadFi daquela data (linha do tempo do CadFi).
+#
+# A resposta é JSON (um registro por linha); com "formato": "xlsx"|"csv.gz"|"parquet" e
+# "relatorio": <nome> devolve só aquele relatório no formato pedido.
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ROTAS_API = {
+    "/passo1": ["batimento", "auditoria_regras"],
+    "/conciliacao": ["conciliacao", "cnpjs_invalidos"],
+    "/passo2": ["rel_cda"],
+    "/passo3": ["rel_balancete", "balancete"],
+    "/validacao": ["validacao", "divergencias"],
+}
+
+MAX_BYTES_ARQUIVO_API = 200 * 1024 * 1024
+
+class ArquivoNaoEncontrado(LookupError):
+    """Id de arquivo desconhecido (nunca enviado ou já descartado do servidor) — a API responde 404."""
+
+def _relatorios_da_rota(rota: str, resultado: dict) -> Tuple[Dict[str, pd.DataFrame], dict]:
+    """Separa o resultado das etapas em (relatórios tabulares, campos extras da resposta)."""
+    if rota == "/passo1":
+        return {**resultado["batimento"], "auditoria_regras": resultado["auditoria_regras"]}, {}
+    if rota == "/conciliacao":
+        return {"conciliacao": resultado["conciliacao"], "cnpjs_invalidos": resultado["cnpjs_invalidos"]}, {}
+    if rota == "/passo2":
+        return {"rel_cda": resultado["rel_cda"]}, {}
+    if rota == "/passo3":
+        return {"rel_balancete": resultado["rel_balancete"]}, {"avisos": avisos_balancete(resultado["balancete"])}
+    div = resultado["divergencias"]
+    relatorios = {"linhas": resultado["validacao"], "consolidado": div["consolidado"]}
+    relatorios.update({f"segmento_{nome}": df for nome, df in div["segmentos"].items()})
+    return relatorios, {"resumo": div["resumo"]}
+
+def _json_padrao(valor):
+    return valor.item() if hasattr(valor, "item") else str(valor)
+
+class _ManipuladorApi(BaseHTTPRequestHandler):
+    server_version = "BatimentoAPI/1.0"
+
+    def log_message(self, formato, *args):  # silencioso; quem sobe a API decide o log
+        pass
+
+    def _responder(self, status: int, corpo, tipo: str = "application/json; charset=utf-8", nome=None):
+        if not isinstance(corpo, (bytes, bytearray)):
+            corpo = json.dumps(corpo, ensure_ascii=False, default=_json_padrao).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(corpo)))
+        if nome:
+            self.send_header("Content-Disposition", f'attachment; filename="{nome}"')
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def _ler_corpo(self) -> bytes:
+        tamanho = int(self.headers.get("Content-Length") or 0)
+        if tamanho > MAX_BYTES_ARQUIVO_API:
+            raise ValueError(f"Arquivo acima do limite de {MAX_BYTES_ARQUIVO_API // (1024 * 1024)} MB.")
+        return self.rfile.read(tamanho)
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/saude":
+            self._responder(200, {"status": "ok", "rotas": ["/arquivos", *ROTAS_API]})
+        else:
+            self._responder(404, {"erro": "Rota não encontrada."})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        try:
+            if url.path == "/arquivos":
+                nome = (parse_qs(url.query).get("nome") or [""])[0]
+                self._responder(201, self.server.guardar_arquivo(self._ler_corpo(), nome))
+            elif url.path in ROTAS_API:
+                pedido = json.loads(self._ler_corpo() or b"{}")
+                if not isinstance(pedido, dict):
+                    raise ValueError("O corpo do pedido deve ser um objeto JSON ({...}).")
+                resultado = self.server.executar(ROTAS_API[url.path], pedido)
+                relatorios, extras = _relatorios_da_rota(url.path, resultado)
+                formato = pedido.get("formato")
+                if formato:
+                    nome = pedido.get("relatorio") or next(iter(relatorios))
+                    if nome not in relatorios:
+                        raise ValueError(f"Relatório '{nome}' inexistente. Opções: {', '.join(relatorios)}.")
+                    if formato not in FORMATOS_EXPORTACAO:
+                        raise ValueError(f"Formato '{formato}' não suportado.")
+                    ext, mime = FORMATOS_EXPORTACAO[formato]
+                    corpo = relatorio_bytes(relatorios[nome], formato, sheet_name=nome[:31]).getvalue()
+                    self._responder(200, corpo, mime, nome=f"{nome}{ext}")
                 else:
-                    # 3) NOVO: ISO AAAA-MM-DD (com ou sem hora)
-                    m4 = re.search(r"\b(20\d{2})-(\d{2})-(\d{2})\b", val)
-                    if m4:
-                        ano, mes = int(m4.group(1)), int(m4.group(2))
-                        current["comp"] = f"{mes:02d}/{ano}"
-                    else:
-                        # 4) NOVO: fallback genérico via pandas
-                        try:
-                            ts = pd.to_datetime(val, dayfirst=True, errors="coerce")
-                            if pd.notna(ts):
-                                current["comp"] = f"{int(ts.month):02d}/{ts.year}"
-                        except Exception:
-                            pass
-
-            i += 2
-            continue
+                    corpo = {nome: json.loads(df.to_json(orient="records", force_ascii=False))
+                             for nome, df in relatorios.items()}
+                    self._responder(200, {**corpo, **extras})
+            else:
+                self._responder(404, {"erro": "Rota não encontrada."})
+        except ArquivoNaoEncontrado as e:
+            self._responder(404, {"erro": f"Arquivo não encontrado: {e.args[0]}"})
+        except (ValueError, json.JSONDecodeError) as e:
+            self._responder(400, {"erro": str(e)})
+        except Exception as e:
+            self._responder(500, {"erro": f"{type(e).__name__}: {e}"})
+
+class ServidorApi(ThreadingHTTPServer):
+    """
+    Servidor HTTP da API. Cada requisição tem sua thread, mas o processamento dos passos vai
+    para um pool de `workers` threads, o que limita quantos batimentos rodam ao mesmo tempo.
+    """
+    daemon_threads = True
+
+    def __init__(self, endereco, workers: int = 4, max_arquivos: int = 32, cache: Optional[dict] = None,
+                 perfil=None, motor: Optional[str] = None):
+        super().__init__(endereco, _ManipuladorApi)
+        self.perfil = perfil  # pasta base dos perfis por requisição (None = desligado)
+        self.motor = motor    # motor padrão; cada pedido pode trocar com "motor"
+        from collections import OrderedDict
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batimento-api")
+        self.cache = cache if cache is not None else novo_cache_etapas()
+        self.arquivos = OrderedDict()
+        self.max_arquivos = max_arquivos
+        self.trava = threading.Lock()
+
+    def guardar_arquivo(self, conteudo: bytes, nome: str) -> dict:
+        if not conteudo:
+            raise ValueError("Envie o conteúdo do arquivo no corpo da requisição.")
+        ident = hashlib.sha1(conteudo).hexdigest()
+        with self.trava:
+            self.arquivos[ident] = (nome or ident, conteudo)
+            self.arquivos.move_to_end(ident)
+            while len(self.arquivos) > self.max_arquivos:
+                self.arquivos.popitem(last=False)
+        return {"id": ident, "nome": nome, "bytes": len(conteudo)}
+
+    def _abrir_arquivo(self, ident: str):
+        with self.trava:
+            if ident not in self.arquivos:
+                raise ArquivoNaoEncontrado(ident)
+            nome, conteudo = self.arquivos[ident]
+        arquivo = io.BytesIO(conteudo)
+        arquivo.name = nome
+        return arquivo
+
+    def executar(self, alvos, pedido: dict) -> dict:
+        entradas = {"regras": carregar_regras()}
+        for chave, valor in pedido.items():
+            if chave.startswith("arquivo_") and valor:
+                entradas[chave] = self._abrir_arquivo(valor)
+        if pedido.get("parametros_validacao"):
+            entradas["parametros_validacao"] = pedido["parametros_validacao"]
+        if pedido.get("data_cadfi") and "arquivo_cadfi" not in entradas:
+            entradas["data_cadfi"] = data_iso(pedido["data_cadfi"])
+            entradas["linha_do_tempo_cadfi"] = carregar_linha_do_tempo()
+        entradas["motor"] = pedido.get("motor") or self.motor
+        perfil = nova_pasta_perfil(self.perfil) if self.perfil else None
+        return self.pool.submit(executar_etapas, alvos, entradas, cache=self.cache, perfil=perfil).result()
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+def criar_servidor_api(host: str = "127.0.0.1", porta: int = 8765, workers: int = 4, perfil=None,
+                       motor: Optional[str] = None) -> ServidorApi:
+    """Cria o servidor (porta 0 = porta livre qualquer; veja `servidor.server_address`)."""
+    return ServidorApi((host, porta), workers=workers, perfil=perfil, motor=motor)
+
+
+# ======================== Vigia de pasta (processamento automático) ========================
+# `python app.py vigiar <pasta> --saida <pasta>`: a cada `intervalo` segundos procura na pasta os
+# arquivos do mês (pelo nome), detecta os novos/alterados pelo hash do conteúdo e roda só as etapas
+# afetadas (o cache de etapas vive enquanto o processo estiver de pé). Cada execução grava os
+# relatórios numa pasta versionada junto com um manifesto.json.
+
+# entrada do pipeline -> (trechos do nome normalizado, extensões aceitas); a ordem importa
+PADROES_ARQUIVOS_PASTA = {
+    "arquivo_balancete": (("balancete",), (".xlsx", ".pdf")),
+    "arquivo_cda": (("cda",), (".xlsx",)),
+    "arquivo_controle": (("controle",), (".xlsx", ".xls")),
+    "arquivo_cadfi": (("cadfi", "cad_fi"), (".xlsx",)),
+}
+
+ARQUIVO_ESTADO_VIGIA = ".estado_vigia.json"
 
-        # 🔎 STATUS (NOVO): próximo valor após "Status:"
-        if up.startswith("STATUS"):
-            val = linhas[i + 1].strip() if (i + 1) < n else ""
-            if val:
-                current["status"] = val
-            i += 2
+def classificar_arquivo_por_nome(nome: str) -> Optional[str]:
+    """Qual entrada do pipeline o arquivo parece ser (pelo nome), ou None."""
+    nome = Path(nome).name
+    if nome.startswith(("~$", ".")):  # temporários do Excel / ocultos
+        return None
+    chave = _norm_header_key(nome)
+    for entrada, (trechos, extensoes) in PADROES_ARQUIVOS_PASTA.items():
+        if nome.lower().endswith(extensoes) and any(t in chave for t in trechos):
+            return entrada
+    return None
+
+def varrer_pasta(pasta, hashes: Optional[dict] = None, estabilidade: float = 5.0) -> Dict[str, dict]:
+    """
+    Devolve {entrada: {'arquivo', 'sha1', 'bytes'}} com o arquivo mais recente de cada tipo
+    (pelo nome ou, se o nome não disser, pelo conteúdo).
+    `hashes` (caminho -> (mtime_ns, tamanho, sha1)) evita re-hashear o que não mudou; arquivos
+    alterados há menos de `estabilidade` segundos ficam para a próxima volta (ainda copiando).
+    """
+    hashes = {} if hashes is None else hashes
+    agora = time.time()
+    encontrados = {}
+    for caminho in sorted(Path(pasta).iterdir()):
+        if not caminho.is_file() or caminho.name.startswith(("~$", ".")):
+            continue
+        entrada = classificar_arquivo_por_nome(caminho.name)
+        if entrada is None and caminho.suffix.lower() not in (".xlsx", ".xls", ".pdf"):
             continue
+        info = caminho.stat()
+        if agora - info.st_mtime < estabilidade:
+            continue
+        assinatura = (info.st_mtime_ns, info.st_size)
+        if entrada is None:
+            # nome não diz nada: classifica pelo conteúdo (só o começo do arquivo, 1x por versão)
+            tipo_cache = hashes.get(f"tipo:{caminho}")
+            if not tipo_cache or tipo_cache[0] != assinatura:
+                tipo_cache = (assinatura, ENTRADA_POR_TIPO.get(classificar_arquivo(caminho)["tipo"]))
+                hashes[f"tipo:{caminho}"] = tipo_cache
+            entrada = tipo_cache[1]
+            if entrada is None:
+                continue
+        anterior = hashes.get(str(caminho))
+        if not anterior or anterior[:2] != assinatura:
+            anterior = (*assinatura, hashlib.sha1(caminho.read_bytes()).hexdigest())
+            hashes[str(caminho)] = anterior
+        atual = encontrados.get(entrada)
+        if atual is None or info.st_mtime_ns > atual["mtime_ns"]:
+            encontrados[entrada] = {"arquivo": str(caminho), "sha1": anterior[2],
+                                    "bytes": info.st_size, "mtime_ns": info.st_mtime_ns}
+    return encontrados
+
+def _relatorios_da_execucao(resultado: dict, parametros_validacao: Optional[dict]) -> Dict[str, Tuple[str, pd.DataFrame]]:
+    """nome base do arquivo -> (nome da aba, DF), com os mesmos nomes dos downloads da interface."""
+    relatorios = {}
+    if "batimento" in resultado:
+        b = resultado["batimento"]
+        relatorios["Relatorio_Fundos_Em_Ambos"] = ("Relatorio", b["rel_comum"])
+        relatorios["Relatorio_Fundos_Somente_no_CadFi"] = ("Relatorio", b["rel_fora"])
+        relatorios["Relatorio_Fundos_Somente_no_Controle"] = ("Relatorio", b["rel_controle_fora"])
+    if "cnpjs_invalidos" in resultado:
+        relatorios["Relatorio_CNPJs_Invalidos"] = ("CNPJs_Invalidos", resultado["cnpjs_invalidos"])
+    if "conciliacao" in resultado:
+        relatorios["Relatorio_Conciliacao_Nomes"] = ("Conciliacao", resultado["conciliacao"])
+    if "auditoria_regras" in resultado:
+        relatorios["Relatorio_Auditoria_Regras_CadFi"] = ("Auditoria_Regras", resultado["auditoria_regras"])
+    if "rel_cda" in resultado:
+        relatorios["Batimento do CDA"] = ("Em_Ambos_com_CDA", resultado["rel_cda"])
+    if "rel_balancete" in resultado:
+        relatorios["Batimento do CDA e do Balancete"] = ("Batimento do CDA e do Balancete",
+                                                         resultado["rel_balancete"])
+    if "divergencias" in resultado:
+        titulo = f"Divergencias_Competencia_{parametros_validacao['alvo'].replace('/', '-')}"
+        relatorios[f"{titulo}_linhas"] = ("Divergencias_Linhas", resultado["validacao"])
+        relatorios[f"{titulo}_fundos"] = ("Consolidado_Fundos", resultado["divergencias"]["consolidado"])
+    return relatorios
+
+def processar_entradas_da_pasta(encontrados: Dict[str, dict], saida, formato: str = "xlsx",
+                                parametros_validacao: Optional[dict] = None, cache: Optional[dict] = None,
+                                progresso=None, perfil: bool = False, motor: Optional[str] = None,
+                                historico: bool = True) -> Path:
+    """
+    Roda as etapas possíveis com os arquivos encontrados e grava relatórios + manifesto numa pasta nova.
+    Com `historico`, a execução também entra no banco do histórico (ver registrar_no_historico) e
+    o CadFi vira um snapshot da linha do tempo, datado pelo nome do arquivo (ou pela modificação).
+    """
+    inicio = time.time()
+    entradas = {"regras": carregar_regras(), "motor": motor or MOTOR_PADRAO}
+    for entrada, info in encontrados.items():
+        arquivo = io.BytesIO(Path(info["arquivo"]).read_bytes())
+        arquivo.name = Path(info["arquivo"]).name
+        entradas[entrada] = arquivo
+
+    # só o que dá para calcular com os arquivos presentes (passo 2 precisa do 1, e assim por diante)
+    alvos = []
+    if {"arquivo_cadfi", "arquivo_controle"} <= entradas.keys():
+        alvos += ["batimento", "cnpjs_invalidos", "conciliacao", "auditoria_regras"]
+        if "arquivo_cda" in entradas:
+            alvos.append("rel_cda")
+            if "arquivo_balancete" in entradas:
+                alvos.append("rel_balancete")
+                if parametros_validacao:
+                    entradas["parametros_validacao"] = parametros_validacao
+                    alvos += ["validacao", "divergencias"]
+
+    digest = hashlib.sha1("|".join(f"{k}={v['sha1']}" for k, v in sorted(encontrados.items())).encode()).hexdigest()
+    pasta_versao = Path(saida) / f"{time.strftime('%Y-%m-%d_%H%M%S')}_{digest[:8]}"
+    pasta_versao.mkdir(parents=True, exist_ok=True)
+    manifesto = {
+        "versao": pasta_versao.name,
+        "inicio": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(inicio)),
+        "regras_versao": entradas["regras"]["versao"],
+        "entradas": {k: {"arquivo": Path(v["arquivo"]).name, "sha1": v["sha1"], "bytes": v["bytes"]}
+                     for k, v in sorted(encontrados.items())},
+        "parametros_validacao": parametros_validacao,
+        "motor": entradas["motor"],
+        "etapas": {},
+        "relatorios": {},
+    }
+    if perfil:
+        manifesto["perfil"] = "perfil"
+    try:
+        if not alvos:
+            raise ValueError("Faltam arquivos: o 1º passo precisa do CadFi e do Controle FIC.")
+        resultado = executar_etapas(alvos, entradas, cache=cache, progresso=progresso, registro=manifesto["etapas"],
+                                    perfil=pasta_versao / "perfil" if perfil else None)
+        for nome_base, (aba, df) in _relatorios_da_execucao(resultado, parametros_validacao).items():
+            nome = nome_arquivo_relatorio(nome_base, formato)
+            escrever_relatorio(df, pasta_versao / nome, formato, sheet_name=aba)
+            manifesto["relatorios"][nome] = len(df)
+        if "divergencias" in resultado:
+            manifesto["resumo_divergencias"] = resultado["divergencias"]["resumo"]
+        if historico:
+            try:
+                manifesto["historico_execucao"] = registrar_no_historico(
+                    resultado, pasta_versao.name, parametros_validacao, origem="vigia",
+                    regras_versao=manifesto["regras_versao"])
+            except sqlite3.Error as e:  # histórico fora do ar não invalida os relatórios gravados
+                manifesto["erro_historico"] = f"{type(e).__name__}: {e}"
+            try:
+                cadfi = encontrados["arquivo_cadfi"]
+                data = data_no_nome(cadfi["arquivo"]) or data_iso(datetime.fromtimestamp(cadfi["mtime_ns"] / 1e9))
+                df_cadfi = executar_etapas(["cadfi"], entradas, cache=cache)["cadfi"]  # já no cache
+                manifesto["linha_do_tempo_cadfi"] = registrar_snapshot_cadfi(df_cadfi, data)
+            except (sqlite3.Error, ValueError) as e:
+                manifesto["erro_linha_do_tempo"] = f"{type(e).__name__}: {e}"
+    except Exception as e:
+        manifesto["erro"] = f"{type(e).__name__}: {e}"
+    manifesto["duracao_s"] = round(time.time() - inicio, 3)
+    (pasta_versao / "manifesto.json").write_text(
+        json.dumps(manifesto, ensure_ascii=False, indent=2, default=_json_padrao), encoding="utf-8")
+    return pasta_versao
+
+def vigiar_pasta(pasta, saida, intervalo: float = 30.0, formato: str = "xlsx",
+                 parametros_validacao: Optional[dict] = None, estabilidade: float = 5.0,
+                 parar: Optional[threading.Event] = None, uma_vez: bool = False, log=print,
+                 perfil: bool = False, motor: Optional[str] = None, historico: bool = True) -> None:
+    """
+    Laço do vigia. Processa quando o conjunto de arquivos (pelos hashes) ou as regras mudam em
+    relação à última execução — guardada em <saida>/.estado_vigia.json, então reiniciar o vigia
+    não reprocessa o mesmo mês. `parar` (Event) encerra o laço; `uma_vez` faz uma varredura só.
+    """
+    pasta, saida = Path(pasta), Path(saida)
+    saida.mkdir(parents=True, exist_ok=True)
+    arquivo_estado = saida / ARQUIVO_ESTADO_VIGIA
+    try:
+        ultima = json.loads(arquivo_estado.read_text(encoding="utf-8")).get("assinatura")
+    except (OSError, ValueError):
+        ultima = None
+    parar = parar or threading.Event()
+    hashes, cache = {}, novo_cache_etapas()
+    aviso_anterior = None
+
+    while not parar.is_set():
+        try:
+            encontrados = varrer_pasta(pasta, hashes, estabilidade)
+            regras = carregar_regras()
+            if aviso_regras() and aviso_regras() != aviso_anterior:
+                log(aviso_regras())
+            aviso_anterior = aviso_regras()
+            assinatura = {"regras": regras["versao"], "validacao": parametros_validacao,
+                          **{k: v["sha1"] for k, v in encontrados.items()}}
+            if encontrados and assinatura != ultima:
+                mudou = sorted(k for k in assinatura if assinatura[k] != (ultima or {}).get(k))
+                log(f"Mudança detectada em {', '.join(mudou)} — processando…")
+                pasta_versao = processar_entradas_da_pasta(encontrados, saida, formato, parametros_validacao, cache,
+                                                           perfil=perfil, motor=motor, historico=historico)
+                manifesto = json.loads((pasta_versao / "manifesto.json").read_text(encoding="utf-8"))
+                recalculadas = [e for e, s in manifesto["etapas"].items() if s == "calculada"]
+                log(f"{'Erro: ' + manifesto['erro'] if 'erro' in manifesto else 'Relatórios gravados'} "
+                    f"em {pasta_versao} (etapas recalculadas: {', '.join(recalculadas) or 'nenhuma'})")
+                ultima = assinatura
+                arquivo_estado.write_text(json.dumps({"assinatura": ultima, "versao": pasta_versao.name}),
+                                          encoding="utf-8")
+        except (OSError, ValueError) as e:
+            log(f"Falha ao varrer {pasta}: {e}")
+        if uma_vez:
+            break
+        parar.wait(intervalo)
+
+# ======================== Histórico de execuções (SQLite) ========================
+# Cada execução completa (vigia, interface ou `historico importar`) grava seus relatórios num
+# banco SQLite local, com índices por CNPJ, COD GFI e competência, para consultas ad hoc sobre
+# vários meses sem reabrir planilhas:
+#
+#   python app.py historico consultar "SELECT ... FROM balancete_hist WHERE ..."
+#
+# Tabelas: execucoes (uma linha por execução; competencia = MM/AAAA auditado, competencia_ord =
+# AAAA-MM para ordenar), batimento, cda, balancete, divergencias (todas com execucao_id), e as
+# visões *_hist, que já trazem a competência da execução em cada linha.
+import sqlite3
+
+ARQUIVO_HISTORICO = Path(os.environ.get("BATIMENTO_HISTORICO", Path(__file__).with_name("historico.sqlite")))
+
+_TRAVA_HISTORICO = objeto_do_processo("trava_historico", threading.Lock)
+
+ESQUEMA_HISTORICO = """
+CREATE TABLE IF NOT EXISTS execucoes (
+    id INTEGER PRIMARY KEY,
+    chave TEXT UNIQUE NOT NULL,
+    registrada_em TEXT NOT NULL,
+    origem TEXT,
+    competencia TEXT,
+    competencia_ord TEXT,
+    regras_versao TEXT,
+    parametros TEXT
+);
+CREATE TABLE IF NOT EXISTS batimento (
+    execucao_id INTEGER NOT NULL REFERENCES execucoes(id) ON DELETE CASCADE,
+    relatorio TEXT NOT NULL,        -- em_ambos | somente_cadfi | somente_controle
+    cnpj TEXT, nome TEXT, cod_gfi TEXT
+);
+CREATE TABLE IF NOT EXISTS cda (
+    execucao_id INTEGER NOT NULL REFERENCES execucoes(id) ON DELETE CASCADE,
+    cnpj TEXT, nome TEXT, cod_gfi TEXT, protocolo TEXT, competencia TEXT, status TEXT
+);
+CREATE TABLE IF NOT EXISTS balancete (
+    execucao_id INTEGER NOT NULL REFERENCES execucoes(id) ON DELETE CASCADE,
+    cnpj TEXT, nome TEXT, cod_gfi TEXT, protocolo TEXT, competencia TEXT, status TEXT
+);
+CREATE TABLE IF NOT EXISTS divergencias (
+    execucao_id INTEGER NOT NULL REFERENCES execucoes(id) ON DELETE CASCADE,
+    cnpj TEXT, nome TEXT, origem TEXT, competencia_atual TEXT, competencia_esperada TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_execucoes_competencia ON execucoes (competencia_ord);
+CREATE INDEX IF NOT EXISTS ix_batimento_execucao ON batimento (execucao_id, relatorio);
+CREATE INDEX IF NOT EXISTS ix_batimento_cnpj ON batimento (cnpj);
+CREATE INDEX IF NOT EXISTS ix_batimento_cod_gfi ON batimento (cod_gfi);
+CREATE INDEX IF NOT EXISTS ix_cda_execucao ON cda (execucao_id);
+CREATE INDEX IF NOT EXISTS ix_cda_cnpj ON cda (cnpj);
+CREATE INDEX IF NOT EXISTS ix_cda_cod_gfi ON cda (cod_gfi);
+CREATE INDEX IF NOT EXISTS ix_cda_competencia ON cda (competencia, status);
+CREATE INDEX IF NOT EXISTS ix_balancete_execucao ON balancete (execucao_id);
+CREATE INDEX IF NOT EXISTS ix_balancete_cnpj ON balancete (cnpj);
+CREATE INDEX IF NOT EXISTS ix_balancete_cod_gfi ON balancete (cod_gfi);
+CREATE INDEX IF NOT EXISTS ix_balancete_competencia ON balancete (competencia, status);
+CREATE INDEX IF NOT EXISTS ix_divergencias_execucao ON divergencias (execucao_id, origem);
+CREATE INDEX IF NOT EXISTS ix_divergencias_cnpj ON divergencias (cnpj);
+CREATE VIEW IF NOT EXISTS batimento_hist AS
+    SELECT e.competencia AS competencia_execucao, e.competencia_ord, t.* FROM batimento t JOIN execucoes e ON e.id = t.execucao_id;
+CREATE VIEW IF NOT EXISTS cda_hist AS
+    SELECT e.competencia AS competencia_execucao, e.competencia_ord, t.* FROM cda t JOIN execucoes e ON e.id = t.execucao_id;
+CREATE VIEW IF NOT EXISTS balancete_hist AS
+    SELECT e.competencia AS competencia_execucao, e.competencia_ord, t.* FROM balancete t JOIN execucoes e ON e.id = t.execucao_id;
+CREATE VIEW IF NOT EXISTS divergencias_hist AS
+    SELECT e.competencia AS competencia_execucao, e.competencia_ord, t.* FROM divergencias t JOIN execucoes e ON e.id = t.execucao_id;
+"""
+
+# Perguntas frequentes (a interface oferece como ponto de partida)
+CONSULTAS_HISTORICO = {
+    "Execuções registradas": (
+        "SELECT id, competencia, origem, registrada_em, regras_versao FROM execucoes "
+        "ORDER BY competencia_ord DESC, id DESC"
+    ),
+    "COD GFI com Balancete 'Não possui' nas últimas 6 competências": (
+        "SELECT cod_gfi, cnpj, MAX(nome) AS nome, COUNT(DISTINCT competencia_ord) AS competencias,\n"
+        "       GROUP_CONCAT(DISTINCT competencia_execucao) AS em\n"
+        "FROM balancete_hist\n"
+        "WHERE status = 'Não possui'\n"
+        "  AND competencia_ord IN (SELECT DISTINCT competencia_ord FROM execucoes\n"
+        "                          WHERE competencia_ord IS NOT NULL ORDER BY competencia_ord DESC LIMIT 6)\n"
+        "GROUP BY cod_gfi, cnpj ORDER BY competencias DESC, cod_gfi"
+    ),
+    "Fundos com divergência em mais de uma competência": (
+        "SELECT cnpj, MAX(nome) AS nome, COUNT(DISTINCT competencia_ord) AS competencias\n"
+        "FROM divergencias_hist GROUP BY cnpj HAVING competencias > 1 ORDER BY competencias DESC"
+    ),
+    "Histórico de um CNPJ": (
+        "SELECT competencia_execucao, 'CDA' AS origem, protocolo, competencia, status FROM cda_hist WHERE cnpj = '00.000.000/0000-00'\n"
+        "UNION ALL\n"
+        "SELECT competencia_execucao, 'Balancete', protocolo, competencia, status FROM balancete_hist WHERE cnpj = '00.000.000/0000-00'\n"
+        "ORDER BY 1"
+    ),
+}
+
+def abrir_historico(banco=None, somente_leitura: bool = False) -> sqlite3.Connection:
+    """Conexão com o banco do histórico (criado na primeira escrita). Leitura nunca altera o arquivo."""
+    caminho = Path(banco or ARQUIVO_HISTORICO)
+    if somente_leitura:
+        if not caminho.exists():
+            raise ValueError(f"Histórico ainda vazio ({caminho}): nenhuma execução registrada.")
+        conexao = sqlite3.connect(f"{caminho.resolve().as_uri()}?mode=ro", uri=True, timeout=30,
+                                  check_same_thread=False)
+        conexao.execute("PRAGMA query_only = 1")
+        return conexao
+    caminho.parent.mkdir(parents=True, exist_ok=True)
+    conexao = sqlite3.connect(str(caminho), timeout=30, check_same_thread=False)
+    conexao.execute("PRAGMA journal_mode = WAL")  # leitores não bloqueiam o vigia gravando
+    conexao.execute("PRAGMA foreign_keys = ON")
+    conexao.executescript(ESQUEMA_HISTORICO + ESQUEMA_LINHA_DO_TEMPO)
+    return conexao
+
+def _competencia_da_execucao(resultado: dict, parametros_validacao: Optional[dict]) -> Optional[str]:
+    """MM/AAAA auditado: o alvo da validação ou, sem ela, a competência mais comum do CDA/Balancete."""
+    if parametros_validacao and parametros_validacao.get("alvo"):
+        return _extrair_mm_aaaa(parametros_validacao["alvo"])
+    for chave, coluna in (("rel_cda", "CDA_Competencia"), ("rel_balancete", "Balancete_Competencia"),
+                          ("rel_balancete", "CDA_Competencia")):
+        df = resultado.get(chave)
+        if isinstance(df, pd.DataFrame) and coluna in df.columns:
+            meses = df[coluna].dropna().astype(str).map(_extrair_mm_aaaa).dropna()
+            if not meses.empty:
+                return meses.mode().iloc[0]
+    return None
+
+def _linhas_sql(df: pd.DataFrame, colunas) -> list:
+    """Tuplas (texto ou None) das colunas pedidas; coluna ausente vira None."""
+    series = [df[c].astype(object).where(df[c].notna(), None) if c in df.columns else [None] * len(df)
+              for c in colunas]
+    return [tuple(None if v is None else str(v) for v in linha) for linha in zip(*series)]
+
+def registrar_no_historico(resultado: dict, chave: str, parametros_validacao: Optional[dict] = None,
+                           origem: str = "", regras_versao: Optional[str] = None, banco=None) -> Optional[int]:
+    """
+    Grava os relatórios de uma execução (saída de executar_etapas). `chave` identifica a execução
+    (hash das entradas): registrar de novo a mesma chave não duplica nada. Devolve o id da execução.
+    """
+    competencia = _competencia_da_execucao(resultado, parametros_validacao)
+    competencia_ord = f"{competencia[3:]}-{competencia[:2]}" if competencia else None
+    with _TRAVA_HISTORICO:
+        conexao = abrir_historico(banco)
+        try:
+            with conexao:
+                cursor = conexao.execute(
+                    "INSERT OR IGNORE INTO execucoes (chave, registrada_em, origem, competencia, competencia_ord,"
+                    " regras_versao, parametros) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (chave, time.strftime("%Y-%m-%dT%H:%M:%S"), origem, competencia, competencia_ord,
+                     regras_versao, json.dumps(parametros_validacao, ensure_ascii=False) if parametros_validacao else None))
+                if cursor.rowcount == 0:
+                    return conexao.execute("SELECT id FROM execucoes WHERE chave = ?", (chave,)).fetchone()[0]
+                ident = cursor.lastrowid
+
+                for relatorio, nome in (("em_ambos", "rel_comum"), ("somente_cadfi", "rel_fora"),
+                                        ("somente_controle", "rel_controle_fora")):
+                    df = (resultado.get("batimento") or {}).get(nome)
+                    if df is None:
+                        continue
+                    col_nome = "Nome do fundo (Controle)" if relatorio == "somente_controle" else "Nome do fundo"
+                    conexao.executemany(
+                        "INSERT INTO batimento VALUES (?, ?, ?, ?, ?)",
+                        [(ident, relatorio, *linha) for linha in _linhas_sql(df, ["CNPJ", col_nome, "COD GFI"])])
+
+                base_cda = resultado.get("rel_cda")
+                if base_cda is None:
+                    base_cda = resultado.get("rel_balancete")
+                for tabela, df, prefixo in (("cda", base_cda, "CDA"), ("balancete", resultado.get("rel_balancete"), "Balancete")):
+                    if df is None or f"{prefixo}_Status" not in df.columns:
+                        continue
+                    colunas = ["CNPJ", "Nome do fundo", "COD GFI",
+                               f"{prefixo}_Protocolo", f"{prefixo}_Competencia", f"{prefixo}_Status"]
+                    conexao.executemany(f"INSERT INTO {tabela} VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                        [(ident, *linha) for linha in _linhas_sql(df, colunas)])
+
+                df = resultado.get("validacao")
+                if df is not None and not df.empty:
+                    colunas = ["CNPJ", "Nome do fundo", "Origem", "Competência atual", "Competência esperada"]
+                    conexao.executemany("INSERT INTO divergencias VALUES (?, ?, ?, ?, ?, ?)",
+                                        [(ident, *linha) for linha in _linhas_sql(df, colunas)])
+            # estatísticas para o planejador usar os índices: ANALYZE de todas as tabelas só na primeira gravação;
+            # depois, PRAGMA optimize (refaz só o que ficou velho) com amostragem limitada, fora da transação
+            conexao.execute("PRAGMA analysis_limit = 1000")
+            sem_estatisticas = conexao.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone() is None
+            conexao.execute("ANALYZE" if sem_estatisticas else "PRAGMA optimize")
+            return ident
+        finally:
+            conexao.close()
+
+def consultar_historico(sql: str, parametros=(), banco=None) -> Tuple[pd.DataFrame, float]:
+    """Roda uma consulta (somente leitura) no histórico. Devolve (resultado, milissegundos)."""
+    conexao = abrir_historico(banco, somente_leitura=True)
+    try:
+        inicio = time.perf_counter()
+        try:
+            cursor = conexao.execute(sql, parametros)
+        except sqlite3.Error as e:
+            raise ValueError(f"Consulta inválida: {e}") from e
+        colunas = [d[0] for d in cursor.description or ()]
+        df = pd.DataFrame(cursor.fetchall(), columns=colunas)
+        return df, (time.perf_counter() - inicio) * 1000
+    finally:
+        conexao.close()
+
+def alvos_do_historico(entradas: dict) -> list:
+    """Etapas a registrar com a validação: as que de fato rodaram (relatórios reenviados cortam a cadeia)."""
+    alvos = ["rel_balancete", "validacao", "divergencias"]
+    if entradas.get("arquivo_rel_cda") is None:
+        alvos.append("rel_cda")
+        if entradas.get("arquivo_rel_ambos") is None:
+            alvos.append("batimento")
+    return alvos
+
+def chave_execucao(entradas: dict) -> str:
+    """Identifica uma execução pelas entradas (arquivos, regras e parâmetros), sem o motor."""
+    return hashlib.sha1("|".join(f"{k}={impressao_digital(v)}" for k, v in sorted(entradas.items())
+                                 if k != "motor" and v is not None).encode("utf-8")).hexdigest()
+
+# nome base do arquivo gravado pelo vigia -> onde o relatório entra no resultado
+_RELATORIOS_PARA_RESULTADO = {
+    "Relatorio_Fundos_Em_Ambos": ("batimento", "rel_comum"),
+    "Relatorio_Fundos_Somente_no_CadFi": ("batimento", "rel_fora"),
+    "Relatorio_Fundos_Somente_no_Controle": ("batimento", "rel_controle_fora"),
+    "Batimento do CDA": ("rel_cda", None),
+    "Batimento do CDA e do Balancete": ("rel_balancete", None),
+}
 
-        # Nº PROTOCOLO
-        if (up.startswith("Nº PROTOCOLO") or up.startswith("N° PROTOCOLO") or
-            up.startswith("NO PROTOCOLO") or up.startswith("Nº DO PROTOCOLO") or
-            up.startswith("N° DO PROTOCOLO")):
-            val = linhas[i + 1].strip() if (i + 1) < n else ""
-            current["protocolo"] = val[:-2] if val.endswith(".0") else val
-            i += 2
+def importar_historico(pasta_saida, banco=None, log=print) -> int:
+    """Registra no histórico as execuções já gravadas pelo vigia em `pasta_saida`. Devolve quantas."""
+    extensoes = sorted((ext for ext, _ in FORMATOS_EXPORTACAO.values()), key=len, reverse=True)
+    total = 0
+    for manifesto_arq in sorted(Path(pasta_saida).glob("*/manifesto.json")):
+        manifesto = json.loads(manifesto_arq.read_text(encoding="utf-8"))
+        if "erro" in manifesto:
             continue
+        resultado = {}
+        for nome_arquivo in manifesto.get("relatorios", {}):
+            base = next((nome_arquivo[:-len(ext)] for ext in extensoes if nome_arquivo.endswith(ext)), nome_arquivo)
+            arquivo = manifesto_arq.parent / nome_arquivo
+            if base in _RELATORIOS_PARA_RESULTADO:
+                chave, sub = _RELATORIOS_PARA_RESULTADO[base]
+                df = ler_relatorio(arquivo)
+                if sub:
+                    resultado.setdefault(chave, {})[sub] = df
+                else:
+                    resultado[chave] = df
+            elif base.startswith("Divergencias_Competencia_") and base.endswith("_linhas"):
+                resultado["validacao"] = ler_relatorio(arquivo)
+        registrar_no_historico(resultado, manifesto["versao"], manifesto.get("parametros_validacao"),
+                               origem="vigia", regras_versao=manifesto.get("regras_versao"), banco=banco)
+        total += 1
+        log(f"{manifesto['versao']}: registrada")
+    return total
+
+# ======================== Linha do tempo do CadFi ========================
+# Cada CadFi processado (vigia, 1º passo ou `python app.py cadfi registrar`) vira um snapshot
+# datado no banco do histórico. Por CNPJ, guardamos só as mudanças: listas paralelas de datas de
+# início (ordenadas) e estados — o estado é a tupla das linhas do fundo naquele CadFi (Denominação,
+# Administrador, Situação, Tipo), ou None quando o fundo não aparece. O estado numa data é um
+# bisect nas datas do fundo (O(log n)); o CadFi inteiro numa data alimenta o 1º passo "como era".
+# Depois do último snapshot vale o último estado conhecido; antes do primeiro, nada.
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime
+
+COLUNAS_LINHA_DO_TEMPO = ["Denominacao_Social", "Administrador", "Situacao", "Tipo_Fundo"]
+
+ESQUEMA_LINHA_DO_TEMPO = """
+CREATE TABLE IF NOT EXISTS cadfi_snapshots (
+    data TEXT PRIMARY KEY,          -- AAAA-MM-DD
+    sha1 TEXT NOT NULL,
+    registrado_em TEXT NOT NULL,
+    fundos INTEGER
+);
+CREATE TABLE IF NOT EXISTS cadfi_fundos (
+    cnpj TEXT PRIMARY KEY,
+    posicao INTEGER NOT NULL        -- ordem da primeira aparição (mantém a ordem do CadFi)
+);
+CREATE TABLE IF NOT EXISTS cadfi_intervalos (
+    cnpj TEXT NOT NULL,
+    inicio TEXT NOT NULL,
+    ordem INTEGER NOT NULL,         -- linha do fundo no CadFi (há CNPJ repetido)
+    presente INTEGER NOT NULL,
+    denominacao TEXT, administrador TEXT, situacao TEXT, tipo_fundo TEXT,
+    PRIMARY KEY (cnpj, inicio, ordem)
+) WITHOUT ROWID;
+"""
+
+_TRAVA_LINHA_DO_TEMPO = objeto_do_processo("trava_linha_do_tempo", threading.Lock)
+_LINHAS_DO_TEMPO = objeto_do_processo("linhas_do_tempo", dict)  # caminho do banco -> linha do tempo carregada (por versão)
+
+def data_iso(valor) -> str:
+    """'AAAA-MM-DD' a partir de date/datetime, 'DD/MM/AAAA', 'AAAA-MM-DD' ou 'AAAAMMDD'."""
+    if isinstance(valor, datetime):
+        return valor.date().isoformat()
+    if isinstance(valor, date):
+        return valor.isoformat()
+    texto = str(valor or "").strip()
+    for formato in ("%d/%m/%Y", "%Y-%m-%d", "%Y%m%d"):
+        try:
+            return datetime.strptime(texto, formato).date().isoformat()
+        except ValueError:
+            pass
+    raise ValueError(f"Data inválida: '{valor}' (use DD/MM/AAAA ou AAAA-MM-DD).")
 
-        i += 1
+def data_no_nome(nome) -> Optional[str]:
+    """Data no nome do arquivo (cad_fi_20250831.xlsx, CadFi 2025-08-31.xlsx), se houver."""
+    m = _RE["data_no_nome"].search(Path(str(nome)).name)
+    if not m:
+        return None
+    try:
+        return data_iso("".join(m.groups()))
+    except ValueError:
+        return None
 
-    # Flush final
-    if current["cnpj"] and current["protocolo"]:
-        flush()
+def nova_linha_do_tempo() -> dict:
+    return {"datas": [], "digests": {}, "fundos": {}, "versao": ""}
 
-    if not registros:
-        return pd.DataFrame(columns=["CNPJ", "Balancete_Protocolo", "Balancete_Competencia", "Balancete_Status"])
+def _versao_linha_do_tempo(digests: dict) -> str:
+    return hashlib.sha1("|".join(f"{d}={s}" for d, s in sorted(digests.items())).encode()).hexdigest()[:12]
 
-    df = pd.DataFrame(registros).drop_duplicates("CNPJ", keep="first").reset_index(drop=True)
-    return df
+def _estados_do_snapshot(df: pd.DataFrame) -> Dict[str, tuple]:
+    """CNPJ formatado -> tupla das linhas do fundo (na ordem do arquivo); CNPJ inválido fica de fora."""
+    faltantes = set(COLUNAS_LINHA_DO_TEMPO + ["CNPJ_Fundo"]) - set(df.columns)
+    if faltantes:
+        raise ValueError(f"Colunas ausentes no CadFi: {faltantes}")
+    cnpjs = _cnpj_formatado(df["CNPJ_Fundo"])
+    colunas = [df[c].astype(object).where(df[c].notna(), None) for c in COLUNAS_LINHA_DO_TEMPO]
+    estados = {}
+    for cnpj, *linha in zip(cnpjs.astype(object), *colunas):
+        if isinstance(cnpj, str):
+            estados.setdefault(cnpj, []).append(tuple(linha))
+    return {cnpj: tuple(linhas) for cnpj, linhas in estados.items()}
+
+def _estado_fundo(fundo: dict, data: str):
+    i = bisect_right(fundo["inicios"], data) - 1
+    return fundo["estados"][i] if i >= 0 else None
+
+def _fixar_estado(fundo: dict, data: str, estado) -> None:
+    i = bisect_left(fundo["inicios"], data)
+    if i < len(fundo["inicios"]) and fundo["inicios"][i] == data:
+        fundo["estados"][i] = estado
+    else:
+        fundo["inicios"].insert(i, data)
+        fundo["estados"].insert(i, estado)
+
+def _compactar_fundo(fundo: dict) -> None:
+    """Tira começos repetidos (mesmo estado do intervalo anterior) e ausências iniciais."""
+    inicios, estados, anterior = [], [], None
+    for inicio, estado in zip(fundo["inicios"], fundo["estados"]):
+        if estado != anterior:
+            inicios.append(inicio)
+            estados.append(estado)
+            anterior = estado
+    fundo["inicios"], fundo["estados"] = inicios, estados
+
+def adicionar_snapshot_cadfi(linha: dict, df: pd.DataFrame, data, sha1: Optional[str] = None) -> set:
+    """
+    Incorpora um CadFi (já lido) visto em `data`. Aceita snapshots fora de ordem (o intervalo
+    seguinte continua valendo a partir do snapshot seguinte) e substitui um da mesma data.
+    Só troca as listas dos fundos alterados (quem já leu a linha do tempo não vê meia mudança).
+    Devolve os CNPJs cuja linha do tempo mudou.
+    """
+    data = data_iso(data)
+    sha1 = sha1 or impressao_digital(df)
+    if linha["digests"].get(data) == sha1:
+        return set()
+    estados = _estados_do_snapshot(df)
+    i = bisect_right(linha["datas"], data)
+    proxima = linha["datas"][i] if i < len(linha["datas"]) else None
+
+    afetados = set()
+    vazio = {"inicios": [], "estados": []}
+    for cnpj in list(linha["fundos"]) + [c for c in estados if c not in linha["fundos"]]:
+        atual = linha["fundos"].get(cnpj, vazio)
+        novo = estados.get(cnpj)
+        if _estado_fundo(atual, data) == novo:
+            continue  # nada muda nem nesta data nem no snapshot seguinte
+        fundo = {"inicios": list(atual["inicios"]), "estados": list(atual["estados"])}
+        if proxima is not None:
+            _fixar_estado(fundo, proxima, _estado_fundo(fundo, proxima))
+        _fixar_estado(fundo, data, novo)
+        _compactar_fundo(fundo)
+        linha["fundos"][cnpj] = fundo
+        afetados.add(cnpj)
+
+    if data not in linha["digests"]:
+        linha["datas"].insert(bisect_left(linha["datas"], data), data)
+    linha["digests"][data] = sha1
+    linha["versao"] = _versao_linha_do_tempo(linha["digests"])
+    return afetados
+
+def estado_em(linha: dict, cnpj, data) -> Optional[tuple]:
+    """Linhas (Denominação, Administrador, Situação, Tipo) do fundo no CadFi em `data`, ou None."""
+    fundo = linha["fundos"].get(formatar_cnpj(cnpj))
+    return _estado_fundo(fundo, data_iso(data)) if fundo else None
+
+def cadfi_na_data(linha: dict, data) -> pd.DataFrame:
+    """O CadFi como era em `data` (mesmas colunas que o 1º passo lê do arquivo)."""
+    if not linha["datas"]:
+        raise ValueError("Linha do tempo do CadFi vazia: registre ao menos um CadFi antes.")
+    data = data_iso(data)
+    if data < linha["datas"][0]:
+        raise ValueError(f"Não há CadFi registrado até {data} (o primeiro é de {linha['datas'][0]}).")
+    cnpjs, linhas = [], []
+    for cnpj, fundo in linha["fundos"].items():
+        for registro in _estado_fundo(fundo, data) or ():
+            cnpjs.append(cnpj)
+            linhas.append(registro)
+    df = pd.DataFrame(linhas, columns=COLUNAS_LINHA_DO_TEMPO)
+    df.insert(0, "CNPJ_Fundo", cnpjs)
+    return compactar_dtypes(df.astype(TIPO_TEXTO))
+
+def linha_do_tempo_fundo(linha: dict, cnpj) -> pd.DataFrame:
+    """Intervalos do fundo: uma linha por (intervalo, registro no CadFi); 'Fim' vazio = ainda vale."""
+    fundo = linha["fundos"].get(formatar_cnpj(cnpj)) or {"inicios": [], "estados": []}
+    linhas = []
+    for i, (inicio, estado) in enumerate(zip(fundo["inicios"], fundo["estados"])):
+        fim = fundo["inicios"][i + 1] if i + 1 < len(fundo["inicios"]) else None
+        for registro in estado or ((None,) * len(COLUNAS_LINHA_DO_TEMPO),):
+            linhas.append((inicio, fim, estado is not None, *registro))
+    return pd.DataFrame(linhas, columns=["Inicio", "Fim", "No_CadFi"] + COLUNAS_LINHA_DO_TEMPO)
+
+def movimentos_universo_fic(linha: dict, de, ate, regras: Optional[dict] = None) -> pd.DataFrame:
+    """Fundos que entraram ou saíram do universo FIC (filtrar_cadfi) entre as datas `de` e `ate`."""
+    antes = filtrar_cadfi(cadfi_na_data(linha, de), regras)
+    depois = filtrar_cadfi(cadfi_na_data(linha, ate), regras)
+    entrou = depois[~depois["CNPJ"].isin(antes["CNPJ"])]
+    saiu = antes[~antes["CNPJ"].isin(depois["CNPJ"])]
+    colunas = ["CNPJ", "Denominacao_Social", "Administrador", "Situacao", "Tipo_Fundo"]
+    movimentos = pd.concat([entrou[colunas].assign(Movimento="Entrou"), saiu[colunas].assign(Movimento="Saiu")],
+                           ignore_index=True)
+    # situação do outro lado: como estava quem entrou (em `de`) e como ficou quem saiu (em `ate`)
+    def situacao(cnpj, quando):
+        estado = estado_em(linha, cnpj, quando)
+        return "; ".join(f"{r[2]} ({r[1]})" for r in estado) if estado else "Fora do CadFi"
+    movimentos["CadFi_Outra_Data"] = [situacao(c, de if m == "Entrou" else ate)
+                                      for c, m in zip(movimentos["CNPJ"], movimentos["Movimento"])]
+    return movimentos
+
+def registrar_snapshot_cadfi(df: pd.DataFrame, data, banco=None, sha1: Optional[str] = None) -> dict:
+    """Acrescenta um CadFi à linha do tempo gravada. Devolve {'data', 'fundos_alterados', 'versao'}."""
+    data = data_iso(data)
+    sha1 = sha1 or impressao_digital(df)
+    with _TRAVA_LINHA_DO_TEMPO:
+        gravada = carregar_linha_do_tempo(banco)
+        if gravada["digests"].get(data) == sha1:
+            return {"data": data, "fundos_alterados": 0, "versao": gravada["versao"]}
+        # cópia rasa: a linha publicada só é trocada depois de gravar no banco
+        linha = {"datas": list(gravada["datas"]), "digests": dict(gravada["digests"]),
+                 "fundos": dict(gravada["fundos"]), "versao": gravada["versao"]}
+        afetados = adicionar_snapshot_cadfi(linha, df, data, sha1)
+        conexao = abrir_historico(banco)
+        try:
+            with conexao:
+                conexao.executemany("DELETE FROM cadfi_intervalos WHERE cnpj = ?", [(c,) for c in afetados])
+                conexao.executemany(
+                    "INSERT INTO cadfi_intervalos VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(cnpj, inicio, ordem, estado is not None, *registro)
+                     for cnpj in afetados
+                     for inicio, estado in zip(linha["fundos"][cnpj]["inicios"], linha["fundos"][cnpj]["estados"])
+                     for ordem, registro in enumerate(estado or ((None,) * len(COLUNAS_LINHA_DO_TEMPO),))])
+                posicao = conexao.execute("SELECT COALESCE(MAX(posicao), -1) + 1 FROM cadfi_fundos").fetchone()[0]
+                novos = [c for c in linha["fundos"] if c in afetados and c not in gravada["fundos"]]
+                conexao.executemany("INSERT OR IGNORE INTO cadfi_fundos VALUES (?, ?)",
+                                    [(c, posicao + i) for i, c in enumerate(novos)])
+                conexao.execute("INSERT OR REPLACE INTO cadfi_snapshots VALUES (?, ?, ?, ?)",
+                                (data, sha1, time.strftime("%Y-%m-%dT%H:%M:%S"),
+                                 sum(1 for f in linha["fundos"].values() if _estado_fundo(f, data))))
+        finally:
+            conexao.close()
+        _LINHAS_DO_TEMPO[str(Path(banco or ARQUIVO_HISTORICO))] = linha
+        return {"data": data, "fundos_alterados": len(afetados), "versao": linha["versao"]}
+
+def _snapshots_gravados(banco=None) -> Dict[str, str]:
+    if not Path(banco or ARQUIVO_HISTORICO).exists():
+        return {}
+    conexao = abrir_historico(banco)
+    try:
+        return dict(conexao.execute("SELECT data, sha1 FROM cadfi_snapshots").fetchall())
+    finally:
+        conexao.close()
+
+def carregar_linha_do_tempo(banco=None) -> dict:
+    """Linha do tempo gravada, lida uma vez por processo (e de novo só se outro processo a alterar)."""
+    caminho = str(Path(banco or ARQUIVO_HISTORICO))
+    digests = _snapshots_gravados(banco)
+    versao = _versao_linha_do_tempo(digests) if digests else ""
+    linha = _LINHAS_DO_TEMPO.get(caminho)
+    if linha is not None and linha["versao"] == versao:
+        return linha
+    linha = nova_linha_do_tempo()
+    if digests:
+        conexao = abrir_historico(banco)
+        try:
+            cursor = conexao.execute(
+                "SELECT i.cnpj, i.inicio, i.presente, i.denominacao, i.administrador, i.situacao, i.tipo_fundo"
+                " FROM cadfi_intervalos i JOIN cadfi_fundos f ON f.cnpj = i.cnpj"
+                " ORDER BY f.posicao, i.inicio, i.ordem")
+            for cnpj, inicio, presente, *registro in cursor:
+                fundo = linha["fundos"].setdefault(cnpj, {"inicios": [], "estados": []})
+                if not fundo["inicios"] or fundo["inicios"][-1] != inicio:
+                    fundo["inicios"].append(inicio)
+                    fundo["estados"].append(() if presente else None)
+                if presente:
+                    fundo["estados"][-1] += (tuple(registro),)
+        finally:
+            conexao.close()
+        linha["datas"], linha["digests"], linha["versao"] = sorted(digests), digests, versao
+    _LINHAS_DO_TEMPO[caminho] = linha
+    return linha
+
+# --- Benchmark dos motores (`python app.py bench ...`)
+def _conteudo_relatorio(df: pd.DataFrame, formato: str) -> bytes:
+    """Bytes do relatório sem os carimbos de data (criação do xlsx, mtime do gzip)."""
+    dados = relatorio_bytes(df, formato).getvalue()
+    if formato == "csv.gz":
+        import gzip
+        return gzip.decompress(dados)
+    if formato == "xlsx":
+        with zipfile.ZipFile(io.BytesIO(dados)) as z:
+            return b"".join(z.read(n) for n in sorted(z.namelist()) if n != "docProps/core.xml")
+    return dados
+
+def comparar_motores(entradas: dict, alvos, repeticoes: int = 3, motores=None) -> dict:
+    """
+    Lê os arquivos uma vez (etapas que não dependem do motor) e cronometra, para cada motor, as
+    etapas que dependem dele, `repeticoes` vezes sem cache. Confere também se os relatórios saem
+    iguais byte a byte em todos os formatos.
+    Devolve {'tempos': {motor: {etapa: [segundos, ...]}}, 'identicos': {'relatorio/formato': bool}}.
+    """
+    motores = motores or motores_disponiveis()
+
+    do_motor, mudou = set(), True
+    while mudou:
+        mudou = False
+        for nome, (deps, _, _) in ETAPAS_BATIMENTO.items():
+            partes = {p for d in deps for p in d.split("|")}
+            if nome not in do_motor and partes & (do_motor | {"motor"}):
+                do_motor.add(nome)
+                mudou = True
+    necessarias, pilha = set(), list(alvos)
+    while pilha:
+        nome = pilha.pop()
+        if nome in ETAPAS_BATIMENTO and nome not in necessarias:
+            necessarias.add(nome)
+            pilha += [_resolver_dependencia(d, entradas) for d in ETAPAS_BATIMENTO[nome][0]]
+    comum = novo_cache_etapas(max_itens=256)
+    executar_etapas(sorted(necessarias - do_motor), entradas, cache=comum)
+
+    tempos, saidas = {}, {}
+    for motor in motores:
+        tempos[motor] = {}
+        def cronometrar(nome, funcao, medidas=tempos[motor]):
+            def rodar(*args, progresso=None):
+                inicio = time.perf_counter()
+                valor = funcao(*args, progresso=progresso)
+                medidas.setdefault(nome, []).append(time.perf_counter() - inicio)
+                return valor
+            return rodar
+        etapas = {nome: (deps, cronometrar(nome, funcao), desc)
+                  for nome, (deps, funcao, desc) in ETAPAS_BATIMENTO.items()}
+        for _ in range(repeticoes):
+            cache = novo_cache_etapas(max_itens=256)
+            cache["itens"].update(comum["itens"])
+            resultado = executar_etapas(alvos, {**entradas, "motor": motor}, cache=cache, etapas=etapas)
+        saidas[motor] = _relatorios_da_execucao(resultado, entradas.get("parametros_validacao"))
+
+    identicos = {}
+    for nome, (_, df) in saidas[motores[0]].items():
+        for formato in FORMATOS_EXPORTACAO:
+            base = _conteudo_relatorio(df, formato)
+            identicos[f"{nome}/{formato}"] = all(
+                _conteudo_relatorio(saidas[m][nome][1], formato) == base for m in motores[1:])
+    return {"tempos": tempos, "identicos": identicos}
+
+def medir_reexecucao(repeticoes: int = 20) -> dict:
+    """
+    Custo fixo de um rerun do Streamlit fora do main(): re-executa este arquivo `repeticoes` vezes
+    (sem rodar a interface nem o CLI) e mede também a montagem das tabelas fixas, que só acontece
+    na primeira execução do processo. Tempos em ms.
+    """
+    import statistics
+    inicio = time.perf_counter()
+    codigo = compile(Path(__file__).read_text(encoding="utf-8"), __file__, "exec")
+    compilacao = time.perf_counter() - inicio
+    inicio = time.perf_counter()
+    _montar_tabelas()
+    tabelas = time.perf_counter() - inicio
+    tempos = []
+    for _ in range(max(1, repeticoes)):
+        inicio = time.perf_counter()
+        exec(codigo, {"__name__": "_medicao_rerun", "__file__": __file__})
+        tempos.append(time.perf_counter() - inicio)
+    return {"compilacao_ms": compilacao * 1000, "tabelas_ms": tabelas * 1000,
+            "reexecucao_ms": statistics.median(tempos) * 1000, "reexecucao_max_ms": max(tempos) * 1000}
+
+# --- Teste de carga (`python app.py carga ...`)
+# Cliente sem interface que faz o que cada sessão do Streamlit faz nos quatro passos: cópia dos
+# uploads, conferência do tipo, pipeline no pool compartilhado (como o pool_tarefas), downloads no
+# formato escolhido e registro no histórico. N sessões rodam ao mesmo tempo, numa única instância,
+# para achar o ponto em que a leitura das planilhas e a escrita dos .xlsx saturam a CPU.
+# (O AppTest não serve aqui: ele recria o runtime global a cada run e não roda em paralelo.)
+def gerar_entradas_sinteticas(pasta, fundos: int = 3000, semente: int = 1) -> dict:
+    """
+    Grava em `pasta` CadFi, Controle FIC e protocolos de CDA e Balancete sintéticos (CNPJs com DV
+    válido, ~metade no Controle, alguns inválidos) e devolve {entrada do pipeline: caminho}.
+    """
+    rng = np.random.default_rng(semente)
+    pasta = Path(pasta)
+    pasta.mkdir(parents=True, exist_ok=True)
+    base = rng.integers(0, 10, size=(fundos, 12))
+    base[:, 8:12] = [0, 0, 0, 1]
+    dv1 = base @ PESOS_DV1_CNPJ % 11
+    dv1 = np.where(dv1 < 2, 0, 11 - dv1)
+    dig = np.column_stack([base, dv1])
+    dv2 = dig @ PESOS_DV2_CNPJ % 11
+    dig = np.column_stack([dig, np.where(dv2 < 2, 0, 11 - dv2)])
+    cnpjs = formatar_cnpjs(pd.Series(["".join(map(str, linha)) for linha in dig], dtype=TIPO_TEXTO)).tolist()
+    regras = REGRAS_PADRAO["cadfi"]
+    nomes = np.array(["BB FIC RENDA FIXA", "BB ACOES", "BB FUNDO DE INVESTIMENTO EM COTAS", "BB MULTIMERCADO FC"])
+
+    cadfi = pd.DataFrame({
+        "CNPJ_Fundo": cnpjs,
+        "Denominação_Social": [f"{n} {i}" for i, n in enumerate(rng.choice(nomes, fundos))],
+        "Administrador": rng.choice([regras["administradores"][0], "OUTRO ADMINISTRADOR S.A"], fundos, p=[.8, .2]),
+        "Situação": rng.choice([regras["situacoes"][0], "Cancelado"], fundos, p=[.85, .15]),
+        "Tipo_Fundo": rng.choice([regras["tipos_fundo"][0], "FII"], fundos, p=[.9, .1]),
+    })
+    no_controle = np.flatnonzero(rng.random(fundos) < .5)
+    controle = pd.DataFrame({
+        "Fundos": [f"BB FUNDO {i}" for i in no_controle],
+        # ~1% com o último dígito trocado (caem nos CNPJs inválidos / conciliação)
+        "CNPJ": [c[:-1] + str((int(c[-1]) + 1) % 10) if rng.random() < .01 else c for c in np.take(cnpjs, no_controle)],
+        "COD GFI": [str(1000 + i) for i in no_controle],
+        "SIT": rng.choice(list("AAAAIPT"), len(no_controle)),
+    })
 
-def parse_protocolo_balancete_from_pdf(uploaded_pdf) -> pd.DataFrame:
-    text = _read_text_from_pdf(uploaded_pdf)
-    if not text:
-        return pd.DataFrame(columns=["CNPJ", "Balancete_Protocolo", "Balancete_Competencia", "Balancete_Status"])
-
-    pattern_cnpj = re.compile(r"(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})")
-    pattern_proto = re.compile(r"(?:N[º°]\s*PROTOCOLO|PROTOCOLO)\D*(\d{6,})", flags=re.I)
-    pattern_comp_mm_yyyy = re.compile(r"(\b\d{2}/\d{4}\b)")
-    pattern_status = re.compile(r"STATUS:\s*([\s\S]{0,40}?)(?:\r?\n|\r)", flags=re.I)  # captura linha após "Status:"
-
-    registros = []
-    for m in pattern_cnpj.finditer(text):
-        cnpj_masked = m.group(1)
-        start = m.start()
-
-        window = text[start:start+600]
-        proto_m = pattern_proto.search(window)
-        protocolo = proto_m.group(1) if proto_m else ""
-
-        prev_window = text[max(0, start-400):start+200]
-        comp_m = pattern_comp_mm_yyyy.search(prev_window)
-        competencia = comp_m.group(1) if comp_m else ""
-
-        status_m = pattern_status.search(prev_window) or pattern_status.search(window)
-        status_txt = status_m.group(1).strip() if status_m else ""
-
-        cnpj_num = normaliza_cnpj(cnpj_masked)
-        if cnpj_num:
-            registros.append({
-                "CNPJ": formatar_cnpj(cnpj_num),
-                "Balancete_Protocolo": protocolo,
-                "Balancete_Competencia": competencia,
-                "Balancete_Status": status_txt
-            })
+    def protocolo(indices, tipo, com_arquivo):
+        linhas = []
+        for i in indices:
+            mm = rng.choice(["07", "08"])
+            linhas += ["Protocolo de Confirmação", "Participante:", f"FUNDO {i}", cnpjs[i],
+                       "Tipo do Participante:", "FI", "Informe:", tipo, "Competência:", f"{mm}/2025",
+                       "Status:", "Ativo", "Data Ação:", "05/09/2025 10:00:00"]
+            if com_arquivo:
+                linhas += ["Nome do Arquivo", f"{tipo}_{cnpjs[i]}_{mm}2025.xml"]
+            linhas += ["Nº Protocolo", str(500000 + i)]
+        return pd.DataFrame({"linha": linhas})
+
+    caminhos = {"arquivo_cadfi": pasta / "cadfi.xlsx", "arquivo_controle": pasta / "controle.xlsx",
+                "arquivo_cda": pasta / "cda.xlsx", "arquivo_balancete": pasta / "balancete.xlsx"}
+    cadfi.to_excel(caminhos["arquivo_cadfi"], index=False)
+    controle.to_excel(caminhos["arquivo_controle"], index=False)
+    protocolo(range(0, fundos, 3), "CDA", False).to_excel(caminhos["arquivo_cda"], index=False, header=False)
+    protocolo(range(0, fundos, 4), "BALANCETE", True).to_excel(caminhos["arquivo_balancete"], index=False, header=False)
+    return {k: str(v) for k, v in caminhos.items()}
+
+def _tamanho_bytes(obj, vistos=None) -> int:
+    """Memória aproximada do que uma sessão guarda (DataFrames com deep=True, bytes, uploads)."""
+    vistos = set() if vistos is None else vistos
+    if id(obj) in vistos:
+        return 0
+    vistos.add(id(obj))
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True, deep=True).sum())
+    if isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    if hasattr(obj, "getbuffer"):
+        return obj.getbuffer().nbytes
+    if isinstance(obj, dict):
+        return sum(_tamanho_bytes(v, vistos) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(_tamanho_bytes(v, vistos) for v in obj)
+    return sys.getsizeof(obj)
+
+def _rss_pico_mib() -> Optional[float]:
+    """Pico de memória residente do processo (MiB), ou None se a plataforma não informa."""
+    try:
+        import resource
+        pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return pico / 2**20 if sys.platform == "darwin" else pico / 1024  # bytes no macOS, KiB no Linux
+    except ImportError:  # Windows
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss) / 2**20
+    except ImportError:
+        return None
 
-    if not registros:
-        return pd.DataFrame(columns=["CNPJ", "Balancete_Protocolo", "Balancete_Competencia", "Balancete_Status"])
+def _sessao_de_carga(arquivos: dict, pool, cache, formato: str, banco) -> dict:
+    """Uma sessão da interface, do 1º ao 4º passo. Devolve os tempos (s) por passo e o estado final."""
+    def upload(entrada):
+        copia = io.BytesIO(Path(arquivos[entrada]).read_bytes())
+        copia.name = Path(arquivos[entrada]).name
+        return arquivo_em_memoria(copia)
+
+    entradas = {"motor": MOTOR_PADRAO, "regras": carregar_regras()}
+    downloads, tempos = {}, {}
+    passos = [
+        ("passo1", {"arquivo_cadfi": "cadfi", "arquivo_controle": "controle"},
+         ["batimento", "cnpjs_invalidos", "conciliacao", "auditoria_regras"]),
+        ("passo2", {"arquivo_cda": "protocolo_cda"}, ["rel_cda"]),
+        ("passo3", {"arquivo_balancete": "protocolo_balancete"}, ["rel_balancete", "balancete"]),
+        ("passo4", {}, None),
+    ]
+    for passo, uploads, alvos in passos:
+        inicio = time.perf_counter()
+        for entrada, tipo in uploads.items():
+            entradas[entrada] = upload(entrada)
+            conferir_tipo_arquivo(entradas[entrada], tipo)
+        if passo == "passo4":
+            entradas["parametros_validacao"] = {"modo": "mes_ano", "alvo": "08/2025", "contar_nao_possui": True}
+            alvos = alvos_do_historico(entradas)
+        resultado = pool.submit(executar_etapas, alvos, dict(entradas), cache=cache).result()
+        if passo == "passo1":
+            bat = resultado["batimento"]
+            relatorios = {"zip": gerar_zip_relatorios(bat["rel_comum"], bat["rel_fora"], bat["rel_controle_fora"],
+                                                      formato=formato),
+                          "invalidos": resultado["cnpjs_invalidos"], "conciliacao": resultado["conciliacao"],
+                          "auditoria": resultado["auditoria_regras"]}
+        elif passo == "passo4":
+            registrar_no_historico(resultado, chave_execucao(entradas), entradas["parametros_validacao"],
+                                   origem="carga", regras_versao=entradas["regras"]["versao"], banco=banco)
+            div = resultado["divergencias"]
+            relatorios = {"linhas": resultado["validacao"], "fundos": div["consolidado"], **div["segmentos"]}
+        else:
+            relatorios = {passo: resultado[alvos[0]]}
+        for nome, df in relatorios.items():
+            dados = df if hasattr(df, "getvalue") else relatorio_bytes(df, formato)
+            downloads[f"{passo}/{nome}"] = dados.getvalue() if hasattr(dados, "getvalue") else dados
+        tempos[passo] = time.perf_counter() - inicio
+    return {"tempos": tempos, "estado": {"entradas": entradas, "resultado": resultado, "downloads": downloads}}
+
+def teste_de_carga(arquivos: dict, sessoes: int, workers: int = 4, formato: str = "xlsx",
+                   cache_compartilhado: bool = False, banco=None) -> dict:
+    """
+    Roda `sessoes` sessões ao mesmo tempo contra uma instância (pool de `workers` tarefas, como o
+    pool_tarefas da interface). Cada sessão tem seu próprio cache de etapas — como analistas com
+    arquivos diferentes —, a menos que `cache_compartilhado`. Devolve latências (s) por passo e
+    da sessão inteira, CPU média (em núcleos ocupados), pico de RSS (None se indisponível) e
+    memória por sessão (MiB, com o cache próprio; o compartilhado sai à parte em memoria_cache_mib).
+    """
+    import tempfile
 
-    df = pd.DataFrame(registros).drop_duplicates(subset="CNPJ", keep="first").reset_index(drop=True)
-    return df
+    cache_comum = novo_cache_etapas() if cache_compartilhado else None
+    banco = banco or Path(tempfile.mkdtemp(prefix="batimento_carga_")) / "historico.sqlite"
+    carregar_regras()
+    resultados, erros = [], []
+
+    def rodar():
+        inicio = time.perf_counter()
+        cache = cache_comum or novo_cache_etapas()
+        try:
+            r = _sessao_de_carga(arquivos, pool, cache, formato, banco)
+        except Exception as e:  # uma sessão com erro não derruba as outras
+            erros.append(f"{type(e).__name__}: {e}")
+            return
+        r["tempos"]["sessao"] = time.perf_counter() - inicio
+        estado = r.pop("estado")
+        if cache_comum is None:  # o cache próprio é a maior parte do que a sessão guarda
+            estado["cache"] = cache["itens"]
+        r["memoria"] = _tamanho_bytes(estado)
+        resultados.append(r)
+
+    cpu, parede = time.process_time(), time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="carga_pool") as pool, \
+            ThreadPoolExecutor(max_workers=sessoes, thread_name_prefix="carga_sessao") as clientes:
+        for futuro in [clientes.submit(rodar) for _ in range(sessoes)]:
+            futuro.result()
+    parede = time.perf_counter() - parede
+
+    latencias = {}
+    for passo in ("passo1", "passo2", "passo3", "passo4", "sessao"):
+        valores = np.array([r["tempos"][passo] for r in resultados]) if resultados else np.array([np.nan])
+        latencias[passo] = {"p50": float(np.percentile(valores, 50)), "p90": float(np.percentile(valores, 90)),
+                            "p99": float(np.percentile(valores, 99)), "max": float(np.max(valores))}
+    memorias = [r["memoria"] / 2**20 for r in resultados] or [float("nan")]
+    return {
+        "sessoes": sessoes, "concluidas": len(resultados), "erros": erros, "duracao": parede,
+        "latencias": latencias,
+        "cpu_nucleos": (time.process_time() - cpu) / parede,
+        "rss_pico_mib": _rss_pico_mib(),
+        "memoria_sessao_mib": float(np.mean(memorias)),
+        "memoria_cache_mib": _tamanho_bytes(cache_comum["itens"]) / 2**20 if cache_comum else None,
+    }
 
 
 # ========================== INTERFACE STREAMLIT ==========================
-st.set_page_config(page_title="Batimento de Fundos - CadFi x Controle FIC",page_icon="banco_do_brasil_amarelo.ico", layout="centered")
+# Cache das etapas do pipeline: um por processo, compartilhado pelas tarefas e pelos reruns
+@st.cache_resource
+def cache_etapas():
+    return novo_cache_etapas()
+
+# Ícone da aba: o .ico vira PNG uma vez por processo. Com o caminho do .ico, o set_page_config
+# decodifica e recodifica a imagem (256px) a cada rerun — era o maior custo de um rerun parado.
+@st.cache_resource
+def icone_pagina(caminho: str = "banco_do_brasil_amarelo.ico"):
+    try:
+        from PIL import Image
+        with Image.open(caminho) as img:
+            buf = io.BytesIO()
+            img.save(buf, format="PNG")
+        return buf.getvalue()
+    except Exception:
+        return caminho  # o Streamlit trata o texto como antes
 
-st.title("Batimento de Fundos — Contabilidade FIC")
-st.subheader("📊 1° - Batimento de Fundos — CadFi x Controle FIC")
-st.caption("Interface web dos Batimentos. Faça o upload dos dois arquivos e clique em **Processar**.")
+def entradas_pipeline(**novas) -> dict:
+    """
+    Atualiza as entradas do pipeline guardadas na sessão (valor None remove a entrada) e devolve
+    uma cópia. Cada passo só mexe nas suas; os seguintes reaproveitam as anteriores.
+    """
+    entradas = st.session_state.setdefault("entradas_pipeline", {})
+    for nome, valor in novas.items():
+        if valor is None:
+            entradas.pop(nome, None)
+        else:
+            entradas[nome] = valor
+    return dict(entradas)
+
+# Grades paginadas: só a página visível vai para o navegador. Rodam como fragmento, então
+# trocar de página ou buscar não re-executa o script inteiro (nem os botões de processamento).
+_fragmento = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda f: f)
+
+@_fragmento
+def grade_paginada(df, chave: str, tamanho_pagina: int = 50):
+    if df is None or df.empty:
+        st.dataframe(df, use_container_width=True, hide_index=True)
+        return
+    c_busca, c_pag = st.columns([3, 1])
+    with c_busca:
+        busca = st.text_input("Buscar por CNPJ ou COD GFI", key=f"{chave}_busca")
+    _, total, paginas = paginar_relatorio(df, busca, 1, tamanho_pagina)
+    # ajusta a página guardada antes de criar o widget (a busca pode ter reduzido o nº de páginas)
+    st.session_state[f"{chave}_pagina"] = min(st.session_state.get(f"{chave}_pagina", 1), paginas)
+    with c_pag:
+        pagina = st.number_input("Página", min_value=1, max_value=paginas, step=1, key=f"{chave}_pagina")
+    pagina_df, total, paginas = paginar_relatorio(df, busca, pagina, tamanho_pagina)
+    st.dataframe(pagina_df, use_container_width=True, hide_index=True)
+    st.caption(f"{total} linha(s) • página {pagina} de {paginas}")
+
+# Pool único por processo: sobrevive aos reruns; as tarefas ficam em st.session_state
+@st.cache_resource
+def pool_tarefas():
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="batimento")
+
+_fragmento_periodico = st.fragment(run_every=1) if hasattr(st, "fragment") else (lambda f: f)
+
+@_fragmento_periodico
+def painel_tarefa(chave: str):
+    """Mostra o andamento da tarefa `chave` e oferece cancelamento; ao terminar, força um rerun completo."""
+    tarefa = st.session_state.get(chave)
+    if not tarefa:
+        return
+    if tarefa["futuro"].done():
+        st.rerun()
+    est = tarefa["estado"]
+    decorrido = time.time() - tarefa["inicio"]
+    if est["total"]:
+        st.progress(min(1.0, est["feitos"] / est["total"]),
+                    text=f"{est['etapa']} — {est['feitos']}/{est['total']} ({decorrido:.0f}s)")
+    else:
+        st.progress(0.0, text=f"{est['etapa']}… ({decorrido:.0f}s)")
+    if tarefa["cancelar"].is_set():
+        st.caption("Cancelando…")
+    elif st.button("Cancelar", key=f"{chave}_cancelar"):
+        tarefa["cancelar"].set()
+
+def submeter_tarefa(chave: str, funcao, *args, descricao: str = "", impressao: Optional[str] = None,
+                    **kwargs) -> None:
+    """
+    Inicia a tarefa, a menos que já haja uma rodando nessa chave (nesse caso, só reanexa).
+    `impressao` (impressao_acao) vai junto para o resultado entrar no cache das ações.
+    """
+    atual = st.session_state.get(chave)
+    if atual and not atual["futuro"].done():
+        st.info("⏳ Já existe um processamento em andamento — acompanhando o atual.")
+        return
+    if st.session_state.get("perfilar"):
+        kwargs["perfil"] = nova_pasta_perfil()
+    st.session_state[chave] = iniciar_tarefa(pool_tarefas(), funcao, *args, descricao=descricao, **kwargs)
+    st.session_state[chave]["perfil"] = kwargs.get("perfil")
+    st.session_state[chave]["impressao"] = impressao
+
+def coletar_tarefa(chave: str):
+    """
+    Se a tarefa terminou, tira da sessão e devolve (True, resultado) — exceções da tarefa sobem
+    para o chamador. Se ainda roda, mostra o painel e devolve (False, None).
+    """
+    tarefa = st.session_state.get(chave)
+    if not tarefa:
+        return False, None
+    if not tarefa["futuro"].done():
+        painel_tarefa(chave)
+        return False, None
+    del st.session_state[chave]
+    if tarefa.get("perfil"):
+        mostrar_perfil(tarefa["perfil"])
+    try:
+        return True, tarefa["futuro"].result()
+    except TarefaCancelada:
+        st.warning("Processamento cancelado.")
+        return False, None
+
+# Cache das ações (botões dos passos): impressão da ação -> resultado e downloads já gerados.
+# Clicar de novo com as mesmas entradas serve daqui na hora, sem tarefa e sem regerar arquivos.
+@st.cache_resource
+def cache_acoes():
+    return novo_cache_etapas(max_itens=8)
+
+def buscar_acao(impressao: str) -> Optional[dict]:
+    cache = cache_acoes()
+    with cache["trava"]:
+        item = cache["itens"].get(impressao)
+        if item is not None:
+            cache["itens"].move_to_end(impressao)
+    return item
+
+def guardar_acao(impressao: Optional[str], resultado) -> dict:
+    """Item do cache das ações para o resultado ({'resultado', 'downloads', 'quando', 'impressao'})."""
+    item = {"resultado": resultado, "downloads": {}, "quando": time.time(), "impressao": impressao}
+    if impressao:
+        cache = cache_acoes()
+        with cache["trava"]:
+            cache["itens"][impressao] = item
+            cache["itens"].move_to_end(impressao)
+            while len(cache["itens"]) > cache["max_itens"]:
+                cache["itens"].popitem(last=False)
+    return item
+
+def acionar_passo(acao: str, alvos, entradas: dict, forcar: bool = False, descricao: str = "") -> None:
+    """
+    Clique no botão do passo: com a mesma impressão já no cache das ações, o resultado fica pronto
+    para este rerun; senão (ou com `forcar`), a tarefa vai para o pool.
+    """
+    impressao = impressao_acao(acao, alvos, entradas)
+    item = None if forcar else buscar_acao(impressao)
+    if item is not None:
+        st.session_state[f"servido_{acao}"] = item
+        return
+    submeter_tarefa(f"tarefa_{acao}", executar_etapas, alvos, entradas, cache=cache_etapas(),
+                    recalcular=forcar, impressao=impressao, descricao=descricao)
+
+def coletar_acao(acao: str):
+    """
+    Resultado do passo pronto neste rerun: (True, resultado, item, do_cache) — `item` é o do cache
+    das ações, que guarda os downloads gerados — ou (False, None, None, False).
+    """
+    item = st.session_state.pop(f"servido_{acao}", None)
+    if item is not None:
+        return True, item["resultado"], item, True
+    impressao = (st.session_state.get(f"tarefa_{acao}") or {}).get("impressao")
+    concluido, resultado = coletar_tarefa(f"tarefa_{acao}")
+    if not concluido:
+        return False, None, None, False
+    return True, resultado, guardar_acao(impressao, resultado), False
+
+def indicador_cache(acao: str, item: dict) -> None:
+    """Aviso de resultado servido do cache das ações, com o botão para forçar o recálculo."""
+    c_aviso, c_botao = st.columns([4, 1])
+    with c_aviso:
+        st.info(f"⚡ Servido do cache: mesmas entradas já processadas às "
+                f"{time.strftime('%H:%M:%S', time.localtime(item['quando']))} (impressão `{item['impressao'][:10]}`).")
+    with c_botao:
+        st.button("🔄 Recalcular", key=f"recalcular_{acao}", help="Ignora o cache e processa tudo de novo.",
+                  on_click=st.session_state.__setitem__, args=(f"forcar_{acao}", True))
+
+def bytes_download(downloads: Optional[dict], chave, gerar) -> bytes:
+    """Conteúdo de um download, gerado uma vez por item do cache das ações (`downloads` None: sempre gera)."""
+    if downloads is not None and chave in downloads:
+        return downloads[chave]
+    dados = gerar()
+    dados = dados.getvalue() if hasattr(dados, "getvalue") else dados
+    if downloads is not None:
+        downloads[chave] = dados
+    return dados
+
+def conferir_uploads(*pares) -> None:
+    """Classificação rápida dos uploads antes de enfileirar a tarefa: arquivo trocado falha na hora."""
+    for arquivo, esperado in pares:
+        if arquivo is None:
+            continue
+        try:
+            conferir_tipo_arquivo(arquivo, esperado)
+        except ValueError as e:
+            st.error(f"⚠️ {e}")
+            st.stop()
 
-col1, col2 = st.columns(2)
-with col1:
-    cadfi_file = st.file_uploader("Arquivo CadFi (.xlsx)", type=["xlsx"], accept_multiple_files=False)
-with col2:
-    controle_file = st.file_uploader("Arquivo Controle FIC (.xlsx)", type=["xlsx", "xls"], accept_multiple_files=False)
+def mostrar_perfil(pasta):
+    """Resumo do perfil por etapa + download dos relatórios (.prof/.txt) para anexar num chamado."""
+    pasta = Path(pasta)
+    resumo_arq = pasta / "perfil.json"
+    if not resumo_arq.exists():
+        st.caption("⏱️ Perfil: nenhuma etapa recalculada (tudo veio do cache).")
+        return
+    resumo = json.loads(resumo_arq.read_text(encoding="utf-8"))
+    with st.expander(f"⏱️ Perfil por etapa — {pasta.name}"):
+        st.dataframe(pd.DataFrame.from_dict(resumo, orient="index"), use_container_width=True)
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
+            for arq in sorted(pasta.iterdir()):
+                zipf.write(arq, arq.name)
+        st.download_button("⬇️ Baixar perfil (.zip)", data=buffer.getvalue(),
+                           file_name=f"perfil_{pasta.name}.zip", mime="application/zip",
+                           key=f"perfil_{pasta.name}")
+
+def botao_download_relatorio(label, df, nome_base, sheet_name="Relatorio", downloads: Optional[dict] = None):
+    formato_saida = st.session_state.get("formato_saida", "xlsx")
+    ext, mime = FORMATOS_EXPORTACAO[formato_saida]
+    st.download_button(
+        label,
+        data=bytes_download(downloads, (nome_base, formato_saida),
+                            lambda: relatorio_bytes(df, formato_saida, sheet_name=sheet_name)),
+        file_name=f"{nome_base}{ext}",
+        mime=mime,
+    )
 
-processar = st.button("Processar", type="primary")
+def pagina_historico():
+    """Consultas SQL sobre as execuções registradas (somente leitura)."""
+    st.title("Histórico de execuções")
+    st.caption(f"Banco: `{ARQUIVO_HISTORICO}` — tabelas `execucoes`, `batimento`, `cda`, `balancete`, "
+               "`divergencias` e as visões `*_hist` (com a competência de cada execução).")
+    exemplo = st.selectbox("Consultas prontas", list(CONSULTAS_HISTORICO), key="historico_exemplo")
+    sql = st.text_area("SQL", value=CONSULTAS_HISTORICO[exemplo], height=180, key=f"historico_sql_{exemplo}")
+    if st.button("Consultar", type="primary"):
+        try:
+            st.session_state["historico_resultado"] = consultar_historico(sql)
+        except ValueError as e:
+            st.error(str(e))
+            st.session_state.pop("historico_resultado", None)
+    if "historico_resultado" in st.session_state:
+        df, ms = st.session_state["historico_resultado"]
+        st.caption(f"{len(df)} linha(s) em {ms:.1f} ms")
+        grade_paginada(df, "grade_historico")
+        botao_download_relatorio("⬇️ Baixar resultado", df, "Consulta_Historico", sheet_name="Consulta")
+
+def main():
+    """Página do Streamlit (executada a cada rerun)."""
+    st.set_page_config(page_title="Batimento de Fundos - CadFi x Controle FIC",page_icon=icone_pagina(), layout="centered")
+    if st.sidebar.radio("Página", ("Batimento", "Histórico"), horizontal=True, key="pagina") == "Histórico":
+        pagina_historico()
+        return
+
+    st.title("Batimento de Fundos — Contabilidade FIC")
+    st.subheader("📊 1° - Batimento de Fundos — CadFi x Controle FIC")
+    st.caption("Interface web dos Batimentos. Faça o upload dos dois arquivos e clique em **Processar**.")
+
+    formato_saida = st.sidebar.selectbox(
+        "Formato dos relatórios",
+        list(FORMATOS_EXPORTACAO),
+        format_func=lambda f: {"xlsx": "Excel (.xlsx)", "csv.gz": "CSV compactado (.csv.gz)",
+                               "parquet": "Parquet (.parquet)"}[f],
+        help="Vale para todos os downloads. Relatórios em qualquer um desses formatos podem ser reenviados nos passos 2 e 3.",
+        key="formato_saida",
+    )
+    st.sidebar.checkbox("Perfilar etapas (cProfile/tracemalloc)", key="perfilar",
+                        help=f"Grava .prof e relatório de alocações por etapa em {PASTA_PERFIS}.")
+    motores = motores_disponiveis()
+    motor = st.sidebar.selectbox(
+        "Motor de cálculo", motores,
+        index=motores.index(MOTOR_PADRAO) if MOTOR_PADRAO in motores else 0,
+        help="Junções e validações em pandas ou Polars (multi-thread). Os relatórios saem idênticos.",
+        key="motor",
+    )
+    entradas_pipeline(motor=motor)
 
-if processar:
-    if not cadfi_file or not controle_file:
-        st.error("⚠️ Envie os dois arquivos (CadFi e Controle Espelho) antes de processar.")
+    # Regras de filtro: relidas só quando o arquivo muda; o parse dos arquivos enviados é uma etapa
+    # própria do pipeline e não depende das regras, então uma recarga não obriga a reler as planilhas.
+    try:
+        regras_ativas = carregar_regras()
+    except ValueError as e:
+        st.error(f"❌ {e}")
         st.stop()
+    if aviso_regras():
+        st.sidebar.warning(aviso_regras())
+    st.sidebar.caption(
+        f"Regras de filtro: `{Path(regras_ativas['arquivo']).name if regras_ativas['arquivo'] else 'padrão interno'}`"
+        f" — versão {regras_ativas['versao']}"
+    )
+
+    cadfi_passado = st.checkbox("Usar o CadFi de uma data passada (linha do tempo)", key="cadfi_passado",
+                                help="Monta o CadFi como era na data, a partir dos CadFi já processados.")
+    col1, col2 = st.columns(2)
+    with col1:
+        if cadfi_passado:
+            cadfi_file = None
+            data_cadfi = st.date_input("CadFi em", key="data_cadfi_passado", format="DD/MM/YYYY")
+        else:
+            cadfi_file = st.file_uploader("Arquivo CadFi (.xlsx)", type=["xlsx"], accept_multiple_files=False)
+            data_cadfi = st.date_input("Data de referência do CadFi", value=None, key="data_ref_cadfi",
+                                       format="DD/MM/YYYY",
+                                       help="Data do snapshot na linha do tempo. Vazio: a data no nome do arquivo ou hoje.")
+    with col2:
+        controle_file = st.file_uploader("Arquivo Controle FIC (.xlsx)", type=["xlsx", "xls"], accept_multiple_files=False)
+
+    processar = st.button("Processar", type="primary")
+    forcar = st.session_state.pop("forcar_passo1", False)
+
+    if processar or forcar:
+        if not (cadfi_file or cadfi_passado) or not controle_file:
+            st.error("⚠️ Envie os dois arquivos (CadFi e Controle Espelho) antes de processar.")
+            st.stop()
+
+        conferir_uploads((cadfi_file, "cadfi"), (controle_file, "controle"))
+        if cadfi_passado:
+            linha_do_tempo = carregar_linha_do_tempo()
+            if not linha_do_tempo["datas"] or data_iso(data_cadfi) < linha_do_tempo["datas"][0]:
+                st.error("⚠️ Não há CadFi registrado até essa data"
+                         + (f" (o primeiro é de {linha_do_tempo['datas'][0]})." if linha_do_tempo["datas"] else "."))
+                st.stop()
+            st.session_state.pop("snapshot_cadfi_pendente", None)
+            cadfi = {"arquivo_cadfi": None, "linha_do_tempo_cadfi": linha_do_tempo, "data_cadfi": data_iso(data_cadfi)}
+        else:
+            st.session_state["snapshot_cadfi_pendente"] = data_iso(
+                data_cadfi or data_no_nome(cadfi_file.name) or date.today())
+            cadfi = {"arquivo_cadfi": arquivo_em_memoria(cadfi_file), "linha_do_tempo_cadfi": None, "data_cadfi": None}
+        entradas = entradas_pipeline(**cadfi, arquivo_controle=arquivo_em_memoria(controle_file),
+                                     regras=regras_ativas)
+        acionar_passo("passo1", ["batimento", "cnpjs_invalidos", "conciliacao", "auditoria_regras"], entradas,
+                      forcar, descricao="Processando arquivos")
 
     try:
-        with st.spinner("Processando arquivos..."):
-            cadfi_raw = carregar_excel(cadfi_file)                    # mantém como está (xlsx)
-            cadfi_filtrado = filtrar_cadfi(cadfi_raw)
-
-            controle_prep = carregar_controle_fic(controle_file)
-
-            # APLICA FILTRO DE SIT A JAQUI (recomendado) — se a coluna não existir é noop
-            controle_prep = filtrar_controle_por_situacao(controle_prep)
-
-            # segue comparações com controle já restrito a SIT == 'A'
-            df_fora = comparar_cnpjs(cadfi_filtrado, controle_prep)
-            df_comum = comparar_fundos_em_comum(cadfi_filtrado, controle_prep)
-            df_controle_fora = comparar_controle_fora_cadfi(cadfi_filtrado, controle_prep)
-
-            df_controle_fora = filtrar_controle_por_situacao(df_controle_fora)
-            df_controle_fora = filtrar_controle_por_nome(df_controle_fora)
-
-            rel_fora = relatorio_fora_controle(df_fora)
-            rel_comum = relatorio_em_comum(df_comum)
-            rel_comum = remover_segundos_colunas(rel_comum, ["CDA_Protocolo", "CDA_Competencia"])
-            rel_controle_fora = relatorio_controle_fora_cadfi(df_controle_fora)
-
-            rel_comum = adicionar_drive_por_cnpj(rel_comum, controle_prep)
-            
-            if "COD GFI" in rel_comum.columns:
-                for _df_name in ("rel_comum", "rel_fora", "rel_controle_fora"):
-                    _df = locals()[_df_name]
-                    if "COD GFI" in _df.columns:
-                        cols = ["COD GFI"] + [c for c in _df.columns if c != "COD GFI"]
-                        locals()[_df_name] = _df[cols]
-            
-            rel_fora = adicionar_drive_por_cnpj(rel_fora, controle_prep)
-            rel_controle_fora = adicionar_drive_por_cnpj(rel_controle_fora, controle_prep)
+        concluido, resultado, item, do_cache = coletar_acao("passo1")
+        if concluido and st.session_state.get("snapshot_cadfi_pendente"):
+            # o CadFi lido entra na linha do tempo (sai do cache; mesmo conteúdo na mesma data não regrava)
+            data_snapshot = st.session_state.pop("snapshot_cadfi_pendente")
+            try:
+                df_cadfi = executar_etapas(["cadfi"], entradas_pipeline(), cache=cache_etapas())["cadfi"]
+                info = registrar_snapshot_cadfi(df_cadfi, data_snapshot)
+                st.caption(f"🕒 CadFi registrado na linha do tempo em {data_snapshot} "
+                           f"({info['fundos_alterados']} fundo(s) com mudança).")
+            except (sqlite3.Error, OSError, ValueError) as e:
+                st.warning(f"CadFi não registrado na linha do tempo: {e}")
+        if concluido:
+            if do_cache:
+                indicador_cache("passo1", item)
+            rel_comum = resultado["batimento"]["rel_comum"]
+            rel_fora = resultado["batimento"]["rel_fora"]
+            rel_controle_fora = resultado["batimento"]["rel_controle_fora"]
 
             st.session_state["rel_comum"] = rel_comum
             st.session_state["rel_fora"] = rel_fora
@@ -1430,26 +4297,50 @@ if processar:
             ]
 
             with st.expander("✅ Fundos presentes em AMBOS (CadFi e Controle)"):
-                st.dataframe(rel_comum, use_container_width=True, hide_index=True)
+                grade_paginada(rel_comum, "grade_comum")
 
             with st.expander("ℹ️ Fundos do Controle que NÃO estão no CadFi"):
-                st.dataframe(rel_controle_fora, use_container_width=True, hide_index=True)
+                grade_paginada(rel_controle_fora, "grade_controle_fora")
 
             with st.expander("❌ Fundos do CadFi que NÃO estão no Controle"):
-                st.dataframe(rel_fora, use_container_width=True, hide_index=True)
-
-            def gerar_zip_relatorios(rel_comum, rel_fora, rel_controle_fora):
-                zip_buffer = io.BytesIO()
-                with zipfile.ZipFile(zip_buffer, "w") as zipf:
-                    zipf.writestr("Relatorio_Fundos_Em_Ambos.xlsx", to_excel_bytes(rel_comum).getvalue())
-                    zipf.writestr("Relatorio_Fundos_Somente_no_CadFi.xlsx", to_excel_bytes(rel_fora).getvalue())
-                    zipf.writestr("Relatorio_Fundos_Somente_no_Controle.xlsx", to_excel_bytes(rel_controle_fora).getvalue())
-                zip_buffer.seek(0)
-                return zip_buffer
+                grade_paginada(rel_fora, "grade_fora")
+
+            invalidos = resultado["cnpjs_invalidos"]
+            if len(invalidos):
+                st.session_state["mensagens_batimento"].append(
+                    f"⚠️ CNPJ inválido (fora do batimento): {len(invalidos)} linha(s)")
+                with st.expander("⚠️ CNPJs inválidos — vazios ou com dígito verificador errado"):
+                    grade_paginada(invalidos, "grade_cnpjs_invalidos")
+                    botao_download_relatorio("⬇️ Baixar — CNPJs inválidos", invalidos,
+                                             "Relatorio_CNPJs_Invalidos", sheet_name="CNPJs_Invalidos",
+                                             downloads=item["downloads"])
+
+            conciliacao = resultado["conciliacao"]
+            sugeridos = int((conciliacao["Sugerido"] == "Sim").sum())
+            st.session_state["mensagens_batimento"].append(
+                f"🔗 Possíveis pares por nome (CNPJ ausente ou digitado errado): {sugeridos}")
+            with st.expander("🔗 Possíveis pares por nome — CNPJ ausente ou digitado errado"):
+                st.caption("Candidatos entre 'Fora do Controle' e 'Controle fora do CadFi' (e linhas sem CNPJ "
+                           "válido), pela semelhança dos nomes e dos CNPJs. 'Sugerido' = melhor par de cada fundo.")
+                grade_paginada(conciliacao, "grade_conciliacao")
+                botao_download_relatorio("⬇️ Baixar — Conciliação por nome", conciliacao,
+                                         "Relatorio_Conciliacao_Nomes", sheet_name="Conciliacao",
+                                         downloads=item["downloads"])
+
+            auditoria = resultado["auditoria_regras"]
+            with st.expander("🔎 Auditoria das regras de nome do CadFi"):
+                st.caption("Fundos que passaram nos filtros de administrador, situação e tipo: termo que os "
+                           "excluiu, termo de inclusão que casou e se entraram no batimento.")
+                grade_paginada(auditoria, "grade_auditoria_regras")
+                botao_download_relatorio("⬇️ Baixar — Auditoria das regras", auditoria,
+                                         "Relatorio_Auditoria_Regras_CadFi", sheet_name="Auditoria_Regras",
+                                         downloads=item["downloads"])
 
             st.download_button(
                 label="⬇️ Baixar TODOS os relatórios (.zip)",
-                data=gerar_zip_relatorios(rel_comum, rel_fora, rel_controle_fora),
+                data=bytes_download(item["downloads"], ("zip", formato_saida),
+                                    lambda: gerar_zip_relatorios(rel_comum, rel_fora, rel_controle_fora,
+                                                                 formato=formato_saida)),
                 file_name="Relatorios_Batimento_CadFi_Controle.zip",
                 mime="application/zip"
             )
@@ -1458,296 +4349,463 @@ if processar:
         st.error("❌ Erro ao processar os arquivos.")
         st.exception(e)
 
-# Exibe mensagens fixas fora do bloco de processamento
-if "mensagens_batimento" in st.session_state:
-    for msg in st.session_state["mensagens_batimento"]:
-        st.markdown(msg)
+    # Exibe mensagens fixas fora do bloco de processamento
+    if "mensagens_batimento" in st.session_state:
+        for msg in st.session_state["mensagens_batimento"]:
+            st.markdown(msg)
 
 
 
-# ========================== INTERFACE: CDA (Enriquecer "Em Ambos") ==========================
-st.markdown("---")
-st.subheader("📄 2° CDA — Enriquecer o relatório **Fundos em Ambos** com Protocolo/Competência")
+    # ========================== INTERFACE: CDA (Enriquecer "Em Ambos") ==========================
+    st.markdown("---")
+    st.subheader("📄 2° CDA — Enriquecer o relatório **Fundos em Ambos** com Protocolo/Competência")
 
-col_cda1, col_cda2 = st.columns(2)
-with col_cda1:
-    rel_ambos_file = st.file_uploader("Relatório — Fundos em Ambos (xlsx)", type=["xlsx"], key="rel_ambos_cda")
-with col_cda2:
-    cda_proto_file = st.file_uploader("Planilha de Protocolo do CDA (xlsx)", type=["xlsx"], key="cda_proto_file")
+    col_cda1, col_cda2 = st.columns(2)
+    with col_cda1:
+        rel_ambos_file = st.file_uploader("Relatório — Fundos em Ambos (xlsx, csv.gz ou parquet)",
+                                          type=TIPOS_RELATORIO_ENTRADA, key="rel_ambos_cda",
+                                          help="Opcional se o 1º passo foi processado nesta sessão.")
+    with col_cda2:
+        cda_proto_file = st.file_uploader("Planilha de Protocolo do CDA (xlsx)", type=["xlsx"], key="cda_proto_file")
 
-bt_cda = st.button("Preencher colunas do CDA", type="primary", key="btn_cda_process")
-
-if bt_cda:
-    if not rel_ambos_file or not cda_proto_file:
-        st.error("⚠️ Envie **os dois arquivos**: (1) Relatório 'Em Ambos' e (2) Protocolo do CDA.")
-        st.stop()
-    try:
-        with st.spinner("Lendo arquivos e integrando CDA..."):
-            df_ambos = pd.read_excel(rel_ambos_file, dtype=str)
-            df_ambos = padronizar_colunas(df_ambos)
-
-            if "CNPJ" not in df_ambos.columns:
-                st.error("O relatório 'Em Ambos' precisa ter a coluna 'CNPJ'.")
-                st.stop()
+    bt_cda = st.button("Preencher colunas do CDA", type="primary", key="btn_cda_process")
+    forcar = st.session_state.pop("forcar_passo2", False)
 
-            df_cda = parse_protocolos_cda_xlsx(cda_proto_file)
-            df_final = enriquecer_em_comum_com_cda(df_ambos, df_cda)
+    if bt_cda or forcar:
+        tem_passo1 = "arquivo_controle" in st.session_state.get("entradas_pipeline", {})
+        if not cda_proto_file or not (rel_ambos_file or tem_passo1):
+            st.error("⚠️ Envie **os dois arquivos**: (1) Relatório 'Em Ambos' e (2) Protocolo do CDA.")
+            st.stop()
+        # sem relatório reenviado, a base é o 'Em Ambos' do 1º passo
+        conferir_uploads((rel_ambos_file, "relatorio"), (cda_proto_file, "protocolo_cda"))
+        entradas = entradas_pipeline(arquivo_rel_ambos=arquivo_em_memoria(rel_ambos_file),
+                                     arquivo_cda=arquivo_em_memoria(cda_proto_file))
+        acionar_passo("passo2", ["rel_cda"], entradas, forcar, descricao="Lendo arquivos e integrando CDA")
 
+    try:
+        concluido, resultado, item, do_cache = coletar_acao("passo2")
+        if concluido:
+            if do_cache:
+                indicador_cache("passo2", item)
+            df_final = resultado["rel_cda"]
             tot = len(df_final)
             casados = df_final["CDA_Protocolo"].astype(str).str.strip().ne("Não possui").sum()
             st.success(f"✅ Encontramos protocolo do CDA para {casados} de {tot} fundos.")
-            
+
             st.session_state["mensagens_cda"] = [
                 f"✅ Encontramos protocolo do CDA para {casados} de {tot} fundos."
             ]
 
-
             with st.expander("🔎 Prévia do Batimento do CDA"):
-                st.dataframe(df_final, use_container_width=True, hide_index=True)
+                grade_paginada(df_final, "grade_cda")
 
-            st.download_button(
-                label="⬇️ Baixar — Batimento do CDA",
-                data=to_excel_bytes(df_final, sheet_name="Em_Ambos_com_CDA"),
-                file_name="Batimento do CDA.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            )
-            
+            botao_download_relatorio("⬇️ Baixar — Batimento do CDA", df_final,
+                                     "Batimento do CDA", sheet_name="Em_Ambos_com_CDA", downloads=item["downloads"])
+
+    except ValueError as e:
+        st.error(str(e))
     except Exception as e:
         st.exception(e)
-        
-if "mensagens_cda" in st.session_state:
-    for msg in st.session_state["mensagens_cda"]:
-        st.markdown(msg)
 
+    if "mensagens_cda" in st.session_state:
+        for msg in st.session_state["mensagens_cda"]:
+            st.markdown(msg)
 
-# ============================== Interface de Balancete ==============================
-st.markdown("## 🔄 3º - Enriquecer batimento com Balancete")
 
-colb1, colb2 = st.columns(2)
-with colb1:
-    relatorio_ambos_file = st.file_uploader(
-        "Arquivo Relatório de Ambos com CDA (.xlsx)",
-        type=["xlsx"],
-        key="relatorio_ambos"
-    )
-with colb2:
-    balancete_file = st.file_uploader(
-        "Arquivo de Balancete (XLSX ou PDF)",
-        type=["xlsx", "pdf"],
-        accept_multiple_files=False
-    )
-
-enriquecer = st.button("Preencher colunas Balancete", type="primary", key="btn_balancete_enriquecer")
-
-if enriquecer:
-    if not relatorio_ambos_file or not balancete_file:
-        st.error("⚠️ Envie os dois arquivos antes de enriquecer.")
-        st.stop()
-
-    try:
-        with st.spinner("Enriquecendo com Balancete..."):
-            # 1) Carrega relatório 'Em Ambos'
-            df_rel_comum = pd.read_excel(relatorio_ambos_file, dtype=str)
-            df_rel_comum = padronizar_colunas(df_rel_comum)
+    # ============================== Interface de Balancete ==============================
+    st.markdown("## 🔄 3º - Enriquecer batimento com Balancete")
 
-            if "CNPJ" not in df_rel_comum.columns:
-                st.error("O relatório 'Em Ambos' precisa ter a coluna 'CNPJ'.")
-                st.stop()
-
-            # 2) Parse do arquivo de balancete (xlsx mais confiável; pdf heurístico)
-            fname = str(getattr(balancete_file, "name", "")).lower()
-            if fname.endswith(".xlsx"):
-                df_balancete_proto = parse_protocolo_balancete(balancete_file)
-            else:
-                df_balancete_proto = parse_protocolo_balancete_from_pdf(balancete_file)
-
-            # 3) Padroniza colunas e normaliza CNPJ nas duas pontas
-            df_balancete_proto = padronizar_colunas(df_balancete_proto)
-
-            # Normaliza CNPJ do relatório-base
-            df_rel_comum["CNPJ"] = df_rel_comum["CNPJ"].apply(
-                lambda x: formatar_cnpj(normaliza_cnpj(x)) if pd.notna(x) else None
-            )
-
-            # Normaliza CNPJ do balancete (se existir)
-            if "CNPJ" in df_balancete_proto.columns:
-                df_balancete_proto["CNPJ"] = df_balancete_proto["CNPJ"].apply(
-                    lambda x: formatar_cnpj(normaliza_cnpj(x)) if pd.notna(x) else None
-                )
-            else:
-                st.warning(
-                    "Não foi possível extrair CNPJ do arquivo de Balancete — verifique o layout. "
-                    "O resultado pode ficar vazio."
-                )
-
-            # 4) Fallback: garante as colunas esperadas do balancete para o merge
-            for c in ["Balancete_Protocolo", "Balancete_Competencia", "Balancete_Status"]:
-                if c not in df_balancete_proto.columns:
-                    df_balancete_proto[c] = None
-
-            # 5) Merge por CNPJ
-            merged = df_rel_comum.merge(
-                df_balancete_proto[["CNPJ", "Balancete_Protocolo", "Balancete_Competencia", "Balancete_Status"]],
-                on="CNPJ",
-                how="left"
-            )
-
-            # Preenche vazios
-            for c in ["Balancete_Protocolo", "Balancete_Competencia", "Balancete_Status"]:
-                merged[c] = merged[c].fillna("Não possui")
-
-            # 🔽 PADRONIZA COMPETÊNCIA para 01/MM/AAAA (CDA e Balancete):
-            for col in ["CDA_Competencia", "Balancete_Competencia"]:
-                if col in merged.columns:
-                    merged[col] = merged[col].map(_competencia_to_01_mm_aaaa)
-
-
-            cols = list(merged.columns)
-            insert_pos = cols.index("Mes de Referencia") + 1 if "Mes de Referencia" in cols else len(cols)
+    colb1, colb2 = st.columns(2)
+    with colb1:
+        relatorio_ambos_file = st.file_uploader(
+            "Arquivo Relatório de Ambos com CDA (.xlsx, .csv.gz ou .parquet)",
+            type=TIPOS_RELATORIO_ENTRADA,
+            key="relatorio_ambos",
+            help="Opcional se o 2º passo foi processado nesta sessão."
+        )
+    with colb2:
+        balancete_file = st.file_uploader(
+            "Arquivo de Balancete (XLSX ou PDF)",
+            type=["xlsx", "pdf"],
+            accept_multiple_files=False
+        )
 
-            for c in ["Balancete_Protocolo", "Balancete_Competencia", "Balancete_Status"]:
-                if c in cols:
-                    cols.remove(c)
+    enriquecer = st.button("Preencher colunas Balancete", type="primary", key="btn_balancete_enriquecer")
+    forcar = st.session_state.pop("forcar_passo3", False)
 
-            cols = (
-                cols[:insert_pos]
-                + ["Balancete_Protocolo", "Balancete_Competencia", "Balancete_Status"]
-                + cols[insert_pos:]
-            )
-            merged = merged[cols]
+    if enriquecer or forcar:
+        tem_passo2 = "arquivo_cda" in st.session_state.get("entradas_pipeline", {})
+        if not balancete_file or not (relatorio_ambos_file or tem_passo2):
+            st.error("⚠️ Envie os dois arquivos antes de enriquecer.")
+            st.stop()
+        conferir_uploads((relatorio_ambos_file, "relatorio"), (balancete_file, "protocolo_balancete"))
+        entradas = entradas_pipeline(arquivo_rel_cda=arquivo_em_memoria(relatorio_ambos_file),
+                                     arquivo_balancete=arquivo_em_memoria(balancete_file))
+        acionar_passo("passo3", ["rel_balancete", "balancete"], entradas, forcar,
+                      descricao="Enriquecendo com Balancete")
 
-            # 7) Exibe e disponibiliza download
+    try:
+        concluido, resultado, item, do_cache = coletar_acao("passo3")
+        if concluido:
+            if do_cache:
+                indicador_cache("passo3", item)
+            merged = resultado["rel_balancete"]
+            for aviso in avisos_balancete(resultado["balancete"]):
+                st.warning(aviso)
+
+            # Exibe e disponibiliza download
             encontrados = merged["Balancete_Protocolo"].astype(str).str.strip().ne("Não possui").sum()
             st.success(f"✅ Enriquecido com {encontrados} protocolos encontrados.")
-            st.dataframe(merged, use_container_width=True, hide_index=True)
+            grade_paginada(merged, "grade_balancete")
 
             # Mensagem fixa + download
             st.session_state["mensagens_balancete"] = [
                 f"✅ Enriquecido com {encontrados} protocolos encontrados."
             ]
-            st.download_button(
-                label="⬇️ Baixar — Batimento do CDA e do Balancete",
-                data=to_excel_bytes(merged, sheet_name="Batimento do CDA e do Balancete"),
-                file_name="Batimento do CDA e do Balancete.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            )
-        # ... após montar `merged`
-        st.session_state["rel_enriquecido_balancete"] = merged  # <- adiciona esta linha
-
-
+            botao_download_relatorio("⬇️ Baixar — Batimento do CDA e do Balancete", merged,
+                                     "Batimento do CDA e do Balancete",
+                                     sheet_name="Batimento do CDA e do Balancete",
+                                     downloads=item["downloads"])
+            st.session_state["passo3_concluido"] = True  # habilita o 4º passo
+
+    except ValueError as e:
+        st.error(str(e))
     except Exception as e:
         st.exception(e)
 
-# Mensagens persistentes
-if "mensagens_balancete" in st.session_state:
-    for msg in st.session_state["mensagens_balancete"]:
-        st.markdown(msg)
+    # Mensagens persistentes
+    if "mensagens_balancete" in st.session_state:
+        for msg in st.session_state["mensagens_balancete"]:
+            st.markdown(msg)
 
-# ============================== 4º - Validação de Competência (CDA & Balancete) ==============================
-st.markdown("## ✅ 4º - Validação de Competência (CDA & Balancete)")
+    # ============================== 4º - Validação de Competência (CDA & Balancete) ==============================
+    st.markdown("## ✅ 4º - Validação de Competência (CDA & Balancete)")
 
-with st.form("form_validacao_comp"):
-    modo = st.radio("Validar por:", ("Data exata (DD/MM/AAAA)", "Mês/Ano (MM/AAAA)"), horizontal=True)
-    if modo.startswith("Data exata"):
-        data_alvo = st.text_input("Data da competência (DD/MM/AAAA)", value="01/08/2025", placeholder="DD/MM/AAAA")
-        mes_ano_alvo = None
-    else:
-        mes_ano_alvo = st.text_input("Mês/Ano da competência (MM/AAAA)", value="08/2025", placeholder="MM/AAAA")
-        data_alvo = None
+    with st.form("form_validacao_comp"):
+        modo = st.radio("Validar por:", ("Data exata (DD/MM/AAAA)", "Mês/Ano (MM/AAAA)"), horizontal=True)
+        if modo.startswith("Data exata"):
+            data_alvo = st.text_input("Data da competência (DD/MM/AAAA)", value="01/08/2025", placeholder="DD/MM/AAAA")
+            mes_ano_alvo = None
+        else:
+            mes_ano_alvo = st.text_input("Mês/Ano da competência (MM/AAAA)", value="08/2025", placeholder="MM/AAAA")
+            data_alvo = None
 
-    contar_nao_possui = st.checkbox('Contar "Não possui" como erro', value=True)
-    validar_btn = st.form_submit_button("Validar agora")
+        contar_nao_possui = st.checkbox('Contar "Não possui" como erro', value=True)
+        validar_btn = st.form_submit_button("Validar agora")
+    forcar = st.session_state.pop("forcar_passo4", False)
 
-if validar_btn:
-    df_base = st.session_state.get("rel_enriquecido_balancete")  # gerado no passo 3
-    if df_base is None:
-        st.warning("Antes, rode o 3º passo (Balancete) para gerar o relatório enriquecido.")
-    else:
+    if validar_btn or forcar:
+        if not st.session_state.get("passo3_concluido"):
+            st.warning("Antes, rode o 3º passo (Balancete) para gerar o relatório enriquecido.")
+        else:
+            alvo_msg = data_alvo if modo.startswith("Data exata") else mes_ano_alvo
+            titulo_rel = f"Divergencias_Competencia_{alvo_msg.replace('/', '-')}"
+            # só a validação depende do alvo: as etapas anteriores saem do cache, a menos que
+            # algum arquivo dos passos 1–3 tenha mudado desde então
+            entradas = entradas_pipeline(parametros_validacao={
+                "modo": "data" if modo.startswith("Data exata") else "mes_ano",
+                "alvo": alvo_msg,
+                "contar_nao_possui": contar_nao_possui,
+            })
+            # as etapas anteriores saem do cache; só vêm junto para o histórico
+            alvos = alvos_do_historico(entradas)
+            try:
+                impressao = impressao_acao("passo4", alvos, entradas)
+            except ValueError as e:
+                st.error(str(e))
+                st.stop()
+            item = None if forcar else buscar_acao(impressao)
+            if item is not None:
+                indicador_cache("passo4", item)  # já registrada no histórico quando foi calculada
+            else:
+                perfil = nova_pasta_perfil() if st.session_state.get("perfilar") else None
+                try:
+                    with st.spinner("Validando competências..."):
+                        resultado = executar_etapas(alvos, entradas, cache=cache_etapas(), perfil=perfil,
+                                                    recalcular=forcar)
+                except ValueError as e:
+                    st.error(str(e))
+                    st.stop()
+                if perfil:
+                    mostrar_perfil(perfil)
+                try:
+                    registrar_no_historico(resultado, chave_execucao(entradas), entradas["parametros_validacao"],
+                                           origem="interface", regras_versao=entradas["regras"]["versao"])
+                except (sqlite3.Error, OSError) as e:
+                    st.warning(f"Execução não registrada no histórico: {e}")
+                item = guardar_acao(impressao, resultado)
+            resultado = item["resultado"]
+            inconsist = resultado["validacao"]
+
+            # Consolidado, segmentos e resumo (CNPJ únicos) em uma chamada só
+            divergencias = resultado["divergencias"]
+            resumo = divergencias["resumo"]
+            if resumo["fundos_com_erro"] == 0:
+                st.success(f"Tudo certo! Nenhuma divergência para {alvo_msg}. "
+                           f"Fundos na base: {resumo['total_fundos']}.")
+            else:
+                perc = (resumo["fundos_com_erro"]/resumo["total_fundos"]) if resumo["total_fundos"] else 0
+                st.error(
+                    f"Foram encontrados **{resumo['fundos_com_erro']} fundos** com divergência "
+                    f"({perc:.1%} do total de {resumo['total_fundos']}).\n\n"
+                    f"Linhas de divergência: {resumo['linhas']}."
+                )
+                st.caption(
+                    f"Quebra por origem — Somente **CDA**: {resumo['somente_cda']} • "
+                    f"Somente **Balancete**: {resumo['somente_balancete']} • "
+                    f"**Ambos**: {resumo['ambos']}"
+                )
+
+                # 1) Grid de linhas (auditoria)
+                with st.expander("🔎 Ver linhas de divergência (CDA e Balancete)"):
+                    grade_paginada(inconsist, "grade_div_linhas")
+                    botao_download_relatorio("⬇️ Baixar (linhas) — Divergências por origem", inconsist,
+                                             f"{titulo_rel}_linhas", sheet_name="Divergencias_Linhas",
+                                             downloads=item["downloads"])
+
+                # 2) Consolidado por fundo (uma linha por CNPJ) e segmentos por CNPJ
+                consol = divergencias["consolidado"]
+                df_so_cda = divergencias["segmentos"]["Somente CDA"]
+                df_so_bal = divergencias["segmentos"]["Somente Balancete"]
+                df_ambos  = divergencias["segmentos"]["Ambos"]
+
+                with st.expander("🧮 Consolidado por fundo (1 linha por CNPJ)"):
+                    grade_paginada(consol, "grade_div_consolidado")
+                    botao_download_relatorio("⬇️ Baixar (fundos) — Consolidado geral", consol,
+                                             f"{titulo_rel}_fundos", sheet_name="Consolidado_Fundos",
+                                             downloads=item["downloads"])
+
+                col_a, col_b, col_c = st.columns(3)
+                with col_a:
+                    st.write(f"**Somente CDA** ({len(df_so_cda)} fundos)")
+                    grade_paginada(df_so_cda, "grade_div_so_cda")
+                    botao_download_relatorio("⬇️ Baixar — Somente CDA", df_so_cda,
+                                             f"{titulo_rel}_somente_CDA", sheet_name="Somente_CDA",
+                                             downloads=item["downloads"])
+                with col_b:
+                    st.write(f"**Somente Balancete** ({len(df_so_bal)} fundos)")
+                    grade_paginada(df_so_bal, "grade_div_so_bal")
+                    botao_download_relatorio("⬇️ Baixar — Somente Balancete", df_so_bal,
+                                             f"{titulo_rel}_somente_Balancete", sheet_name="Somente_Balancete",
+                                             downloads=item["downloads"])
+                with col_c:
+                    st.write(f"**Ambos** ({len(df_ambos)} fundos)")
+                    grade_paginada(df_ambos, "grade_div_ambos")
+                    botao_download_relatorio("⬇️ Baixar — Ambos", df_ambos,
+                                             f"{titulo_rel}_ambos", sheet_name="Ambos",
+                                             downloads=item["downloads"])
+
+
+# ========================== LINHA DE COMANDO ==========================
+def cli(argv=None) -> int:
+    """Modos sem interface. A interface web continua sendo `streamlit run app.py`."""
+    import argparse
+    parser = argparse.ArgumentParser(prog="app.py", description="Batimento de Fundos — modos sem interface.")
+    sub = parser.add_subparsers(dest="comando", required=True)
+
+    p_api = sub.add_parser("api", help="sobe a API HTTP local")
+    p_api.add_argument("--host", default="127.0.0.1")
+    p_api.add_argument("--porta", type=int, default=8765)
+    p_api.add_argument("--workers", type=int, default=4, help="batimentos simultâneos")
+    p_api.add_argument("--perfil", action="store_true",
+                       help=f"grava cProfile/tracemalloc por etapa em {PASTA_PERFIS} (uma pasta por requisição)")
+    p_api.add_argument("--motor", choices=MOTORES, default=MOTOR_PADRAO)
+
+    p_vigia = sub.add_parser("vigiar", help="processa automaticamente os arquivos que chegam numa pasta")
+    p_vigia.add_argument("pasta", help="pasta onde chegam CadFi, Controle FIC, CDA e Balancete")
+    p_vigia.add_argument("--saida", required=True, help="pasta dos relatórios versionados")
+    p_vigia.add_argument("--intervalo", type=float, default=30.0, help="segundos entre varreduras")
+    p_vigia.add_argument("--formato", choices=list(FORMATOS_EXPORTACAO), default="xlsx")
+    p_vigia.add_argument("--competencia", help="MM/AAAA: também roda a validação do 4º passo")
+    p_vigia.add_argument("--uma-vez", action="store_true", help="faz uma varredura e sai")
+    p_vigia.add_argument("--perfil", action="store_true",
+                         help="grava cProfile/tracemalloc por etapa na pasta de cada execução")
+    p_vigia.add_argument("--motor", choices=MOTORES, default=MOTOR_PADRAO)
+    p_vigia.add_argument("--sem-historico", action="store_true", help="não registra as execuções no histórico")
+
+    # --banco vale em cada ação (`historico consultar "<sql>" --banco x.sqlite`), não só antes dela
+    com_banco = argparse.ArgumentParser(add_help=False)
+    com_banco.add_argument("--banco", default=str(ARQUIVO_HISTORICO), help="arquivo SQLite do histórico")
+
+    p_hist = sub.add_parser("historico", help="consulta o histórico de execuções (SQLite)")
+    sub_hist = p_hist.add_subparsers(dest="acao", required=True)
+    p_consulta = sub_hist.add_parser("consultar", parents=[com_banco],
+                                     help="roda uma consulta SQL (somente leitura)")
+    p_consulta.add_argument("sql", help=f"SQL ou o nome de uma consulta pronta: {', '.join(map(repr, CONSULTAS_HISTORICO))}")
+    p_consulta.add_argument("--saida", help="grava o resultado num arquivo (.xlsx, .csv.gz ou .parquet)")
+    p_importar = sub_hist.add_parser("importar", parents=[com_banco],
+                                     help="registra as execuções já gravadas pelo vigia")
+    p_importar.add_argument("pasta", help="pasta de saída do vigia")
+
+    p_cadfi = sub.add_parser("cadfi", help="linha do tempo dos fundos a partir dos CadFi processados")
+    sub_cadfi = p_cadfi.add_subparsers(dest="acao", required=True)
+    p_registrar = sub_cadfi.add_parser("registrar", parents=[com_banco],
+                                       help="acrescenta um CadFi (.xlsx) à linha do tempo")
+    p_registrar.add_argument("arquivo")
+    p_registrar.add_argument("--data", help="data do CadFi (padrão: a do nome do arquivo ou a da modificação)")
+    p_fundo = sub_cadfi.add_parser("fundo", parents=[com_banco],
+                                   help="intervalos de situação/administrador/tipo de um CNPJ")
+    p_fundo.add_argument("cnpj")
+    p_mov = sub_cadfi.add_parser("movimentos", parents=[com_banco],
+                                 help="fundos que entraram/saíram do universo FIC entre duas datas")
+    p_mov.add_argument("--de", required=True)
+    p_mov.add_argument("--ate", required=True)
+    p_na_data = sub_cadfi.add_parser("na-data", parents=[com_banco],
+                                     help="grava o CadFi como era numa data (entrada do 1º passo)")
+    p_na_data.add_argument("data")
+    p_na_data.add_argument("--saida", required=True, help="arquivo .xlsx")
+
+    p_bench = sub.add_parser("bench", help="compara tempos e relatórios dos motores pandas e Polars")
+    p_bench.add_argument("--cadfi", required=True)
+    p_bench.add_argument("--controle", required=True)
+    p_bench.add_argument("--cda", help="inclui o 2º passo")
+    p_bench.add_argument("--balancete", help="inclui o 3º passo (exige --cda)")
+    p_bench.add_argument("--competencia", help="MM/AAAA: inclui a validação do 4º passo (exige --balancete)")
+    p_bench.add_argument("--repeticoes", type=int, default=3)
+    p_carga = sub.add_parser("carga", help="teste de carga: N sessões simultâneas nos quatro passos")
+    p_carga.add_argument("--sessoes", default="1,2,4,8",
+                         help="sessões simultâneas; uma lista (1,4,8) roda um nível depois do outro")
+    p_carga.add_argument("--entradas", help="pasta com cadfi.xlsx, controle.xlsx, cda.xlsx e balancete.xlsx "
+                                            "(sem ela, gera entradas sintéticas)")
+    p_carga.add_argument("--fundos", type=int, default=3000, help="tamanho do CadFi sintético")
+    p_carga.add_argument("--workers", type=int, default=4, help="tarefas simultâneas (o pool da interface usa 4)")
+    p_carga.add_argument("--formato", choices=list(FORMATOS_EXPORTACAO), default="xlsx")
+    p_carga.add_argument("--cache-compartilhado", action="store_true",
+                         help="todas as sessões no mesmo cache de etapas (mesmos arquivos para todos)")
+    p_rerun = sub.add_parser("rerun", help="mede o custo fixo de cada rerun do Streamlit (fora da interface)")
+    p_rerun.add_argument("--repeticoes", type=int, default=20)
+
+    args = parser.parse_args(argv)
+    if args.comando == "vigiar":
+        parametros = ({"modo": "mes_ano", "alvo": args.competencia, "contar_nao_possui": True}
+                      if args.competencia else None)
+        print(f"Vigiando {args.pasta} a cada {args.intervalo:g}s (Ctrl+C para encerrar)")
+        try:
+            vigiar_pasta(args.pasta, args.saida, args.intervalo, args.formato, parametros,
+                         uma_vez=args.uma_vez, perfil=args.perfil, motor=args.motor,
+                         historico=not args.sem_historico)
+        except KeyboardInterrupt:
+            pass
+    elif args.comando == "api":
+        servidor = criar_servidor_api(args.host, args.porta, args.workers,
+                                      perfil=PASTA_PERFIS if args.perfil else None, motor=args.motor)
+        host, porta = servidor.server_address[:2]
+        print(f"API do batimento em http://{host}:{porta} (Ctrl+C para encerrar)")
         try:
-            if modo.startswith("Data exata"):
-                inconsist = validar_por_data_exata(df_base, data_alvo, contar_nao_possui=contar_nao_possui)
-                titulo_rel = f"Divergencias_Competencia_{data_alvo.replace('/', '-')}"
-                alvo_msg = data_alvo
+            servidor.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            servidor.server_close()
+    elif args.comando == "historico":
+        try:
+            if args.acao == "importar":
+                print(f"{importar_historico(args.pasta, banco=args.banco)} execução(ões) registrada(s) em {args.banco}")
+                return 0
+            df, ms = consultar_historico(CONSULTAS_HISTORICO.get(args.sql, args.sql), banco=args.banco)
+        except ValueError as e:
+            print(e)
+            return 1
+        if args.saida:
+            formato = next((f for f, (ext, _) in FORMATOS_EXPORTACAO.items() if args.saida.endswith(ext)), "xlsx")
+            escrever_relatorio(df, args.saida, formato, sheet_name="Consulta")
+        else:
+            with pd.option_context("display.max_rows", 200, "display.max_columns", None, "display.width", 200):
+                print(df.to_string(index=False) if not df.empty else "(nenhuma linha)")
+        print(f"{len(df)} linha(s) em {ms:.1f} ms")
+    elif args.comando == "cadfi":
+        try:
+            if args.acao == "registrar":
+                caminho = Path(args.arquivo)
+                data = args.data or data_no_nome(caminho) or data_iso(datetime.fromtimestamp(caminho.stat().st_mtime))
+                info = registrar_snapshot_cadfi(_etapa_cadfi(str(caminho)), data, banco=args.banco)
+                print(f"CadFi de {info['data']} registrado: {info['fundos_alterados']} fundo(s) com mudança "
+                      f"(linha do tempo {info['versao']})")
+                return 0
+            linha = carregar_linha_do_tempo(args.banco)
+            if args.acao == "fundo":
+                df = linha_do_tempo_fundo(linha, args.cnpj)
+            elif args.acao == "movimentos":
+                df = movimentos_universo_fic(linha, args.de, args.ate)
             else:
-                inconsist = validar_por_mes_ano(df_base, mes_ano_alvo, contar_nao_possui=contar_nao_possui)
-                titulo_rel = f"Divergencias_Competencia_{mes_ano_alvo.replace('/', '-')}"
-                alvo_msg = mes_ano_alvo
+                df = cadfi_na_data(linha, args.data)
+                escrever_relatorio(df, args.saida, "xlsx", sheet_name="CadFi")
+                print(f"{len(df)} linha(s) gravada(s) em {args.saida}")
+                return 0
         except ValueError as e:
-            st.error(str(e))
-            st.stop()
-
-        # Resumo correto (CNPJ únicos)
-        resumo = resumo_divergencias(inconsist, df_base)
-        if resumo["fundos_com_erro"] == 0:
-            st.success(f"Tudo certo! Nenhuma divergência para {alvo_msg}. "
-                       f"Fundos na base: {resumo['total_fundos']}.")
+            print(e)
+            return 1
+        with pd.option_context("display.max_rows", 200, "display.max_columns", None, "display.width", 200):
+            print(df.to_string(index=False) if not df.empty else "(nenhuma linha)")
+    elif args.comando == "bench":
+        if len(motores_disponiveis()) < 2:
+            print("Polars não instalado: nada a comparar.")
+            return 1
+        entradas = {"regras": carregar_regras()}
+        alvos = ["batimento"]
+        for chave, caminho, alvo in (("arquivo_cadfi", args.cadfi, None), ("arquivo_controle", args.controle, None),
+                                     ("arquivo_cda", args.cda, "rel_cda"),
+                                     ("arquivo_balancete", args.balancete, "rel_balancete")):
+            if caminho:
+                entradas[chave] = io.BytesIO(Path(caminho).read_bytes())
+                entradas[chave].name = Path(caminho).name
+                alvos += [alvo] if alvo else []
+        if args.competencia and "rel_balancete" in alvos:
+            entradas["parametros_validacao"] = {"modo": "mes_ano", "alvo": args.competencia, "contar_nao_possui": True}
+            alvos += ["validacao", "divergencias"]
+        r = comparar_motores(entradas, alvos, args.repeticoes)
+        motores = list(r["tempos"])
+        print(f"{'etapa':<16}" + "".join(f"{m + ' (mediana)':>20}" for m in motores) + f"{'ganho':>10}")
+        for etapa in r["tempos"][motores[0]]:
+            medianas = [float(np.median(r["tempos"][m][etapa])) for m in motores]
+            print(f"{etapa:<16}" + "".join(f"{t * 1000:>18.1f}ms" for t in medianas)
+                  + f"{medianas[0] / max(medianas[-1], 1e-9):>9.1f}x")
+        diferentes = [k for k, ok in r["identicos"].items() if not ok]
+        print("Relatórios idênticos byte a byte." if not diferentes else f"Relatórios DIFERENTES: {', '.join(diferentes)}")
+        return 1 if diferentes else 0
+    elif args.comando == "carga":
+        import tempfile
+        if args.entradas:
+            arquivos = {entrada: str(Path(args.entradas) / nome) for entrada, nome in (
+                ("arquivo_cadfi", "cadfi.xlsx"), ("arquivo_controle", "controle.xlsx"),
+                ("arquivo_cda", "cda.xlsx"), ("arquivo_balancete", "balancete.xlsx"))}
         else:
-            perc = (resumo["fundos_com_erro"]/resumo["total_fundos"]) if resumo["total_fundos"] else 0
-            st.error(
-                f"Foram encontrados **{resumo['fundos_com_erro']} fundos** com divergência "
-                f"({perc:.1%} do total de {resumo['total_fundos']}).\n\n"
-                f"Linhas de divergência: {resumo['linhas']}."
-            )
-            st.caption(
-                f"Quebra por origem — Somente **CDA**: {resumo['somente_cda']} • "
-                f"Somente **Balancete**: {resumo['somente_balancete']} • "
-                f"**Ambos**: {resumo['ambos']}"
-            )
-
-            # 1) Grid de linhas (auditoria)
-            with st.expander("🔎 Ver linhas de divergência (CDA e Balancete)"):
-                st.dataframe(inconsist, use_container_width=True, hide_index=True)
-                st.download_button(
-                    "⬇️ Baixar (linhas) — Divergências por origem",
-                    data=to_excel_bytes(inconsist, sheet_name="Divergencias_Linhas"),
-                    file_name=f"{titulo_rel}_linhas.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                )
+            arquivos = gerar_entradas_sinteticas(tempfile.mkdtemp(prefix="batimento_entradas_"), args.fundos)
+            print(f"Entradas sintéticas ({args.fundos} fundos) em {Path(arquivos['arquivo_cadfi']).parent}")
+        print(f"{'sessões':>8}{'passo':>8}{'p50':>9}{'p90':>9}{'p99':>9}{'máx':>9}"
+              f"{'CPU (núcleos)':>15}{'RSS pico':>11}{'MiB/sessão':>12}")
+        falhou = False
+        for n in [int(x) for x in args.sessoes.split(",") if x.strip()]:
+            r = teste_de_carga(arquivos, n, args.workers, args.formato, args.cache_compartilhado)
+            for passo, lat in r["latencias"].items():
+                rss = f"{r['rss_pico_mib']:>9.0f}Mi" if r["rss_pico_mib"] is not None else f"{'n/a':>11}"
+                extra = (f"{r['cpu_nucleos']:>15.2f}{rss}{r['memoria_sessao_mib']:>12.1f}"
+                         if passo == "sessao" else "")
+                print(f"{n:>8}{passo:>8}" + "".join(f"{lat[k]:>8.2f}s" for k in ("p50", "p90", "p99", "max")) + extra)
+            if r["memoria_cache_mib"] is not None:
+                print(f"  cache compartilhado: {r['memoria_cache_mib']:.1f} MiB")
+            for erro in r["erros"]:
+                print(f"  erro: {erro}")
+            falhou = falhou or bool(r["erros"])
+        return 1 if falhou else 0
+    elif args.comando == "rerun":
+        r = medir_reexecucao(args.repeticoes)
+        print(f"Compilação do app.py (o Streamlit guarda o bytecode): {r['compilacao_ms']:.1f} ms")
+        print(f"Tabelas fixas (só na 1ª execução do processo): {r['tabelas_ms']:.1f} ms")
+        print(f"Re-execução do módulo por rerun: {r['reexecucao_ms']:.2f} ms (mediana; máx. {r['reexecucao_max_ms']:.2f} ms)")
+    return 0
+
+def _em_execucao_streamlit() -> bool:
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        return get_script_run_ctx(suppress_warning=True) is not None
+    except (ImportError, TypeError):
+        return st.runtime.exists()
 
-            # 2) Consolidado por fundo (uma linha por CNPJ)
-            consol = consolidar_incons_por_fundo(inconsist)
-
-            # Segmentos por CNPJ
-            tem_cda = consol["CDA atual"].notna() | consol["CDA esperada"].notna()
-            tem_bal = consol["Balancete atual"].notna() | consol["Balancete esperada"].notna()
-            df_so_cda = consol[tem_cda & ~tem_bal]
-            df_so_bal = consol[~tem_cda & tem_bal]
-            df_ambos  = consol[tem_cda & tem_bal]
-
-            with st.expander("🧮 Consolidado por fundo (1 linha por CNPJ)"):
-                st.dataframe(consol, use_container_width=True, hide_index=True)
-                st.download_button(
-                    "⬇️ Baixar (fundos) — Consolidado geral",
-                    data=to_excel_bytes(consol, sheet_name="Consolidado_Fundos"),
-                    file_name=f"{titulo_rel}_fundos.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                )
 
-            col_a, col_b, col_c = st.columns(3)
-            with col_a:
-                st.write(f"**Somente CDA** ({len(df_so_cda)} fundos)")
-                st.dataframe(df_so_cda, use_container_width=True, hide_index=True)
-                st.download_button(
-                    "⬇️ Baixar — Somente CDA",
-                    data=to_excel_bytes(df_so_cda, sheet_name="Somente_CDA"),
-                    file_name=f"{titulo_rel}_somente_CDA.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                )
-            with col_b:
-                st.write(f"**Somente Balancete** ({len(df_so_bal)} fundos)")
-                st.dataframe(df_so_bal, use_container_width=True, hide_index=True)
-                st.download_button(
-                    "⬇️ Baixar — Somente Balancete",
-                    data=to_excel_bytes(df_so_bal, sheet_name="Somente_Balancete"),
-                    file_name=f"{titulo_rel}_somente_Balancete.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                )
-            with col_c:
-                st.write(f"**Ambos** ({len(df_ambos)} fundos)")
-                st.dataframe(df_ambos, use_container_width=True, hide_index=True)
-                st.download_button(
-                    "⬇️ Baixar — Ambos",
-                    data=to_excel_bytes(df_ambos, sheet_name="Ambos"),
-                    file_name=f"{titulo_rel}_ambos.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                )
+if __name__ == "__main__":
+    if _em_execucao_streamlit():
+        main()
+    else:
+        import sys
+        sys.exit(cli())